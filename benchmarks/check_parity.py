@@ -0,0 +1,167 @@
+"""
+Sprawdzenie zgodności wyników potoku rozliczenia z zapisanym punktem odniesienia.
+
+Na małym syntetycznym wyciągu IBKR (stałe parametry i ziarno) przelicza potok: filtrowanie,
+łączenie z kursami, konwersję walut, alokację FIFO oraz podsumowania per stock i per rok,
+i porównuje z parity_reference.json:
+- fifo_allocated oraz kwoty przeliczone (Proceeds_converted, Basis_converted, Comm/Fee_converted)
+  każdej transakcji (po id),
+- sumy z podsumowania per stock i per stock i rok.
+Potok z kwotami zmiennoprzecinkowymi musi zgadzać się co do błędu zaokrągleń. Z kwotami
+stałoprzecinkowymi (MONEY_MODE=fixed) każda transakcja jest zaokrąglana do jednostek drobnych,
+więc sumy mogą odbiegać bardziej – dopuszczamy różnicę względną --fixed-tolerance.
+
+Użycie:
+    python benchmarks/check_parity.py                    # porównanie z parity_reference.json
+    python benchmarks/check_parity.py --save-reference   # zapis nowego punktu odniesienia
+
+Skrypt kończy się kodem 1, jeśli któraś wartość różni się od punktu odniesienia.
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import tempfile
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+DEFAULT_REFERENCE = os.path.join(BENCHMARKS_DIR, "parity_reference.json")
+
+sys.path.insert(0, BENCHMARKS_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from statement_generator import generate_statement  # noqa: E402
+
+PARAMS = {
+    "tickers": 8,
+    "fills": 40,
+    "currencies": ["USD", "EUR", "GBP"],
+    "first_year": 2019,
+    "last_year": 2024,
+    "shorts": 0.2,
+    "seed": 7,
+}
+ROW_COLUMNS = ["fifo_allocated", "Proceeds_converted", "Basis_converted", "Comm/Fee_converted"]
+SUMMARY_COLUMNS = [
+    "Total_Sold", "Proceeds sum", "Proceeds_converted sum", "Comm/Fee sum", "Basis sum", "Basis_converted sum",
+    "Comm/Fee_converted sum", "Proceeds sum (quantity < 0)", "Proceeds_converted sum (quantity < 0)",
+    "Comm/Fee sum (quantity < 0)", "Basis sum (quantity < 0)", "Basis_converted sum (quantity < 0)",
+    "Comm/Fee_converted sum (quantity < 0)",
+]
+# Liczby akcji nie są kwotami – w obu trybach muszą zgadzać się dokładnie
+QUANTITY_COLUMNS = {"fifo_allocated", "Total_Sold"}
+
+
+def to_float(value):
+    # Brak wartości (NaN, NA) zapisujemy w JSON jako null
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(value) else value
+
+
+def outputs(main, html: bytes, money_mode: str) -> dict:
+    """
+    Przelicza potok na wyciągu i zwraca porównywane wartości: transakcje po id, podsumowanie
+    per stock i per stock i rok (kwoty stałoprzecinkowe zamienione na float).
+    """
+    rates = main.get_exchange_rates(main.DEFAULT_EXCHANGE_RATES_FILE)
+    # Identyfikatory nadaje magazyn transakcji – tu wystarczą kolejne liczby
+    df = main.parse_html_transactions(html)
+    df.insert(0, "id", range(1, len(df) + 1))
+    df["shares_in_possession"] = 0.0
+    df = main.standardize_stock_symbols(df)
+    df = main.filter_and_convert_transactions(df, money_mode)
+    df = main.merge_exchange_rates(df, rates)
+    df = main.apply_currency_conversion(df, rates)
+    df = main.allocate_fifo(df)
+    summary, yearly = (main.money_to_float(part) for part in main.summarize_trades(df))
+    df = main.money_to_float(df)
+
+    return {
+        "rows": {str(int(row["id"])): [to_float(row[column]) for column in ROW_COLUMNS]
+                 for _, row in df.iterrows()},
+        "summary": {row["Stock"]: [to_float(row[column]) for column in SUMMARY_COLUMNS]
+                    for _, row in summary.iterrows()},
+        "yearly": {f"{row['Stock']} {int(row['Year'])}": [to_float(row[column]) for column in SUMMARY_COLUMNS]
+                   for _, row in yearly.iterrows()},
+    }
+
+
+def compare(result: dict, reference: dict, abs_tol: float, rel_tol: float) -> list:
+    """
+    Zwraca listę różnic (sekcja, klucz, kolumna, wartość odniesienia, wartość bieżąca).
+    Kwoty są zgodne, jeśli różnią się o nie więcej niż abs_tol albo rel_tol (względnie);
+    liczby akcji (QUANTITY_COLUMNS) – co do błędu zaokrągleń.
+    """
+    differences = []
+    for section, columns in (("rows", ROW_COLUMNS), ("summary", SUMMARY_COLUMNS), ("yearly", SUMMARY_COLUMNS)):
+        for key in sorted(set(result[section]) | set(reference[section])):
+            if key not in result[section] or key not in reference[section]:
+                differences.append((section, key, None, reference[section].get(key), result[section].get(key)))
+                continue
+            for column, expected, actual in zip(columns, reference[section][key], result[section][key]):
+                if expected is None or actual is None:
+                    same = expected is None and actual is None
+                elif column in QUANTITY_COLUMNS:
+                    same = math.isclose(actual, expected, rel_tol=1e-9, abs_tol=1e-9)
+                else:
+                    same = math.isclose(actual, expected, rel_tol=rel_tol, abs_tol=abs_tol)
+                if not same:
+                    differences.append((section, key, column, expected, actual))
+    return differences
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Zgodność wyników potoku rozliczenia z punktem odniesienia.")
+    parser.add_argument("--reference", default=DEFAULT_REFERENCE)
+    parser.add_argument("--save-reference", action="store_true", help="zapisz wynik jako punkt odniesienia")
+    parser.add_argument("--tolerance", type=float, default=1e-6,
+                        help="dopuszczalna bezwzględna różnica dla kwot zmiennoprzecinkowych")
+    parser.add_argument("--fixed-tolerance", type=float, default=0.005,
+                        help="dopuszczalna względna różnica dla kwot stałoprzecinkowych")
+    args = parser.parse_args()
+
+    # Baza magazynu transakcji musi być ustawiona przed importem aplikacji
+    db_dir = tempfile.mkdtemp(prefix="rozliczenie-parity-")
+    os.environ["TRADES_DB"] = os.path.join(db_dir, "trades.db")
+    os.chdir(REPO_DIR)
+    import main as app_main
+
+    html = generate_statement(**PARAMS).encode("utf-8")
+    result = outputs(app_main, html, "float")
+    print(f"Transakcji: {len(result['rows'])}, stocków: {len(result['summary'])}, "
+          f"par stock-rok: {len(result['yearly'])}")
+
+    if args.save_reference:
+        with open(args.reference, "w", encoding="utf-8") as f:
+            json.dump({"params": PARAMS, **result}, f, indent=1)
+            f.write("\n")
+        print(f"Zapisano punkt odniesienia: {args.reference}")
+        return 0
+
+    with open(args.reference, encoding="utf-8") as f:
+        reference = json.load(f)
+    if reference["params"] != PARAMS:
+        print("Parametry różnią się od punktu odniesienia – zapisz go ponownie (--save-reference).")
+        return 1
+
+    # Kwoty stałoprzecinkowe: do 0,05 na transakcję (zaokrąglenia kwot i opłat) albo --fixed-tolerance
+    checks = [("float", result, args.tolerance, 1e-9),
+              ("fixed", outputs(app_main, html, "fixed"), 0.05, args.fixed_tolerance)]
+    failed = False
+    for money_mode, result, abs_tol, rel_tol in checks:
+        differences = compare(result, reference, abs_tol, rel_tol)
+        for section, key, column, expected, actual in differences[:20]:
+            print(f"RÓŻNICA [{money_mode}] {section} {key} {column or ''}: {expected} -> {actual}")
+        if len(differences) > 20:
+            print(f"... i {len(differences) - 20} kolejnych różnic [{money_mode}]")
+        print(f"{money_mode}: {'zgodne' if not differences else f'{len(differences)} różnic'}")
+        failed = failed or bool(differences)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+"""
+Benchmark etapów potoku rozliczenia na syntetycznym wyciągu IBKR.
+
+Mierzy czas parsowania, filtrowania, łączenia z kursami, konwersji walut, alokacji FIFO,
+obu podsumowań oraz pełnych żądań strony głównej, zakładki stocku i eksportu CSV (przez klienta
+testowego Flask).
+Filtrowanie, konwersja walut i podsumowania są mierzone także z kwotami stałoprzecinkowymi.
+Każdy etap jest powtarzany kilka razy; zapisywany jest najlepszy czas.
+
+Użycie:
+    python benchmarks/run_benchmarks.py                   # pomiar i porównanie z baseline.json
+    python benchmarks/run_benchmarks.py --save-baseline   # zapis nowego punktu odniesienia
+    python benchmarks/run_benchmarks.py --threshold 0.5   # dopuszczalny wzrost czasu o 50%
+
+Skrypt kończy się kodem 1, jeśli któryś etap jest wolniejszy od punktu odniesienia
+o więcej niż próg (względny) i jednocześnie o więcej niż --min-delta sekund, a także
+jeśli punkt odniesienia nie zawiera któregoś z mierzonych etapów (trzeba go wtedy zapisać ponownie).
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qs, urlparse
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, "baseline.json")
+
+sys.path.insert(0, BENCHMARKS_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from statement_generator import generate_statement  # noqa: E402
+
+
+def best_time(func, setup=None, repeat: int = 3) -> float:
+    """
+    Zwraca najkrótszy z repeat pomiarów wywołania func. Jeśli podano setup, jego wynik
+    (przygotowany poza pomiarem) jest przekazywany do func.
+    """
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run(params: dict, repeat: int) -> dict:
+    """
+    Generuje wyciąg o zadanych parametrach i mierzy czasy wszystkich etapów.
+    """
+    # Baza magazynu transakcji musi być ustawiona przed importem aplikacji
+    db_dir = tempfile.mkdtemp(prefix="rozliczenie-bench-")
+    os.environ["TRADES_DB"] = os.path.join(db_dir, "trades.db")
+    os.environ.setdefault("PARSE_WORKERS", "1")
+    os.chdir(REPO_DIR)
+    import main
+
+    html = generate_statement(**params).encode("utf-8")
+    rates = main.get_exchange_rates(main.DEFAULT_EXCHANGE_RATES_FILE)
+    stages = {}
+
+    stages["parse_html_transactions"] = best_time(lambda: main.parse_html_transactions(html), repeat=repeat)
+    # Identyfikatory nadaje magazyn transakcji – tu wystarczą kolejne liczby
+    parsed = main.parse_html_transactions(html)
+    parsed.insert(0, "id", range(1, len(parsed) + 1))
+    parsed["shares_in_possession"] = 0.0
+    parsed = main.standardize_stock_symbols(parsed)
+
+    stages["filter_and_convert_transactions"] = best_time(
+        main.filter_and_convert_transactions, lambda: (parsed.copy(),), repeat)
+    filtered = main.filter_and_convert_transactions(parsed.copy())
+
+    stages["merge_exchange_rates"] = best_time(
+        main.merge_exchange_rates, lambda: (filtered.copy(), rates), repeat)
+    merged = main.merge_exchange_rates(filtered.copy(), rates)
+
+    stages["apply_currency_conversion"] = best_time(
+        main.apply_currency_conversion, lambda: (merged.copy(), rates), repeat)
+    converted = main.apply_currency_conversion(merged.copy(), rates)
+
+    stages["allocate_fifo"] = best_time(main.allocate_fifo, lambda: (converted.copy(),), repeat)
+    allocated = main.allocate_fifo(converted.copy())
+
+    stages["summarize_transactions"] = best_time(lambda: main.summarize_transactions(allocated), repeat=repeat)
+    stages["summarize_transactions_by_year"] = best_time(
+        lambda: main.summarize_transactions_by_year(allocated), repeat=repeat)
+
+    # Te same etapy z kwotami stałoprzecinkowymi (MONEY_MODE=fixed)
+    stages["filter_and_convert_transactions_fixed"] = best_time(
+        main.filter_and_convert_transactions, lambda: (parsed.copy(), "fixed"), repeat)
+    merged_fixed = main.merge_exchange_rates(main.filter_and_convert_transactions(parsed.copy(), "fixed"), rates)
+    stages["apply_currency_conversion_fixed"] = best_time(
+        main.apply_currency_conversion, lambda: (merged_fixed.copy(), rates), repeat)
+    allocated_fixed = main.allocate_fifo(main.apply_currency_conversion(merged_fixed.copy(), rates))
+    stages["summarize_trades_fixed"] = best_time(lambda: main.summarize_trades(allocated_fixed), repeat=repeat)
+
+    # Pełne żądania: wgranie wyciągu, a potem strona główna i eksport bez pamięci podręcznej wyników
+    client = main.app.test_client()
+    portfolio_id = "benchmark-" + "0" * 16
+    client.set_cookie(main.PORTFOLIO_COOKIE, portfolio_id)
+    response = client.post("/", data={"files": [(io.BytesIO(html), "statement.html")]},
+                           content_type="multipart/form-data")
+    assert response.status_code == 302, response.data[:500]
+    # Wyciąg jest przetwarzany w tle – czekamy na zakończenie zadania wgrywania
+    job_id = parse_qs(urlparse(response.headers["Location"]).query)["upload"][0]
+    while True:
+        job = client.get(f"/uploads/{job_id}").get_json()
+        if job["state"] not in ("queued", "running"):
+            break
+        time.sleep(0.05)
+    assert job["state"] == "done", job
+
+    def request(path):
+        response = client.get(path)
+        assert response.status_code == 200, response.data[:500]
+
+    def cold(path):
+        # Każdy pomiar zaczyna od pustej pamięci podręcznej wyników
+        main.invalidate_results(main.portfolios.get(portfolio_id))
+        return (path,)
+
+    stages["index"] = best_time(request, lambda: cold("/"), repeat)
+    stages["export_csv"] = best_time(request, lambda: cold("/export-csv"), repeat)
+    # Zakładka stocku (ładowana przy otwarciu) – pierwsza strona tabeli transakcji największego stocku
+    stock = allocated["Stock"].value_counts().index[0]
+    stages["stock_tab"] = best_time(request, lambda: cold(f"/stock/{stock}"), repeat)
+    main.trade_store.clear(portfolio_id)
+
+    return {
+        "params": params,
+        "rows": int(len(allocated)),
+        "python": platform.python_version(),
+        "pandas": main.pd.__version__,
+        "stages": stages,
+    }
+
+
+def check(result: dict, baseline: dict, threshold: float, min_delta: float) -> list:
+    """
+    Zwraca listę etapów wolniejszych od punktu odniesienia o więcej niż próg.
+    Etapy bez punktu odniesienia są zwracane z wartością odniesienia None.
+    """
+    regressions = []
+    for stage, seconds in result["stages"].items():
+        reference = baseline["stages"].get(stage)
+        if reference is None:
+            regressions.append((stage, None, seconds))
+            continue
+        if seconds > reference * (1 + threshold) and seconds - reference > min_delta:
+            regressions.append((stage, reference, seconds))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark potoku rozliczenia transakcji.")
+    parser.add_argument("--tickers", type=int, default=50, help="liczba symboli na walutę")
+    parser.add_argument("--fills", type=int, default=100, help="liczba transakcji na symbol")
+    parser.add_argument("--currencies", default="USD,EUR,GBP")
+    parser.add_argument("--years", default="2019-2024", help="zakres lat, np. 2019-2024")
+    parser.add_argument("--shorts", type=float, default=0.1, help="udział pozycji krótkich")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="zapisz wynik jako punkt odniesienia")
+    parser.add_argument("--threshold", type=float, default=0.3, help="dopuszczalny względny wzrost czasu")
+    parser.add_argument("--min-delta", type=float, default=0.005,
+                        help="minimalny bezwzględny wzrost czasu (s) uznawany za regresję")
+    args = parser.parse_args()
+
+    first_year, last_year = map(int, args.years.split("-"))
+    params = {
+        "tickers": args.tickers,
+        "fills": args.fills,
+        "currencies": args.currencies.split(","),
+        "first_year": first_year,
+        "last_year": last_year,
+        "shorts": args.shorts,
+        "seed": args.seed,
+    }
+    result = run(params, args.repeat)
+
+    baseline = None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline["params"] != params:
+            print("Parametry różnią się od punktu odniesienia – porównanie pominięte.")
+            baseline = None
+        elif baseline.get("pandas") != result["pandas"]:
+            print(f"Punkt odniesienia zapisano na pandas {baseline.get('pandas')}, "
+                  f"bieżąca wersja to {result['pandas']} – czasy mogą nie być porównywalne.")
+
+    print(f"Transakcji: {result['rows']}")
+    for stage, seconds in result["stages"].items():
+        reference = baseline["stages"].get(stage) if baseline else None
+        ratio = f"  ({seconds / reference:.2f}x)" if reference else ""
+        print(f"{stage:38s} {seconds * 1000:10.2f} ms{ratio}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+            f.write("\n")
+        print(f"Zapisano punkt odniesienia: {args.baseline}")
+        return 0
+
+    if baseline:
+        regressions = check(result, baseline, args.threshold, args.min_delta)
+        for stage, reference, seconds in regressions:
+            if reference is None:
+                print(f"BRAK PUNKTU ODNIESIENIA {stage}: {seconds * 1000:.2f} ms (zapisz --save-baseline)")
+            else:
+                print(f"REGRESJA {stage}: {reference * 1000:.2f} ms -> {seconds * 1000:.2f} ms")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
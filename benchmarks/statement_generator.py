@@ -0,0 +1,124 @@
+"""
+Generator syntetycznych wyciągów IBKR w formacie HTML (sekcja Trades) do benchmarków.
+
+Wyciąg ma układ taki jak eksport z IBKR: nagłówek tabeli, wiersze nagłówków walut
+(td.header-currency), transakcje pogrupowane po walucie i symbolu oraz wiersze
+podsumowań "Total" dla każdego symbolu i waluty.
+
+Użycie:
+    python benchmarks/statement_generator.py wyciag.html --tickers 50 --fills 200
+"""
+import argparse
+import random
+from datetime import datetime, timedelta
+
+HEADERS = ["Symbol", "Date/Time", "Quantity", "T. Price", "C. Price", "Proceeds",
+           "Comm/Fee", "Basis", "Realized P/L", "MTM P/L", "Code"]
+
+
+def ticker_symbol(currency: str, index: int) -> str:
+    """
+    Zwraca unikalny symbol akcji dla danej waluty (np. AUSD, BUSD, ..., BAUSD).
+    """
+    letters = ""
+    index += 1
+    while index:
+        index, rest = divmod(index - 1, 26)
+        letters = chr(ord("A") + rest) + letters
+    return f"{letters}{currency}"
+
+
+def generate_trades(rnd: random.Random, count: int, first_year: int, last_year: int, short: bool) -> list:
+    """
+    Generuje chronologiczną listę transakcji (data, ilość, cena) jednego symbolu.
+    Pozycje długie nigdy nie schodzą poniżej zera; pozycje krótkie zaczynają od sprzedaży.
+    """
+    start = datetime(first_year, 1, 2, 9, 30)
+    span = (datetime(last_year, 12, 31, 16, 0) - start).total_seconds()
+    moments = sorted(rnd.uniform(0, span) for _ in range(count))
+    price = rnd.uniform(5, 500)
+    position = 0
+    trades = []
+    for moment in moments:
+        quantity = rnd.randint(1, 100)
+        if short:
+            # Pozycja krótka: otwieramy sprzedażą, zamykamy kupnem
+            if position < 0 and rnd.random() < 0.45:
+                quantity = min(quantity, -position)
+            else:
+                quantity = -quantity
+        elif position > 0 and rnd.random() < 0.45:
+            quantity = -min(quantity, position)
+        position += quantity
+        price = max(1.0, price * rnd.uniform(0.9, 1.1))
+        trades.append((start + timedelta(seconds=moment), quantity, round(price, 2)))
+    return trades
+
+
+def format_number(value: float, decimals: int = 2) -> str:
+    return f"{value:,.{decimals}f}"
+
+
+def trade_row(symbol: str, when: datetime, quantity: int, price: float, rnd: random.Random) -> str:
+    proceeds = -quantity * price
+    comm_fee = -round(rnd.uniform(0.35, 2.5), 8)
+    if quantity > 0:
+        basis = proceeds * -1 - comm_fee
+    else:
+        basis = proceeds * rnd.uniform(0.7, 1.1)
+    cells = [symbol, when.strftime("%Y-%m-%d, %H:%M:%S"), f"{quantity:,}", format_number(price),
+             format_number(price), format_number(proceeds), f"{comm_fee}", format_number(basis),
+             "0", "0", "O" if quantity > 0 else "C"]
+    return "<tr>" + "".join(f"<td>{cell}</td>" for cell in cells) + "</tr>"
+
+
+def total_row(label: str, colspan: int = 5) -> str:
+    return (f'<tr class="subtotal"><td colspan="{colspan}">{label}</td>'
+            + "".join("<td>0</td>" for _ in range(len(HEADERS) - colspan - 1)) + "</tr>")
+
+
+def generate_statement(tickers: int = 20, fills: int = 50, currencies=("USD", "EUR", "GBP"),
+                       first_year: int = 2019, last_year: int = 2024, shorts: float = 0.1,
+                       seed: int = 1) -> str:
+    """
+    Zwraca wyciąg HTML z tickers symbolami na każdą walutę i fills transakcjami na symbol.
+    shorts to udział symboli prowadzonych jako pozycje krótkie.
+    """
+    rnd = random.Random(seed)
+    out = [
+        "<html><head><title>Activity Statement</title></head><body>",
+        '<div class="sectionHeading" id="secTransactions_U1234567Heading">Trades</div>',
+        '<div class="sectionContent" id="tblTransactions_U1234567Body">',
+        '<table class="table table-bordered" id="summaryDetailTable">',
+        "<thead><tr>" + "".join(f'<th class="header-asset">{h}</th>' for h in HEADERS) + "</tr></thead>",
+    ]
+    for currency in currencies:
+        out.append(f'<tbody><tr><td class="header-currency" colspan="{len(HEADERS)}">{currency}</td></tr></tbody>')
+        out.append("<tbody>")
+        for index in range(tickers):
+            symbol = ticker_symbol(currency, index)
+            trades = generate_trades(rnd, fills, first_year, last_year, rnd.random() < shorts)
+            out.extend(trade_row(symbol, when, quantity, price, rnd) for when, quantity, price in trades)
+            out.append(total_row(f"Total {symbol}"))
+        out.append(total_row(f"Total {currency}", colspan=4))
+        out.append("</tbody>")
+    out.append("</table></div></body></html>")
+    return "\n".join(out)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generuje syntetyczny wyciąg IBKR (HTML).")
+    parser.add_argument("output")
+    parser.add_argument("--tickers", type=int, default=20, help="liczba symboli na walutę")
+    parser.add_argument("--fills", type=int, default=50, help="liczba transakcji na symbol")
+    parser.add_argument("--currencies", default="USD,EUR,GBP")
+    parser.add_argument("--years", default="2019-2024", help="zakres lat, np. 2019-2024")
+    parser.add_argument("--shorts", type=float, default=0.1, help="udział pozycji krótkich")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    first_year, last_year = map(int, args.years.split("-"))
+    html = generate_statement(args.tickers, args.fills, tuple(args.currencies.split(",")),
+                              first_year, last_year, args.shorts, args.seed)
+    with open(args.output, "w", encoding="utf-8") as f:
+        f.write(html)
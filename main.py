@@ -1,676 +1,3271 @@
-from flask import Flask, render_template, request, redirect, url_for, send_file
+from flask import (Flask, render_template, request, redirect, url_for, send_file, send_from_directory, Response, g,
+                   jsonify)
+from werkzeug.security import safe_join
 import pandas as pd
 import re
 from bs4 import BeautifulSoup
-from datetime import timedelta, datetime
+from datetime import datetime
 import os
 import io
+import csv
+import hashlib
+import hmac
+import secrets
+import cProfile
+import pstats
+import codecs
+import json
+import multiprocessing
+import sqlite3
+import threading
+import time
+from contextlib import closing, contextmanager
+from functools import wraps
+from html.parser import HTMLParser
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
 
 app = Flask(__name__)
+# Silnik parsowania wyciągów HTML: "stream" (strumieniowy) albo "bs4" (BeautifulSoup)
+app.config["PARSER_ENGINE"] = os.environ.get("PARSER_ENGINE", "stream")
+# Liczba procesów parsujących równolegle wgrane wyciągi (1 = parsowanie w procesie obsługującym żądanie)
+app.config["PARSE_WORKERS"] = int(os.environ.get("PARSE_WORKERS", min(4, os.cpu_count() or 1)))
+# Liczba wątków przetwarzających w tle wgrane wyciągi oraz katalog, w którym czekają na przetworzenie
+app.config["UPLOAD_WORKERS"] = int(os.environ.get("UPLOAD_WORKERS", 2))
+app.config["UPLOADS_DIR"] = os.environ.get("UPLOADS_DIR", "uploads")
+# Liczba transakcji na stronie w zakładce stocku (0 = wszystkie na jednej stronie)
+app.config["TAB_PAGE_SIZE"] = int(os.environ.get("TAB_PAGE_SIZE", 500))
+# Adresy, z których można pobierać /metrics (lista rozdzielona przecinkami)
+app.config["METRICS_ALLOWED"] = os.environ.get("METRICS_ALLOWED", "127.0.0.1,::1").split(",")
+# Co ile sekund proces zapisuje swoje metryki do wspólnego magazynu
+app.config["METRICS_FLUSH_SECONDS"] = float(os.environ.get("METRICS_FLUSH_SECONDS", 5))
+# Token włączający profilowanie żądań (parametr ?profile=<token> lub nagłówek X-Profile-Token);
+# bez ustawionego tokenu profilowanie jest wyłączone
+app.config["PROFILE_TOKEN"] = os.environ.get("PROFILE_TOKEN", "")
+app.config["PROFILES_DIR"] = os.environ.get("PROFILES_DIR", "profiles")
+# Liczba funkcji w raporcie tekstowym profilu
+app.config["PROFILE_TOP"] = int(os.environ.get("PROFILE_TOP", 40))
+# Katalog zapisanych migawek zbioru transakcji
+app.config["SNAPSHOTS_DIR"] = os.environ.get("SNAPSHOTS_DIR", "snapshots")
+# Plik bazy SQLite ze wspólnym magazynem transakcji (współdzielony przez procesy gunicorna)
+app.config["TRADES_DB"] = os.environ.get("TRADES_DB", "trades.db")
+# Reprezentacja kwot: "float" (liczby zmiennoprzecinkowe) albo "fixed" (int64 w groszach/centach,
+# dokładne zaokrąglenia – zob. to_minor_units)
+app.config["MONEY_MODE"] = os.environ.get("MONEY_MODE", "float")
+# Łączny budżet pamięci (w MB) portfeli trzymanych w pamięci jednego procesu
+app.config["PORTFOLIO_MEMORY_MB"] = float(os.environ.get("PORTFOLIO_MEMORY_MB", 512))
+# Ile transakcji przetwarzać naraz: potok liczy wyniki paczkami całych symboli o łącznej liczbie
+# transakcji nie większej niż limit (symbol większy od limitu tworzy własną paczkę; 0 = wszystko naraz)
+app.config["PROCESS_BATCH_ROWS"] = int(os.environ.get("PROCESS_BATCH_ROWS", 50000))
+# Katalog, do którego trafiają migawki stanu FIFO portfeli usuniętych z pamięci (pusty – bez zrzutu)
+app.config["PORTFOLIO_SPILL_DIR"] = os.environ.get("PORTFOLIO_SPILL_DIR", "portfolios")
+# Katalog skompilowanych tabel kursów (binarnie, nazwa pliku to skrót SHA-256 zawartości CSV)
+app.config["RATES_DIR"] = os.environ.get("RATES_DIR", "rates")
 
-# Globalny zbiór transakcji oraz licznik unikalnych identyfikatorów
-all_trades_df = pd.DataFrame(
-    columns=["id", "waluty", "Stock", "Date/Time", "Quantity", "Proceeds", "Comm/Fee", "Basis", "shares_in_possession"]
-)
-next_transaction_id = 1
-exchange_rates_file = "kursy.csv"  # Domyślna ścieżka do pliku z kursami
+DEFAULT_EXCHANGE_RATES_FILE = "kursy.csv"  # Domyślna ścieżka do pliku z kursami
+TRADE_FRAME_COLUMNS = ["id", "waluty", "Stock", "Date/Time", "Quantity", "Proceeds", "Comm/Fee", "Basis",
+                       "shares_in_possession"]
+
+_rates_fingerprints = {}
+_rate_stores = {}  # Magazyny kursów w pamięci procesu, kluczowane ścieżką pliku
+_parse_pool = None  # Pula procesów do parsowania wyciągów, tworzona przy pierwszym użyciu
+_upload_executor = None  # Wątki przetwarzające zadania wgrywania, tworzone przy pierwszym użyciu
 
 
 # ----------------- Funkcje pomocnicze -----------------
-def parse_html_transactions(html_content: str) -> pd.DataFrame:
+def detect_column_indices(header_texts: list) -> dict:
+    """
+    Na podstawie tekstów nagłówków tabeli (<th>) ustala indeksy potrzebnych kolumn.
+    Jeśli nie znaleziono nagłówków, zwraca domyślny układ.
+    """
+    column_indices = {}
+    for i, header in enumerate(header_texts):
+        header_text = header.lower()
+        if "symbol" in header_text:
+            column_indices["symbol"] = i
+        elif "date/time" in header_text:
+            column_indices["date_time"] = i
+        elif "quantity" in header_text:
+            column_indices["quantity"] = i
+        elif "proceeds" in header_text:
+            column_indices["proceeds"] = i
+        elif "comm/fee" in header_text:
+            column_indices["comm_fee"] = i
+        elif "basis" in header_text:
+            column_indices["basis"] = i
+        elif "account" in header_text:
+            column_indices["account"] = i
+        if all(key in column_indices for key in ["symbol", "date_time", "quantity", "proceeds", "comm_fee", "basis"]):
+            break
+    
+    # Jeśli nie znaleziono nagłówków, używamy domyślnego układu
+    if not column_indices:
+        # Domyślny układ (z pierwszego formatu)
+        column_indices = {
+            "symbol": 0,
+            "date_time": 1,
+            "quantity": 2,
+            "proceeds": 5,
+            "comm_fee": 6,
+            "basis": 7
+        }
+    return column_indices
+
+
+def parse_trade_row(cells: list, column_indices: dict, current_currency):
+    """
+    Zamienia teksty komórek jednego wiersza tabeli na słownik z danymi transakcji.
+    Zwraca None dla wierszy, które nie są transakcjami (za mało kolumn, wiersze "Total").
+    """
+    # Sprawdź, czy wiersz zawiera dane transakcji (musi mieć wystarczająco kolumn)
+    if len(cells) < 8:
+        return None
+    
+    # Obsługa przypadku, gdy pierwsza kolumna to "Account"
+    if "account" in column_indices:
+        # Jeśli mamy wykrytą kolumnę account, używamy ją jako wskaźnik
+        account_idx = column_indices.get("account", 0)
+        symbol_idx = account_idx + 1  # Symbol jest następną kolumną po Account
+        date_time_idx = account_idx + 2
+        quantity_idx = account_idx + 3
+        # Pozostałe indeksy dostosowujemy według układu
+        proceeds_idx = account_idx + 6  # Zakładamy, że Proceeds jest 6 kolumn po Account
+        comm_fee_idx = account_idx + 7
+        basis_idx = account_idx + 8
+    else:
+        # Pobierz dane z komórek zgodnie z wykrytymi indeksami kolumn
+        symbol_idx = column_indices.get("symbol", 0)
+        date_time_idx = column_indices.get("date_time", 1)
+        quantity_idx = column_indices.get("quantity", 2)
+        proceeds_idx = column_indices.get("proceeds", 5)
+        comm_fee_idx = column_indices.get("comm_fee", 6)
+        basis_idx = column_indices.get("basis", 7)
+    
+    # Zabezpieczenie przed wyjściem poza zakres
+    last_idx = len(cells) - 1
+    stock = cells[min(symbol_idx, last_idx)]
+    
+    # Mapuj FB na META, ponieważ to ten sam stock
+    if stock == "FB":
+        stock = "META"
+    
+    if stock.startswith("Total") or cells[0].startswith("Total"):
+        return None
+    
+    return {
+        "waluty": current_currency,
+        "Stock": stock,
+        "Date/Time": cells[min(date_time_idx, last_idx)],
+        "Quantity": cells[min(quantity_idx, last_idx)],
+        "Proceeds": cells[min(proceeds_idx, last_idx)],
+        "Comm/Fee": cells[min(comm_fee_idx, last_idx)],
+        "Basis": cells[min(basis_idx, last_idx)]
+    }
+
+
+def parse_currency_header(cells: list):
+    """
+    Wiersze z jedną komórką traktujemy jako nagłówek waluty. Zwraca kod waluty albo None.
+    """
+    if len(cells) == 1 and re.fullmatch(r"[A-Z]{3}", cells[0]):
+        return cells[0]
+    return None
+
+
+# Sekcje wyciągu zbierane w jednym przejściu: fragment identyfikatora kontenera tbl<...>_*Body -> nazwa sekcji
+STATEMENT_SECTIONS = {"Transactions": "trades", "Dividends": "dividends", "WithholdingTax": "withholding_tax",
+                      "Interest": "interest"}
+# Sekcje z operacjami pieniężnymi (data, opis, kwota) i ich nazwy na stronie wyników
+CASH_SECTIONS = {"dividends": "Dywidendy", "withholding_tax": "Podatek u źródła", "interest": "Odsetki"}
+CASH_COLUMNS = ["waluty", "Date", "Description", "Symbol", "Amount"]
+
+
+def detect_cash_column_indices(header_texts: list) -> dict:
+    """
+    Indeksy kolumn Date, Description i Amount tabeli sekcji pieniężnej (dywidendy, podatek u źródła,
+    odsetki). Bez nagłówków – układ z wyciągów IBKR (Date, Description, Amount).
+    """
+    column_indices = {}
+    for i, header in enumerate(header_texts):
+        header_text = header.lower()
+        for key in ("date", "description", "amount"):
+            if header_text.startswith(key) and key not in column_indices:
+                column_indices[key] = i
+    return column_indices or {"date": 0, "description": 1, "amount": 2}
+
+
+def parse_cash_row(cells: list, column_indices: dict, current_currency):
+    """
+    Zamienia teksty komórek wiersza sekcji pieniężnej na słownik (waluta, data, opis, symbol z opisu, kwota).
+    Zwraca None dla wierszy, które nie są operacjami (wiersze "Total", za mało kolumn).
+    """
+    last_idx = len(cells) - 1
+    if last_idx < max(column_indices.values()) or cells[0].startswith("Total"):
+        return None
+    description = cells[column_indices["description"]]
+    # Opis dywidendy i podatku zaczyna się od symbolu: "AAPL(US0378331005) Cash Dividend ..."
+    symbol = re.match(r"^([A-Za-z0-9.\- ]+?)\s*\(", description)
+    symbol = symbol.group(1) if symbol else ""
+    if symbol == "FB":
+        symbol = "META"
+    return {
+        "waluty": current_currency,
+        "Date": cells[column_indices["date"]],
+        "Description": description,
+        "Symbol": symbol,
+        "Amount": cells[column_indices["amount"]]
+    }
+
+
+def parse_section_row(section: str, cells: list, column_indices: dict, current_currency):
+    """
+    Parsuje wiersz tabeli sekcji (parse_trade_row dla transakcji, parse_cash_row dla pozostałych).
+    """
+    if section in CASH_SECTIONS:
+        return parse_cash_row(cells, column_indices, current_currency)
+    return parse_trade_row(cells, column_indices, current_currency)
+
+
+def statement_frames(rows: dict) -> dict:
+    """
+    Składa wiersze sekcji ({sekcja: lista słowników}) w osobne DataFrame dla każdej sekcji.
+    """
+    frames = {"trades": pd.DataFrame(rows.get("trades", []))}
+    for section in CASH_SECTIONS:
+        frames[section] = pd.DataFrame(rows.get(section, []), columns=CASH_COLUMNS + ["source_line"])
+    return frames
+
+
+def parse_html_statement(html_content, engine: str = None) -> dict:
+    """
+    Parsuje HTML w jednym przejściu i zwraca słownik DataFrame dla sekcji wyciągu: trades
+    (transakcje, jak parse_html_transactions) oraz dividends, withholding_tax i interest
+    (kolumny CASH_COLUMNS jako tekst).
+    
+    html_content może być tekstem, bajtami albo plikiem otwartym w trybie binarnym.
+    Silnik wybiera ustawienie PARSER_ENGINE: "stream" (strumieniowy, domyślny) albo "bs4"
+    (pełne drzewo BeautifulSoup). Silnik "bs4" jest też używany awaryjnie, gdy parser
+    strumieniowy zgłosi nieoczekiwany błąd.
+    """
+    engine = engine or app.config["PARSER_ENGINE"]
+    if engine == "stream":
+        # Pozycja w pliku, żeby w razie błędu móc powtórzyć parsowanie silnikiem bs4
+        start = None if isinstance(html_content, (str, bytes)) else html_content.tell()
+        try:
+            return parse_html_statement_stream(html_content)
+        except ValueError:
+            raise
+        except Exception as e:
+            print(f"Błąd parsera strumieniowego, używam BeautifulSoup: {e}")
+            if start is not None:
+                html_content.seek(start)
+    return parse_html_statement_bs4(html_content)
+
+
+def parse_html_transactions(html_content, engine: str = None) -> pd.DataFrame:
+    """
+    Parsuje HTML i zwraca DataFrame z danymi transakcji (sekcja trades z parse_html_statement).
+    Obsługuje różne formaty tabel poprzez wykrywanie nagłówków.
+    """
+    return parse_html_statement(html_content, engine)["trades"]
+
+
+def parse_html_statement_bs4(html_content) -> dict:
+    """
+    Parsuje HTML budując pełne drzewo BeautifulSoup i zwraca DataFrame sekcji wyciągu (jak parse_html_statement).
+    """
+    if not isinstance(html_content, (str, bytes)):
+        html_content = html_content.read()
+    if isinstance(html_content, bytes):
+        html_content = html_content.decode("utf-8")
+    
+    soup = BeautifulSoup(html_content, "html.parser")
+    tables = {}
+    for container in soup.find_all(lambda tag: tag.name == "div" and tag.get("id")
+                                   and TradesTableStreamParser.CONTAINER_ID.search(tag.get("id"))):
+        section = STATEMENT_SECTIONS[TradesTableStreamParser.CONTAINER_ID.search(container.get("id")).group(1)]
+        if section not in tables:
+            tables[section] = container.find("table")
+    
+    # Jeśli nie znaleziono standardowego kontenera, szukamy alternatywnych struktur
+    if "trades" not in tables:
+        if not tables:
+            # Szukaj tabeli w całym dokumencie
+            trades_table = soup.find("table", {"class": "table-bordered"})
+            if trades_table is None:
+                raise ValueError("Nie znaleziono tabeli z transakcjami")
+            tables["trades"] = trades_table
+    elif tables["trades"] is None:
+        raise ValueError("Nie znaleziono tabeli z transakcjami")
+
+    rows = {}
+    for section, table in tables.items():
+        if table is None:
+            continue
+        # Znajdź nagłówki kolumn, aby określić ich indeksy
+        headers = [header.get_text(strip=True) for header in table.find_all("th")]
+        column_indices = (detect_cash_column_indices(headers) if section in CASH_SECTIONS
+                          else detect_column_indices(headers))
+        data = rows.setdefault(section, [])
+        current_currency = None
+        
+        for tr in table.find_all("tr"):
+            cells = [td.get_text(strip=True) for td in tr.find_all("td")]
+            
+            if len(cells) == 1:
+                current_currency = parse_currency_header(cells) or current_currency
+                continue
+            
+            try:
+                row = parse_section_row(section, cells, column_indices, current_currency)
+            except Exception as e:
+                # Logowanie błędu do konsoli - możesz zakomentować lub usunąć w produkcji
+                print(f"Błąd przetwarzania wiersza: {e}")
+                continue
+            if row is not None:
+                row["source_line"] = tr.sourceline  # Do komunikatów o wierszach, których nie da się odczytać
+                data.append(row)
+    
+    return statement_frames(rows)
+
+
+class TradesTableStreamParser(HTMLParser):
+    """
+    Strumieniowy (zdarzeniowy) parser tabel wyciągu. Nie buduje drzewa dokumentu –
+    zbiera jedynie teksty komórek pierwszej tabeli z każdego kontenera sekcji tbl<sekcja>_*Body
+    (STATEMENT_SECTIONS) i oddaje gotowe wiersze w miarę czytania (atrybut rows, opróżniany
+    przez wywołującego).
+    
+    Jeśli dokument nie zawiera żadnego kontenera sekcji, jako tabela transakcji używana jest pierwsza
+    tabela z klasą table-bordered – jej wiersze są buforowane do końca dokumentu.
+    """
+
+    CONTAINER_ID = re.compile(r"^tbl(Transactions|Dividends|WithholdingTax|Interest)_.*Body$")
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        # Wiersze z tabel w kontenerach: (sekcja, teksty komórek, indeksy kolumn, numer wiersza pliku)
+        self.rows = []
+        self.fallback_rows = []  # Wiersze z pierwszej tabeli table-bordered
+        self.container_found = False  # Czy znaleziono kontener transakcji
+        self.sections_found = set()
+        self.tables_found = set()  # Sekcje, w których znaleziono tabelę
+        self._div_depth = 0
+        self._container_div_depth = None
+        self._section = None  # Sekcja kontenera, w którym jesteśmy
+        self._tables = []  # Stos otwartych tabel: sekcja, "fallback" albo None
+        self._active = None  # Najbliższa otwarta tabela, z której zbieramy wiersze
+        self._fallback_used = False
+        self._headers = {}
+        self._column_indices = {}
+        self._row = None
+        self._row_line = None
+        self._cell = None
+        self._cell_is_header = False
+
+    def _update_active(self):
+        self._active = next((table for table in reversed(self._tables) if table is not None), None)
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "div":
+            self._div_depth += 1
+            div_id = dict(attrs).get("id")
+            match = div_id and self._section is None and self.CONTAINER_ID.search(div_id)
+            if match and STATEMENT_SECTIONS[match.group(1)] not in self.sections_found:
+                self._section = STATEMENT_SECTIONS[match.group(1)]
+                self.sections_found.add(self._section)
+                self._container_div_depth = self._div_depth
+                if self._section == "trades":
+                    self.container_found = True
+                    # Znaleziono właściwy kontener – tabela zastępcza nie będzie potrzebna
+                    self.fallback_rows = []
+        elif tag == "table":
+            kind = None
+            if self._container_div_depth is not None and self._section not in self.tables_found:
+                kind = self._section
+                self.tables_found.add(kind)
+            elif self._section is None and not self.container_found and not self._fallback_used:
+                classes = (dict(attrs).get("class") or "").split()
+                if "table-bordered" in classes:
+                    kind = "fallback"
+                    self._fallback_used = True
+            self._tables.append(kind)
+            self._update_active()
+        elif self._active is not None:
+            if tag == "tr":
+                self._row = []
+                self._row_line = self.getpos()[0]
+            elif tag in ("td", "th"):
+                self._close_cell()
+                self._cell = []
+                self._cell_is_header = tag == "th"
+
+    def handle_endtag(self, tag):
+        if tag == "div":
+            if self._container_div_depth == self._div_depth:
+                self._container_div_depth = None
+                self._section = None
+            self._div_depth -= 1
+        elif tag == "table":
+            self._close_cell()
+            self._close_row()
+            if self._tables:
+                self._tables.pop()
+                self._update_active()
+        elif self._active is not None:
+            if tag in ("td", "th"):
+                self._close_cell()
+            elif tag == "tr":
+                self._close_cell()
+                self._close_row()
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            text = data.strip()
+            if text:
+                self._cell.append(text)
+
+    def _close_cell(self):
+        if self._cell is None:
+            return
+        text = "".join(self._cell)
+        table = self._active
+        if self._cell_is_header:
+            self._headers.setdefault(table, []).append(text)
+            self._column_indices[table] = None
+        elif self._row is not None:
+            self._row.append(text)
+        self._cell = None
+
+    def _close_row(self):
+        if self._row is None:
+            return
+        table = self._active
+        if self._column_indices.get(table) is None:
+            headers = self._headers.get(table, [])
+            self._column_indices[table] = (detect_cash_column_indices(headers) if table in CASH_SECTIONS
+                                           else detect_column_indices(headers))
+        if table == "fallback":
+            self.fallback_rows.append(("trades", self._row, self._column_indices[table], self._row_line))
+        else:
+            self.rows.append((table, self._row, self._column_indices[table], self._row_line))
+        self._row = None
+
+
+def iter_html_statement_stream(chunks):
+    """
+    Generator zwracający pary (sekcja, słownik wiersza) w miarę czytania kolejnych fragmentów HTML.
+    chunks to iterowalny zbiór fragmentów tekstu lub bajtów (dekodowanych jako UTF-8).
+    """
+    parser = TradesTableStreamParser()
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    currencies = {}  # Bieżąca waluta (z wiersza nagłówka) w każdej sekcji
+
+    def consume(rows):
+        for section, cells, column_indices, line in rows:
+            if len(cells) == 1:
+                currencies[section] = parse_currency_header(cells) or currencies.get(section)
+                continue
+            try:
+                row = parse_section_row(section, cells, column_indices, currencies.get(section))
+            except Exception as e:
+                print(f"Błąd przetwarzania wiersza: {e}")
+                continue
+            if row is not None:
+                row["source_line"] = line
+                yield section, row
+
+    for chunk in chunks:
+        if isinstance(chunk, bytes):
+            chunk = decoder.decode(chunk)
+        parser.feed(chunk)
+        rows, parser.rows = parser.rows, []
+        yield from consume(rows)
+    parser.feed(decoder.decode(b"", final=True))
+    parser.close()
+    yield from consume(parser.rows)
+
+    if parser.container_found:
+        if "trades" not in parser.tables_found:
+            raise ValueError("Nie znaleziono tabeli z transakcjami")
+    elif not parser.sections_found:
+        # Bez żadnej sekcji wyciągu – transakcje z tabeli zastępczej
+        if not parser._fallback_used:
+            raise ValueError("Nie znaleziono tabeli z transakcjami")
+        yield from consume(parser.fallback_rows)
+
+
+def iter_html_transactions_stream(chunks):
+    """
+    Generator zwracający słowniki transakcji (sekcja trades) w miarę czytania kolejnych fragmentów HTML.
+    """
+    for section, row in iter_html_statement_stream(chunks):
+        if section == "trades":
+            yield row
+
+
+def parse_html_statement_stream(html_content, chunk_size: int = 1 << 20) -> dict:
+    """
+    Parsuje HTML strumieniowo (bez budowania drzewa dokumentu) i zwraca DataFrame sekcji wyciągu
+    (jak parse_html_statement). html_content może być tekstem, bajtami albo plikiem otwartym w trybie binarnym.
+    """
+    if isinstance(html_content, (str, bytes)):
+        chunks = (html_content[i:i + chunk_size] for i in range(0, len(html_content), chunk_size))
+    else:
+        chunks = iter(lambda: html_content.read(chunk_size), b"")
+    rows = {}
+    for section, row in iter_html_statement_stream(chunks):
+        rows.setdefault(section, []).append(row)
+    return statement_frames(rows)
+
+
+def get_parse_pool() -> ProcessPoolExecutor:
+    """
+    Zwraca (tworząc przy pierwszym użyciu) pulę procesów do równoległego parsowania wyciągów.
+    """
+    global _parse_pool
+    if _parse_pool is None:
+        # Pula powstaje w wątku zadania wgrywania, w procesie z wieloma wątkami (gunicorn,
+        # połączenia SQLite) – procesy potomne startują z serwera forkserver (albo spawn),
+        # a nie przez fork tego procesu
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _parse_pool = ProcessPoolExecutor(max_workers=app.config["PARSE_WORKERS"],
+                                          mp_context=multiprocessing.get_context(method))
+    return _parse_pool
+
+
+def parse_statement_file(path: str, engine: str) -> tuple:
+    """
+    Parsuje wyciąg zapisany w pliku (puli procesów przekazywana jest ścieżka, nie treść pliku)
+    i ujednolica jego kolumny (normalize_statement, normalize_cash). Zwraca (DataFrame transakcji,
+    DataFrame operacji pieniężnych wszystkich sekcji CASH_SECTIONS, komunikaty o wierszach).
+    """
+    with open(path, "rb") as f:
+        frames = parse_html_statement(f, engine)
+    df_trades, issues = normalize_statement(frames["trades"])
+    df_cash, cash_issues = normalize_cash(pd.concat(
+        [frames[section].assign(section=section) for section in CASH_SECTIONS], ignore_index=True
+    ))
+    return df_trades, df_cash, issues + cash_issues
+
+
+def iter_parsed_statements(paths: list):
+    """
+    Parsuje zapisane wyciągi i zwraca pary (numer pliku, wynik parse_statement_file albo ValueError
+    dla niepoprawnego pliku) w kolejności ukończenia. Przy PARSE_WORKERS > 1 pliki są parsowane w puli procesów,
+    a gdy pula przestanie działać – pozostałe pliki w bieżącym procesie.
+    """
+    global _parse_pool
+    engine = app.config["PARSER_ENGINE"]
+    pending = set(range(len(paths)))
+    if app.config["PARSE_WORKERS"] > 1:
+        try:
+            futures = {get_parse_pool().submit(parse_statement_file, paths[index], engine): index
+                       for index in sorted(pending)}
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except ValueError as e:
+                    result = e
+                pending.discard(futures[future])
+                yield futures[future], result
+        except BrokenProcessPool as e:
+            # Proces potomny padł (np. brak pamięci) – parsujemy w bieżącym procesie
+            print(f"Pula procesów parsowania nie działa, parsuję sekwencyjnie: {e}")
+            _parse_pool = None
+    for index in sorted(pending):
+        try:
+            result = parse_statement_file(paths[index], engine)
+        except ValueError as e:
+            result = e
+        yield index, result
+
+
+def get_upload_executor() -> ThreadPoolExecutor:
+    """
+    Zwraca (tworząc przy pierwszym użyciu) pulę wątków przetwarzających zadania wgrywania.
+    """
+    global _upload_executor
+    if _upload_executor is None:
+        _upload_executor = ThreadPoolExecutor(max_workers=app.config["UPLOAD_WORKERS"],
+                                              thread_name_prefix="upload")
+    return _upload_executor
+
+
+def enqueue_upload(portfolio: "Portfolio", files: list) -> str:
+    """
+    Zapisuje wgrane pliki w katalogu UPLOADS_DIR i zleca ich przetworzenie w tle (run_upload_job).
+    Zwraca identyfikator zadania, którego postęp podaje trasa upload_status.
+    """
+    directory = app.config["UPLOADS_DIR"]
+    os.makedirs(directory, exist_ok=True)
+    job_id = secrets.token_urlsafe(12)
+    paths = []
+    for i, file in enumerate(files):
+        paths.append(os.path.join(directory, f"{job_id}-{i}.html"))
+        file.save(paths[-1])
+    trade_store.create_upload_job(job_id, portfolio.id, len(files))
+    get_upload_executor().submit(run_upload_job, job_id, portfolio.id, paths, [file.filename for file in files])
+    return job_id
+
+
+def run_upload_job(job_id: str, portfolio_id: str, paths: list, names: list):
+    """
+    Przetwarza zadanie wgrywania: parsuje pliki, zapisując postęp (pliki, wiersze, błędy) we wspólnym
+    magazynie, a na końcu dodaje transakcje do portfela w kolejności wgrania plików.
+    Jeśli choć jeden plik jest niepoprawny, żadna transakcja nie jest dodawana. Wiersze transakcji
+    z nieczytelną datą lub liczbą nie przerywają zadania – są zgłaszane w errors z numerem wiersza pliku.
+    """
+    frames = [None] * len(paths)
+    errors = []
+    row_issues = []
+    rows = 0
+    try:
+        trade_store.update_upload_job(job_id, state="running")
+        with measure("upload_parse"):
+            for done, (index, result) in enumerate(iter_parsed_statements(paths), 1):
+                if isinstance(result, Exception):
+                    errors.append(f"{names[index]}: {result}")
+                else:
+                    trades, cash, issues = result
+                    frames[index] = (trades, cash)
+                    row_issues.extend(f"{names[index]}, {issue}" for issue in issues)
+                    rows += len(trades) + len(cash)
+                trade_store.update_upload_job(job_id, files_done=done, rows_parsed=rows, errors=errors + row_issues)
+        if errors:
+            trade_store.update_upload_job(job_id, state="failed")
+            return
+        
+        df_all = pd.concat([trades for trades, _ in frames], ignore_index=True)
+        df_cash = pd.concat([cash for _, cash in frames], ignore_index=True)
+        metrics.observe("rozliczenie_stage_rows", len(df_all), stage="upload")
+        metrics.set("rozliczenie_dataframe_bytes", df_all.memory_usage(deep=True).sum(), frame="upload")
+        # Magazyn nadaje unikalne identyfikatory w kolejności wgrania
+        if not df_all.empty or not df_cash.empty:
+            with measure("upload_store"):
+                trade_store.insert(portfolio_id, df_all, df_cash)
+        trade_store.update_upload_job(job_id, state="done")
+    except Exception as e:
+        print(f"Błąd zadania wgrywania {job_id}: {e}")
+        trade_store.update_upload_job(job_id, state="failed",
+                                      errors=errors + row_issues + [f"Błąd przetwarzania: {e}"])
+    finally:
+        for path in paths:
+            os.remove(path)
+
+
+# Kwoty w trybie stałoprzecinkowym (MONEY_MODE=fixed): int64 w jednostkach drobnych (grosze, centy),
+# kursy w 1/10000, ilości przy proporcjach FIFO w 1/10000 akcji
+MONEY_SCALE = 100
+RATE_SCALE = 10000
+QUANTITY_SCALE = 10000
+MONEY_COLUMNS = ["Proceeds", "Comm/Fee", "Basis"]
+
+
+def round_half_away(values: np.ndarray) -> np.ndarray:
+    """
+    Zaokrągla liczby zmiennoprzecinkowe do całkowitych, połówki od zera. Wartości różniące się od
+    połówki o mniej niż 1e-6 (np. 100.4999999 z zapisu "1.005") są traktowane jak połówki.
+    """
+    magnitude = np.abs(values)
+    floor = np.floor(magnitude)
+    tie = np.abs(magnitude - floor - 0.5) < 1e-6
+    return np.copysign(np.where(tie, floor + 1, np.rint(magnitude)), values)
+
+
+def to_minor_units(values: pd.Series) -> pd.Series:
+    """
+    Zamienia kwoty (float lub tekst) na int64 w jednostkach drobnych (pd.Int64, braki jako NA),
+    zaokrąglając do pełnych groszy połówkami od zera.
+    """
+    amounts = pd.to_numeric(values, errors="coerce").to_numpy(dtype=float)
+    missing = np.isnan(amounts)
+    minor = round_half_away(np.where(missing, 0.0, amounts) * MONEY_SCALE).astype(np.int64)
+    return pd.Series(pd.arrays.IntegerArray(minor, missing), index=values.index)
+
+
+def div_round(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    """
+    Dzielenie całkowite z zaokrągleniem połówek od zera (denominator > 0).
+    """
+    quotient, remainder = np.divmod(np.abs(numerator), denominator)
+    quotient += 2 * remainder >= denominator
+    return np.where(numerator < 0, -quotient, quotient)
+
+
+def scale_money(values: np.ndarray, numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    """
+    Liczy values * numerator / denominator na liczbach całkowitych, z zaokrągleniem połówek od zera.
+    Argumenty są rozgłaszane (broadcasting) jak w NumPy. Elementy, których iloczyn nie mieści się
+    w int64, są liczone na liczbach całkowitych Pythona.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    numerator = np.asarray(numerator, dtype=np.int64)
+    limit = np.iinfo(np.int64).max // np.maximum(np.abs(numerator), 1)
+    safe = np.abs(values) <= limit
+    if safe.all():
+        return div_round(values * numerator, denominator)
+    values, numerator, denominator, safe = np.broadcast_arrays(values, numerator, denominator, safe)
+    result = np.empty(values.shape, dtype=np.int64)
+    result[safe] = div_round(values[safe] * numerator[safe], denominator[safe])
+    for index in zip(*np.nonzero(~safe)):
+        product = int(values[index]) * int(numerator[index])
+        divisor = int(denominator[index])
+        quotient, remainder = divmod(abs(product), divisor)
+        quotient += 2 * remainder >= divisor
+        result[index] = quotient if product >= 0 else -quotient
+    return result
+
+
+def money_arrays(df: pd.DataFrame, columns: list) -> tuple:
+    """
+    Zwraca kolumny kwot stałoprzecinkowych jako macierz int64 (braki jako 0) i macierz braków.
+    """
+    values = np.column_stack([df[col].to_numpy(dtype=np.int64, na_value=0) for col in columns])
+    missing = np.column_stack([df[col].isna().to_numpy() for col in columns])
+    return values.reshape(len(df), len(columns)), missing.reshape(len(df), len(columns))
+
+
+def is_fixed_point(df: pd.DataFrame) -> bool:
+    """
+    Sprawdza, czy kwoty w DataFrame są w reprezentacji stałoprzecinkowej (pd.Int64).
+    """
+    return "Proceeds" in df.columns and isinstance(df["Proceeds"].dtype, pd.Int64Dtype)
+
+
+def money_to_float(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Zamienia kolumny kwot stałoprzecinkowych (pd.Int64) na float w jednostkach waluty (braki jako NaN)
+    – do wyświetlania i eksportu. DataFrame bez takich kolumn jest zwracany bez zmian.
+    """
+    columns = [col for col in df.columns if isinstance(df[col].dtype, pd.Int64Dtype)]
+    if not columns:
+        return df
+    df = df.copy()
+    for col in columns:
+        df[col] = df[col].to_numpy(dtype=float, na_value=np.nan) / MONEY_SCALE
+    return df
+
+
+# Układy kolumny Date/Time w wyciągach IBKR, sprawdzane w tej kolejności. Pierwszy to układ,
+# w którym daty są zapisywane w magazynie transakcji.
+DATE_TIME_FORMATS = ["%Y-%m-%d, %H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d, %H:%M", "%Y-%m-%d %H:%M",
+                     "%Y-%m-%d", "%Y%m%d;%H%M%S", "%m/%d/%Y, %H:%M:%S"]
+# Ile różnych wartości sprawdzać przy rozpoznawaniu układu dat
+DATE_FORMAT_SAMPLE = 50
+
+
+def detect_date_format(values: pd.Series):
+    """
+    Rozpoznaje układ dat z DATE_TIME_FORMATS na próbce różnych niepustych wartości: zwraca
+    pierwszy układ pasujący do całej próbki, a jeśli żaden – ten, który pasuje do największej liczby
+    wartości. None, gdy nie pasuje żaden.
+    """
+    sample = pd.Series(values.dropna().unique()[:DATE_FORMAT_SAMPLE], dtype=object)
+    sample = sample[sample != ""]
+    best, best_count = None, 0
+    for date_format in DATE_TIME_FORMATS:
+        count = pd.to_datetime(sample, format=date_format, errors="coerce").notna().sum()
+        if count == len(sample):
+            return date_format
+        if count > best_count:
+            best, best_count = date_format, count
+    return best
+
+
+def parse_date_times(values: pd.Series, date_format: str = None) -> pd.Series:
+    """
+    Parsuje kolumnę dat z jawnym układem (podanym albo rozpoznanym przez detect_date_format).
+    Każda różna wartość jest parsowana raz (powtarzające się znaczniki czasu z jednego zlecenia
+    parsują się jednorazowo). Wartości niepasujące do układu próbują kolejnych układów
+    z DATE_TIME_FORMATS; nieczytelne dają NaT.
+    """
+    codes, uniques = pd.factorize(values)
+    uniques = pd.Series(uniques, dtype=object)
+    date_format = date_format or detect_date_format(uniques)
+    parsed = pd.Series(pd.NaT, index=uniques.index, dtype="datetime64[ns]")
+    for i, candidate in enumerate(([date_format] if date_format else []) + DATE_TIME_FORMATS):
+        missing = parsed.isna() & (uniques != "")
+        if not missing.any():
+            break
+        # Wykryty układ dostaje wartości bez zmian, kolejne – tylko nieodczytane, bez białych znaków
+        text = uniques[missing] if i == 0 and date_format else uniques[missing].str.strip()
+        if ", " in candidate:
+            # Układ IBKR "RRRR-MM-DD, GG:MM:SS" bez przecinka to układ ISO, parsowany szybką ścieżką pandas
+            text = text.str.replace(", ", " ", n=1, regex=False)
+            candidate = candidate.replace(", ", " ", 1)
+        parsed[missing] = pd.to_datetime(text, format=candidate, errors="coerce")
+    result = parsed.to_numpy()[codes]
+    result[codes < 0] = np.datetime64("NaT")
+    return pd.Series(result, index=values.index)
+
+
+def parse_numbers(values: pd.Series) -> pd.Series:
+    """
+    Zamienia kolumnę liczb w zapisie wyciągów (separator tysięcy ",") na float; każda różna
+    wartość jest zamieniana raz. Nieczytelne wartości dają NaN.
+    """
+    codes, uniques = pd.factorize(values)
+    uniques = pd.Series(uniques, dtype=object)
+    numbers = pd.to_numeric(uniques, errors="coerce").to_numpy(dtype=float, copy=True)
+    # Separatory tysięcy usuwamy tylko z wartości, których nie udało się odczytać wprost
+    retry = np.isnan(numbers) & uniques.notna().to_numpy()
+    if retry.any():
+        numbers[retry] = pd.to_numeric(uniques[retry].str.replace(",", "", regex=False).str.strip(), errors="coerce")
+    result = numbers[codes]
+    result[codes < 0] = np.nan
+    return pd.Series(result, index=values.index)
+
+
+def trade_rows_mask(df_trades: pd.DataFrame) -> pd.Series:
+    """
+    Wiersze będące transakcjami – bez wierszy sum ("Total" bez ilości) i wierszy bez Basis.
+    """
+    totals = (df_trades["Quantity"].str.strip() == "").to_numpy(copy=True)
+    # Nazwy symboli sprawdzamy tylko w wierszach bez ilości
+    totals[totals] = df_trades["Stock"][totals].str.contains("total", case=False, regex=False).to_numpy(dtype=bool)
+    return (df_trades["Basis"].str.strip() != "") & ~totals
+
+
+# Ile komunikatów o nieczytelnych wierszach zgłaszać z jednego pliku
+ROW_ISSUES_LIMIT = 20
+
+
+def normalize_statement(df_trades: pd.DataFrame) -> tuple:
+    """
+    Ujednolica kolumny wyciągu raz, przy wgrywaniu: rozpoznaje układ dat pliku i zapisuje daty
+    w układzie DATE_TIME_FORMATS[0], a liczby bez separatorów tysięcy. Wartości, których nie da się
+    odczytać, zostają bez zmian.
+    Zwraca (DataFrame bez kolumny source_line, komunikaty o wierszach transakcji z nieczytelną datą
+    lub liczbą – z numerem wiersza pliku HTML).
+    """
+    if df_trades.empty:
+        return df_trades.drop(columns="source_line", errors="ignore"), []
+    trades = trade_rows_mask(df_trades)
+    lines = df_trades["source_line"] if "source_line" in df_trades.columns else pd.Series(None, index=df_trades.index)
+    issues = []
+
+    def report(mask: pd.Series, description: str, values: pd.Series):
+        for line, value in zip(lines[mask], values[mask]):
+            issues.append(f"wiersz {line}: {description} {value!r}")
+
+    dates = parse_date_times(df_trades["Date/Time"])
+    report(trades & dates.isna(), "nieprawidłowa data", df_trades["Date/Time"])
+    df_trades["Date/Time"] = dates.dt.strftime(DATE_TIME_FORMATS[0]).where(dates.notna(), df_trades["Date/Time"])
+    for col in ["Quantity", "Proceeds", "Comm/Fee", "Basis"]:
+        text = df_trades[col].str.strip()
+        unreadable = trades & parse_numbers(text).isna() & (text != "")
+        report(unreadable, f"nieprawidłowa liczba w kolumnie {col}", df_trades[col])
+        df_trades[col] = text.str.replace(",", "", regex=False).where(~unreadable, df_trades[col])
+
+    if len(issues) > ROW_ISSUES_LIMIT:
+        issues = issues[:ROW_ISSUES_LIMIT] + [f"… oraz {len(issues) - ROW_ISSUES_LIMIT} innych wierszy"]
+    return df_trades.drop(columns="source_line", errors="ignore"), issues
+
+
+# Układ dat operacji pieniężnych w magazynie (dywidendy, podatek u źródła i odsetki mają datę bez godziny)
+CASH_DATE_FORMAT = "%Y-%m-%d"
+
+
+def normalize_cash(df_cash: pd.DataFrame) -> tuple:
+    """
+    Ujednolica operacje pieniężne wyciągu (jak normalize_statement): daty w układzie CASH_DATE_FORMAT,
+    kwoty bez separatorów tysięcy. Wiersze bez daty i kwoty (np. podsumowania) są pomijane.
+    Zwraca (DataFrame bez kolumny source_line, komunikaty o wierszach z nieczytelną datą lub kwotą).
+    """
+    df_cash = df_cash[(df_cash["Date"].str.strip() != "") | (df_cash["Amount"].str.strip() != "")]
+    if df_cash.empty:
+        return df_cash.drop(columns="source_line"), []
+    df_cash = df_cash.copy()
+    issues = []
+
+    dates = parse_date_times(df_cash["Date"])
+    amounts = df_cash["Amount"].str.strip()
+    unreadable_amounts = parse_numbers(amounts).isna()
+    for line, value in zip(df_cash["source_line"][dates.isna()], df_cash["Date"][dates.isna()]):
+        issues.append(f"wiersz {line}: nieprawidłowa data {value!r}")
+    for line, value in zip(df_cash["source_line"][unreadable_amounts], df_cash["Amount"][unreadable_amounts]):
+        issues.append(f"wiersz {line}: nieprawidłowa kwota {value!r}")
+    df_cash["Date"] = dates.dt.strftime(CASH_DATE_FORMAT).where(dates.notna(), df_cash["Date"])
+    df_cash["Amount"] = amounts.str.replace(",", "", regex=False).where(~unreadable_amounts, df_cash["Amount"])
+
+    if len(issues) > ROW_ISSUES_LIMIT:
+        issues = issues[:ROW_ISSUES_LIMIT] + [f"… oraz {len(issues) - ROW_ISSUES_LIMIT} innych wierszy"]
+    return df_cash.drop(columns="source_line"), issues
+
+
+def filter_and_convert_transactions(df_trades: pd.DataFrame, money_mode: str = None) -> pd.DataFrame:
+    """
+    Filtrowanie wierszy oraz konwersja kolumn liczbowych i dat.
+    W trybie "fixed" (domyślnie ustawienie MONEY_MODE) kwoty trafiają do kolumn pd.Int64
+    w jednostkach drobnych (to_minor_units), ilości pozostają liczbami zmiennoprzecinkowymi.
+    """
+    money_mode = money_mode or app.config["MONEY_MODE"]
+    df_trades = df_trades[trade_rows_mask(df_trades)]
+
+    for col in ["Quantity", "Proceeds", "Comm/Fee", "Basis"]:
+        df_trades[col] = parse_numbers(df_trades[col])
+        if money_mode == "fixed" and col in MONEY_COLUMNS:
+            df_trades[col] = to_minor_units(df_trades[col])
+    # Daty w magazynie mają układ DATE_TIME_FORMATS[0] (normalize_statement, API, formularz)
+    df_trades["Date/Time"] = parse_date_times(df_trades["Date/Time"], DATE_TIME_FORMATS[0])
+    return df_trades
+
+
+def load_exchange_rates(csv_path: str) -> pd.DataFrame:
+    """
+    Ładuje kursy walut z pliku CSV i formatuje daty.
+    Dane pochodzą z magazynu kursów trzymanego w pamięci (get_exchange_rates).
+    """
+    return get_exchange_rates(csv_path).to_frame()
+
+
+class ExchangeRateStore:
+    """
+    Kursy walut trzymane w pamięci jako posortowane tablice NumPy: daty jako liczba dni
+    od 1970-01-01 (int64) oraz macierz kursów z jedną kolumną na walutę.
+    
+    Kolumny w formacie "N XXX" (np. "1 USD", "100 JPY") są rozpoznawane jako kurs za N jednostek
+    waluty XXX – słownik currencies mapuje kod waluty na (numer kolumny, N).
+    """
+
+    RATE_COLUMN = re.compile(r"^(\d+) ([A-Z]{3})$")
+    # Dni po ostatnim opublikowanym kursie, dla których nadal obowiązuje ostatni kurs (weekend, święta)
+    TRAILING_DAYS = 4
+
+    def __init__(self, days: np.ndarray, columns: list, rates: np.ndarray, fingerprint: str = None):
+        self.days = days
+        self.columns = columns
+        self.rates = rates
+        self.fingerprint = fingerprint
+        self._fixed_rates = None
+        self._calendar = None
+        self.currencies = {}
+        for i, col in enumerate(columns):
+            match = self.RATE_COLUMN.match(str(col))
+            if match:
+                self.currencies.setdefault(match.group(2), (i, int(match.group(1))))
+
+    @classmethod
+    def from_csv(cls, csv_path: str, fingerprint: str = None) -> "ExchangeRateStore":
+        """
+        Parsuje plik CSV z kursami (kolumna data w formacie RRRRMMDD oraz kolumny "N XXX").
+        """
+        df_kursy = pd.read_csv(csv_path, delimiter=",")
+        if "data" not in df_kursy.columns:
+            raise ValueError("Plik CSV musi zawierać kolumnę data")
+        dates = pd.to_datetime(df_kursy["data"].astype(str), format="%Y%m%d", errors="coerce")
+        df_kursy = df_kursy[dates.notna()]
+        days = dates[dates.notna()].to_numpy(dtype="datetime64[D]").astype(np.int64)
+        columns = [col for col in df_kursy.columns if col != "data"]
+        rates = df_kursy[columns].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=float)
+
+        order = np.argsort(days, kind="stable")
+        return cls(days[order], columns, rates[order], fingerprint)
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Zwraca kursy jako DataFrame w układzie pliku CSV (kolumna data jako datetime).
+        """
+        df_kursy = pd.DataFrame(self.rates, columns=self.columns)
+        df_kursy.insert(0, "data", self.days.astype("datetime64[D]").astype("datetime64[ns]"))
+        return df_kursy
+
+    def save(self, path: str):
+        """
+        Zapisuje skompilowaną tabelę kursów (daty, nazwy kolumn, macierz kursów) do pliku .npz.
+        Zapis przez plik tymczasowy – inne procesy nigdy nie widzą niepełnego pliku.
+        """
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            np.savez(f, days=self.days, columns=np.array(self.columns, dtype=str), rates=self.rates)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str, fingerprint: str = None) -> "ExchangeRateStore":
+        """
+        Wczytuje tabelę kursów zapisaną przez save() – bez parsowania CSV.
+        """
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["days"], data["columns"].tolist(), data["rates"], fingerprint)
+
+    def fixed_rates(self) -> np.ndarray:
+        """
+        Zwraca macierz kursów w 1/RATE_SCALE (int64, połówki zaokrąglane od zera; brak kursu = -1).
+        Macierz jest liczona przy pierwszym użyciu.
+        """
+        if self._fixed_rates is None:
+            missing = np.isnan(self.rates)
+            fixed = round_half_away(np.where(missing, 0.0, self.rates) * RATE_SCALE).astype(np.int64)
+            fixed[missing] = -1
+            self._fixed_rates = fixed
+        return self._fixed_rates
+
+    def covered_days(self) -> tuple:
+        """
+        Zakres dni (pierwszy, ostatni – jako liczba dni od 1970-01-01), dla których znany jest kurs
+        z poprzedniego dnia: od dnia po pierwszym kursie do TRAILING_DAYS dni po dniu ostatniego kursu.
+        """
+        return self.days[0] + 1, self.days[-1] + 1 + self.TRAILING_DAYS
+
+    def rate_calendar(self) -> np.ndarray:
+        """
+        Tablica kalendarzowa dla każdego dnia zakresu covered_days(): numer wiersza ostatniego kursu
+        opublikowanego przed tym dniem. Liczona przy pierwszym użyciu.
+        """
+        if self._calendar is None:
+            first, last = self.covered_days()
+            self._calendar = np.searchsorted(self.days, np.arange(first, last + 1) - 1, side="right") - 1
+        return self._calendar
+
+    def previous_rate_rows(self, days: np.ndarray) -> np.ndarray:
+        """
+        Dla każdego dnia zwraca indeks wiersza z ostatnim kursem opublikowanym przed tym dniem
+        (odczyt z tablicy kalendarzowej) albo -1 dla dni spoza covered_days().
+        """
+        rows = np.full(len(days), -1, dtype=np.int64)
+        if not len(self.days):
+            return rows
+        offsets = days - self.covered_days()[0]
+        calendar = self.rate_calendar()
+        inside = (offsets >= 0) & (offsets < len(calendar))
+        rows[inside] = calendar[offsets[inside]]
+        return rows
+
+
+RATES_DIGEST = re.compile(r"[0-9a-f]{64}")
+
+
+def compiled_rates_path(digest: str) -> str:
+    """
+    Ścieżka skompilowanej tabeli kursów o podanym skrócie zawartości CSV.
+    """
+    return os.path.join(app.config["RATES_DIR"], f"{digest}.npz")
+
+
+def compiled_rates_digest(path: str):
+    """
+    Zwraca skrót zawartości, jeśli ścieżka wskazuje skompilowaną tabelę kursów, w przeciwnym razie None.
+    """
+    directory, name = os.path.split(path)
+    digest = name.removesuffix(".npz")
+    if (name.endswith(".npz") and RATES_DIGEST.fullmatch(digest)
+            and os.path.abspath(directory) == os.path.abspath(app.config["RATES_DIR"])):
+        return digest
+    return None
+
+
+def load_compiled_rates(digest: str):
+    """
+    Zwraca skompilowaną tabelę kursów o podanym skrócie albo None, jeśli jeszcze jej nie ma.
+    """
+    try:
+        return ExchangeRateStore.load(compiled_rates_path(digest), digest)
+    except FileNotFoundError:
+        return None
+
+
+def compile_exchange_rates(content: bytes) -> str:
+    """
+    Sprawdza plik CSV z kursami i kompiluje go do binarnej tabeli w RATES_DIR (nazwa = skrót
+    zawartości). Identyczna zawartość wgrana ponownie korzysta z istniejącej tabeli bez parsowania.
+    Zwraca ścieżkę tabeli; nieprawidłowy plik zgłasza ValueError.
+    """
+    digest = hashlib.sha256(content).hexdigest()
+    path = compiled_rates_path(digest)
+    if os.path.exists(path):
+        return path
+    store = ExchangeRateStore.from_csv(io.BytesIO(content), digest)
+    if not store.currencies:
+        raise ValueError("Plik CSV musi zawierać kolumnę data oraz kolumny kursów w formacie \"1 XXX\" (np. 1 USD)")
+    os.makedirs(app.config["RATES_DIR"], exist_ok=True)
+    store.save(path)
+    _rate_stores[path] = store
+    return path
+
+
+def rates_file_fingerprint(csv_path: str) -> str:
+    """
+    Zwraca skrót SHA-256 zawartości pliku z kursami. Skrót jest liczony ponownie tylko wtedy,
+    gdy zmieni się czas modyfikacji lub rozmiar pliku. Skompilowane tabele są nazwane skrótem
+    zawartości i się nie zmieniają, więc ich skrót jest brany z nazwy.
+    """
+    digest = compiled_rates_digest(csv_path)
+    if digest is not None:
+        return digest
+    stat = os.stat(csv_path)
+    stat_key = (stat.st_mtime_ns, stat.st_size)
+    cached = _rates_fingerprints.get(csv_path)
+    if cached is None or cached[0] != stat_key:
+        with open(csv_path, "rb") as f:
+            cached = (stat_key, hashlib.sha256(f.read()).hexdigest())
+        _rates_fingerprints[csv_path] = cached
+    return cached[1]
+
+
+def get_exchange_rates(csv_path: str) -> ExchangeRateStore:
+    """
+    Zwraca magazyn kursów dla pliku, wczytując go tylko przy pierwszym użyciu
+    albo gdy zmieniła się zawartość pliku (czas modyfikacji lub skrót).
+    Pliki CSV są parsowane raz i kompilowane do RATES_DIR – kolejne procesy wczytują tabelę binarną.
+    """
+    fingerprint = rates_file_fingerprint(csv_path)
+    store = _rate_stores.get(csv_path)
+    if store is None or store.fingerprint != fingerprint:
+        store = load_compiled_rates(fingerprint)
+        if store is None:
+            if compiled_rates_digest(csv_path) is not None:
+                raise FileNotFoundError(csv_path)
+            store = ExchangeRateStore.from_csv(csv_path, fingerprint)
+            os.makedirs(app.config["RATES_DIR"], exist_ok=True)
+            store.save(compiled_rates_path(fingerprint))
+        _rate_stores[csv_path] = store
+    return store
+
+
+def merge_exchange_rates(df_trades: pd.DataFrame, rates: ExchangeRateStore, warnings: list = None) -> pd.DataFrame:
+    """
+    Łączy transakcje z kursami walut, wykorzystując ostatni kurs sprzed dnia transakcji
+    (odczyt z tablicy kalendarzowej magazynu kursów, bez sortowania transakcji).
+    Transakcje w walutach obcych spoza zakresu pliku kursów są zgłaszane do listy warnings
+    jako pary (stock, komunikat).
+    """
+    trade_days = df_trades["Date/Time"].to_numpy(dtype="datetime64[D]").astype(np.int64)
+    rows = rates.previous_rate_rows(trade_days)
+    found = rows >= 0
+    
+    kurs_dates = np.full(len(rows), np.datetime64("NaT"), dtype="datetime64[ns]")
+    kurs_dates[found] = rates.days[rows[found]].astype("datetime64[D]")
+    df_trades["Kurs_Date"] = kurs_dates
+    # Numer wiersza w magazynie kursów (-1 = brak kursu); kurs właściwej waluty pobiera
+    # apply_currency_conversion
+    df_trades["rate_row"] = rows
+
+    foreign = (df_trades["waluty"] != "PLN").to_numpy()
+    undated = df_trades["Date/Time"].isna().to_numpy()
+    for stock, count in df_trades.loc[undated & foreign, "Stock"].value_counts(sort=False).items():
+        message = f"{stock}: {count} transakcji bez poprawnej daty – brak kursu"
+        print(message)
+        if warnings is not None:
+            warnings.append((stock, message))
+    outside = ~found & foreign & ~undated
+    if outside.any():
+        if len(rates.days):
+            first, last = np.array(rates.covered_days()).astype("datetime64[D]")
+            covered = f"kursy obejmują dni {first} – {last}"
+        else:
+            covered = "plik kursów jest pusty"
+        for stock, count in df_trades.loc[outside, "Stock"].value_counts(sort=False).items():
+            message = f"{stock}: {count} transakcji poza zakresem pliku kursów ({covered})"
+            print(message)
+            if warnings is not None:
+                warnings.append((stock, message))
+    return df_trades.reset_index(drop=True)
+
+
+def lookup_rates(waluty: pd.Series, rows: np.ndarray, rates: ExchangeRateStore, fixed: bool = False) -> tuple:
+    """
+    Pobiera kursy walut jedną operacją na macierzy magazynu kursów: wiersz z previous_rate_rows
+    (-1 = brak kursu), kolumna waluty. PLN ma zawsze kurs 1.
+    Zwraca (kurs za jednostkę jako float – NaN bez kursu, maska walut spoza pliku kursów,
+    kurs w 1/RATE_SCALE za unit jednostek waluty – -1 bez kursu, unit); dwa ostatnie tylko dla fixed=True.
+    """
+    codes = list(rates.currencies)
+    positions = pd.Index(codes).get_indexer(waluty) if codes else np.full(len(waluty), -1)
+    columns = np.array([rates.currencies[code][0] for code in codes] + [0])
+    units = np.array([rates.currencies[code][1] for code in codes] + [1], dtype=float)
+    
+    rate = np.full(len(waluty), np.nan)
+    valid = (positions >= 0) & (rows >= 0)
+    rate[valid] = rates.rates[rows[valid], columns[positions[valid]]] / units[positions[valid]]
+    is_pln = (waluty == "PLN").to_numpy()
+    rate[is_pln] = 1.0
+    unmatched = (positions < 0) & ~is_pln
+    if not fixed:
+        return rate, unmatched, None, None
+    fixed_rate = np.full(len(waluty), -1, dtype=np.int64)
+    fixed_rate[valid] = rates.fixed_rates()[rows[valid], columns[positions[valid]]]
+    fixed_rate[is_pln] = RATE_SCALE
+    unit = np.where(is_pln, 1, units.astype(np.int64)[positions])
+    return rate, unmatched, fixed_rate, unit
+
+
+def apply_currency_conversion(df_trades: pd.DataFrame, rates: ExchangeRateStore, warnings: list = None) -> pd.DataFrame:
+    """
+    Przelicza wartości transakcji zgodnie z odpowiednim kursem waluty.
+    
+    Waluty transakcji są mapowane na numery kolumn magazynu kursów, a kursy pobierane jedną
+    operacją na macierzy (wiersz z merge_exchange_rates, kolumna waluty). Obsługiwana jest
+    każda waluta z kolumną "N XXX" w pliku kursów; PLN ma zawsze kurs 1. Transakcje w walutach
+    bez kursu są zgłaszane do listy warnings jako pary (stock, komunikat).
+    
+    Kwoty stałoprzecinkowe (is_fixed_point) są przeliczane na liczbach całkowitych: kwota × kurs
+    w 1/RATE_SCALE, podzielone przez liczbę jednostek kursu i zaokrąglone do groszy połówkami od zera.
+    """
+    waluty = df_trades["waluty"]
+    fixed = is_fixed_point(df_trades)
+    rate, unmatched, fixed_rate, unit = lookup_rates(waluty, df_trades["rate_row"].to_numpy(), rates, fixed)
+    
+    if unmatched.any():
+        unmatched_df = df_trades.loc[unmatched, ["Stock"]].assign(waluty=waluty[unmatched].fillna("(brak)"))
+        for (stock, currency), count in unmatched_df.groupby(["Stock", "waluty"]).size().items():
+            message = f"{stock}: brak kursu dla waluty {currency} w pliku kursów ({count} transakcji)"
+            print(message)
+            if warnings is not None:
+                warnings.append((stock, message))
+    
+    df_trades["rate"] = rate
+    if fixed:
+        # Kursy w 1/RATE_SCALE za units jednostek waluty; wynik zaokrąglany do groszy dla każdej transakcji
+        amounts, missing = money_arrays(df_trades, MONEY_COLUMNS)
+        converted = scale_money(amounts, np.maximum(fixed_rate, 0)[:, None], (unit * RATE_SCALE)[:, None])
+        missing |= (fixed_rate < 0)[:, None]
+        for i, col in enumerate(MONEY_COLUMNS):
+            df_trades[f"{col}_converted"] = pd.arrays.IntegerArray(converted[:, i], missing[:, i])
+    else:
+        df_trades["Basis_converted"] = df_trades["Basis"] * df_trades["rate"]
+        df_trades["Comm/Fee_converted"] = df_trades["Comm/Fee"] * df_trades["rate"]
+        df_trades["Proceeds_converted"] = df_trades["Proceeds"] * df_trades["rate"]
+
+    desired_order = ["id", "waluty", "Stock", "Date/Time", "Quantity", "Proceeds", "Proceeds_converted",
+                     "Comm/Fee", "Basis", "Kurs_Date", "rate", "Basis_converted", "Comm/Fee_converted", 
+                     "shares_in_possession"]
+    return df_trades[desired_order]
+
+
+def convert_cash(df_cash: pd.DataFrame, rates: ExchangeRateStore, money_mode: str = None,
+                 warnings: list = None) -> pd.DataFrame:
+    """
+    Przelicza operacje pieniężne (dywidendy, podatek u źródła, odsetki) na PLN kursem z ostatniego
+    dnia roboczego przed dniem operacji – jak transakcje (merge_exchange_rates, apply_currency_conversion).
+    W trybie "fixed" (domyślnie ustawienie MONEY_MODE) kwoty są w jednostkach drobnych (pd.Int64).
+    Operacje bez kursu są zgłaszane do listy warnings jako komunikaty.
+    """
+    money_mode = money_mode or app.config["MONEY_MODE"]
+    df_cash = df_cash.reset_index(drop=True)
+    dates = parse_date_times(df_cash["Date"], CASH_DATE_FORMAT)
+    amounts = parse_numbers(df_cash["Amount"])
+    rows = rates.previous_rate_rows(dates.to_numpy(dtype="datetime64[D]").astype(np.int64))
+    fixed = money_mode == "fixed"
+    rate, unmatched, fixed_rate, unit = lookup_rates(df_cash["waluty"], rows, rates, fixed)
+
+    missing = np.isnan(rate) & ~unmatched & amounts.notna().to_numpy()
+    problems = [(unmatched, "brak waluty w pliku kursów"), (missing, "brak kursu z dnia poprzedzającego operację")]
+    for mask, reason in problems:
+        for (section, currency), count in (df_cash[mask].fillna({"waluty": "(brak)"})
+                                           .groupby(["section", "waluty"]).size().items()):
+            message = f"{CASH_SECTIONS.get(section, section)} ({currency}): {count} operacji – {reason}"
+            print(message)
+            if warnings is not None:
+                warnings.append(message)
+
+    found = rows >= 0
+    kurs_dates = np.full(len(rows), np.datetime64("NaT"), dtype="datetime64[ns]")
+    kurs_dates[found] = rates.days[rows[found]].astype("datetime64[D]")
+    result = df_cash[["section", "waluty", "Date", "Description", "Symbol"]].copy()
+    result["Date"] = dates
+    result["Year"] = dates.dt.year.astype("Int64")
+    result["Kurs_Date"] = kurs_dates
+    result["rate"] = rate
+    if fixed:
+        minor = to_minor_units(amounts)
+        converted = scale_money(minor.to_numpy(dtype=np.int64, na_value=0), np.maximum(fixed_rate, 0),
+                                unit * RATE_SCALE)
+        result["Amount"] = minor
+        result["Amount_converted"] = pd.arrays.IntegerArray(converted, minor.isna().to_numpy() | (fixed_rate < 0))
+    else:
+        result["Amount"] = amounts
+        result["Amount_converted"] = amounts * rate
+    return result
+
+
+def summarize_cash(df_cash: pd.DataFrame) -> pd.DataFrame:
+    """
+    Sumy operacji pieniężnych per rok, sekcja i waluta: Amount (w walucie) i Amount_converted (w PLN).
+    Kwoty stałoprzecinkowe są sumowane dokładnie.
+    """
+    return (df_cash.groupby(["Year", "section", "waluty"], sort=True)[["Amount", "Amount_converted"]]
+            .sum(min_count=1).reset_index().astype({"Year": np.int64}))
+
+
+def build_cash_results(portfolio: "Portfolio") -> dict:
+    """
+    Przelicza operacje pieniężne portfela aktywnym plikiem kursów i zwraca podsumowania: roczne
+    per sekcja i waluta (DataFrame), tabelę HTML lat × sekcje w PLN oraz ostrzeżenia.
+    """
+    warnings = []
+    if portfolio.cash.empty:
+        return {"yearly": pd.DataFrame(), "html": "", "warnings": warnings}
+    with measure("convert_cash"):
+        converted = convert_cash(portfolio.cash, get_exchange_rates(portfolio.exchange_rates_file),
+                                 warnings=warnings)
+        yearly = summarize_cash(converted)
+    # Tabela na stronę wyników: sumy w PLN, kolumny w kolejności CASH_SECTIONS
+    pln = (money_to_float(yearly).groupby(["Year", "section"])["Amount_converted"].sum(min_count=1)
+           .unstack("section")
+           .reindex(columns=[section for section in CASH_SECTIONS if section in set(yearly["section"])])
+           .rename(columns=CASH_SECTIONS).rename_axis(columns=None))
+    html = pln.reset_index().to_html(classes="table table-bordered", index=False, border=0,
+                                     float_format=lambda x: f"{x:.2f}", na_rep="")
+    return {"yearly": yearly, "html": html, "warnings": warnings}
+
+
+def allocate_fifo(df_trades: pd.DataFrame, warnings: list = None) -> pd.DataFrame:
+    """
+    Alokacja FIFO – przypisuje transakcjom kupna i sprzedaży wykorzystanie 
+    zgodnie z kolejnością transakcji. Obsługuje zarówno pozycje długie 
+    jak i krótką sprzedaż (short selling).
+
+    Silnik działa na tablicach NumPy: dla każdego stocku prowadzi kolejki lotów
+    (deque) z pozycjami wierszy, a wyniki zapisuje jednorazowo jako płaskie kolumny
+    liczbowe. Alokacje roczne trafiają do kolumn year_allocated_<rok> – ilość
+    przypisana do roku transakcji zamykającej.
+
+    Transakcje bez poprawnej daty (NaT) nie biorą udziału w alokacji – nie da się ustalić ich
+    kolejności. Zostają w wyniku niezaalokowane (shares_in_possession = NaN) i są zgłaszane
+    do listy warnings jako pary (stock, komunikat).
+    """
+    df_trades = df_trades.drop(columns=["year_allocated"] + fifo_year_columns(df_trades), errors="ignore")
+    n = len(df_trades)
+
+    stock_codes, _ = pd.factorize(df_trades["Stock"])
+    dates = df_trades["Date/Time"]
+    years = dates.dt.year.to_numpy()
+    quantities = df_trades["Quantity"].to_numpy(dtype=float).tolist()
+
+    undated = dates.isna().to_numpy()
+    for stock, count in df_trades.loc[undated, "Stock"].value_counts(sort=False).items():
+        message = f"{stock}: {count} transakcji bez poprawnej daty pominiętych w alokacji FIFO"
+        print(message)
+        if warnings is not None:
+            warnings.append((stock, message))
+
+    # Stabilne sortowanie: najpierw po stocku, w ramach stocku chronologicznie (tylko transakcje z datą)
+    order = np.lexsort((dates.to_numpy(dtype="datetime64[ns]").view("int64"), stock_codes))
+    order = order[~undated[order]]
+    boundaries = np.flatnonzero(np.diff(stock_codes[order])) + 1
+
+    fifo_allocated = [0.0] * n
+    fifo_used = [False] * n
+    shares_in_possession = [np.nan if missing else 0.0 for missing in undated.tolist()]
+    # Zdarzenia alokacji: (pozycja wiersza, rok transakcji zamykającej, ilość)
+    alloc_positions, alloc_years, alloc_quantities = [], [], []
+
+    for group in np.split(order, boundaries) if len(order) else []:
+        # Kolejki lotów: [pozycja wiersza, ilość pozostała do alokacji]
+        buy_queue = deque()
+        sell_queue = deque()
+        current_possession = 0.0
+
+        for pos in group.tolist():
+            quantity = quantities[pos]
+            transaction_year = years[pos]
+
+            current_possession += quantity
+            shares_in_possession[pos] = current_possession
+
+            if quantity > 0:  # Transakcja kupna – najpierw pokrywa pozycje krótkie
+                remaining = quantity
+                opposite_queue, own_queue = sell_queue, buy_queue
+            else:  # Transakcja sprzedaży – najpierw pokrywa pozycje długie
+                remaining = -quantity
+                opposite_queue, own_queue = buy_queue, sell_queue
+
+            while opposite_queue and remaining > 0:
+                lot = opposite_queue[0]
+                to_allocate = min(remaining, lot[1])
+
+                fifo_allocated[lot[0]] += to_allocate
+                if lot[1] == to_allocate:  # Lot całkowicie pokryty
+                    fifo_used[lot[0]] = True
+                    opposite_queue.popleft()
+                else:
+                    lot[1] -= to_allocate
+                fifo_allocated[pos] += to_allocate
+
+                # Rok podatkowy to rok transakcji zamykającej – dla obu stron
+                alloc_positions += (lot[0], pos)
+                alloc_years += (transaction_year, transaction_year)
+                alloc_quantities += (to_allocate, to_allocate)
+
+                remaining -= to_allocate
+
+            # Niezaalokowana reszta czeka w kolejce (przy sprzedaży – short selling)
+            if remaining > 0:
+                own_queue.append([pos, remaining])
+            if remaining == 0:
+                fifo_used[pos] = True
+
+    df_trades["fifo_allocated"] = np.asarray(fifo_allocated, dtype=float)
+    df_trades["fifo_used"] = np.asarray(fifo_used, dtype=bool)
+    df_trades["shares_in_possession"] = np.asarray(shares_in_possession, dtype=float)
+
+    # Alokacje roczne jako płaskie kolumny liczbowe
+    allocation_years, year_index = np.unique(np.asarray(alloc_years, dtype=int), return_inverse=True)
+    year_matrix = np.zeros((n, len(allocation_years)))
+    np.add.at(year_matrix, (np.asarray(alloc_positions, dtype=int), year_index), alloc_quantities)
+    for i, year in enumerate(allocation_years):
+        df_trades[f"year_allocated_{year}"] = year_matrix[:, i]
+
+    return df_trades
+
+
+def fifo_year_columns(df_trades: pd.DataFrame) -> list:
+    """
+    Zwraca posortowaną listę kolumn year_allocated_<rok> utworzonych przez allocate_fifo.
+    """
+    return sorted(col for col in df_trades.columns if str(col).startswith("year_allocated_"))
+
+
+SUMMARY_VALUE_COLUMNS = ["Proceeds", "Proceeds_converted", "Comm/Fee", "Basis", "Basis_converted", "Comm/Fee_converted"]
+# Kolumny podsumowań w kolejności używanej przez szablony i eksport
+SUMMARY_COLUMNS = (["Total_Sold"] + [f"{col} sum" for col in SUMMARY_VALUE_COLUMNS]
+                   + [f"{col} sum (quantity < 0)" for col in SUMMARY_VALUE_COLUMNS])
+
+
+def fifo_allocations_long(df_trades: pd.DataFrame) -> pd.DataFrame:
+    """
+    Spłaszcza kolumny year_allocated_<rok> do tabeli (position, id, Year, allocated) –
+    jeden wiersz na transakcję i rok z dodatnią alokacją. position to pozycja wiersza w df_trades.
+    """
+    year_columns = fifo_year_columns(df_trades)
+    years = np.array([int(col.rsplit("_", 1)[1]) for col in year_columns], dtype=np.int64)
+    matrix = df_trades[year_columns].to_numpy(dtype=float) if year_columns else np.zeros((len(df_trades), 0))
+    positions, year_idx = np.nonzero(matrix > 0)
+    return pd.DataFrame({
+        "position": positions,
+        "id": df_trades["id"].to_numpy()[positions],
+        "Year": years[year_idx],
+        "allocated": matrix[positions, year_idx]
+    })
+
+
+def _grouped_summary_sums(codes: np.ndarray, n_groups: int, allocated: np.ndarray,
+                          quantity: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """
+    Sumuje wartości transakcji proporcjonalnie do alokacji FIFO w grupach o numerach codes.
+    Zwraca macierz n_groups x len(SUMMARY_COLUMNS). Wartości NaN nie są pomijane.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        proportion = np.where(quantity != 0, allocated / np.abs(quantity), 0.0)
+    weighted = values * proportion[:, None]
+    sell = quantity < 0
+
+    result = np.empty((n_groups, len(SUMMARY_COLUMNS)))
+    result[:, 0] = np.bincount(codes, weights=np.where(sell, allocated, 0.0), minlength=n_groups)
+    n_values = values.shape[1]
+    for i in range(n_values):
+        result[:, 1 + i] = np.bincount(codes, weights=weighted[:, i], minlength=n_groups)
+        result[:, 1 + n_values + i] = np.bincount(
+            codes, weights=np.where(sell, weighted[:, i], 0.0), minlength=n_groups
+        )
+    return result
+
+
+def _grouped_summary_sums_fixed(codes: np.ndarray, n_groups: int, allocated: np.ndarray,
+                                quantity: np.ndarray, values: np.ndarray, missing: np.ndarray) -> pd.DataFrame:
+    """
+    Odpowiednik _grouped_summary_sums dla kwot stałoprzecinkowych. Udział transakcji (alokacja
+    i |Quantity| w 1/QUANTITY_SCALE akcji) jest stosowany do każdej kwoty na liczbach całkowitych,
+    z zaokrągleniem do groszy połówkami od zera, a sumy grup są liczone dokładnie w int64.
+    Suma grupy zawierającej brakującą kwotę (missing) jest brakiem (NA) – jak NaN w wersji float.
+    """
+    allocated_units = round_half_away(allocated * QUANTITY_SCALE).astype(np.int64)
+    quantity_units = round_half_away(np.abs(quantity) * QUANTITY_SCALE).astype(np.int64)
+    # Transakcje wykorzystane w całości wchodzą do sum bez dzielenia
+    partial = allocated_units != quantity_units
+    weighted = values.copy()
+    no_quantity = quantity_units[partial] == 0
+    weighted[partial] = scale_money(values[partial], np.where(no_quantity, 0, allocated_units[partial])[:, None],
+                                    np.where(no_quantity, 1, quantity_units[partial])[:, None])
+    sell = quantity < 0
+    # bincount sumuje na float64 – wynik jest dokładny, dopóki suma modułów kwot mieści się w 2**52
+    exact_in_float = float(np.abs(weighted).max(initial=0)) * len(weighted) < 2 ** 52
+    weighted, missing = np.ascontiguousarray(weighted.T), np.ascontiguousarray(missing.T)
+    any_missing = missing.any()
+
+    def group_sums(amounts: np.ndarray, missing_amounts: np.ndarray) -> pd.arrays.IntegerArray:
+        if exact_in_float:
+            sums = np.bincount(codes, weights=amounts, minlength=n_groups).astype(np.int64)
+        else:
+            sums = np.zeros(n_groups, dtype=np.int64)
+            np.add.at(sums, codes, amounts)
+        if any_missing:
+            return pd.arrays.IntegerArray(sums, np.bincount(codes, weights=missing_amounts, minlength=n_groups) > 0)
+        return pd.arrays.IntegerArray(sums, np.zeros(n_groups, dtype=bool))
+
+    result = {"Total_Sold": np.bincount(codes, weights=np.where(sell, allocated, 0.0), minlength=n_groups)}
+    for i, col in enumerate(SUMMARY_VALUE_COLUMNS):
+        result[f"{col} sum"] = group_sums(weighted[i], missing[i])
+    for i, col in enumerate(SUMMARY_VALUE_COLUMNS):
+        result[f"{col} sum (quantity < 0)"] = group_sums(np.where(sell, weighted[i], 0), missing[i] & sell)
+    return pd.DataFrame(result, columns=SUMMARY_COLUMNS)
+
+
+def _grouped_summary(codes: np.ndarray, n_groups: int, allocated: np.ndarray,
+                     quantity: np.ndarray, values: np.ndarray, missing: np.ndarray = None) -> pd.DataFrame:
+    """
+    Zwraca sumy grup jako DataFrame z kolumnami SUMMARY_COLUMNS. Podana macierz braków missing
+    oznacza kwoty stałoprzecinkowe (_grouped_summary_sums_fixed).
+    """
+    if missing is not None:
+        return _grouped_summary_sums_fixed(codes, n_groups, allocated, quantity, values, missing)
+    return pd.DataFrame(_grouped_summary_sums(codes, n_groups, allocated, quantity, values), columns=SUMMARY_COLUMNS)
+
+
+def summarize_trades(df_trades: pd.DataFrame) -> tuple:
+    """
+    Generuje podsumowania FIFO dla wszystkich stocków naraz, w jednym zgrupowanym przebiegu.
+    Uwzględnia proporcjonalne wykorzystanie transakcji (fifo_allocated / |Quantity|),
+    a podział na lata liczy na spłaszczonej tabeli alokacji (fifo_allocations_long).
+    Kwoty stałoprzecinkowe są sumowane dokładnie, jako pd.Int64 w jednostkach drobnych.
+    
+    Zwraca krotkę (podsumowanie per stock, podsumowanie per stock i rok).
+    """
+    stock_codes, stocks = pd.factorize(df_trades["Stock"], sort=True)
+    quantity = df_trades["Quantity"].to_numpy(dtype=float)
+    if is_fixed_point(df_trades):
+        values, missing = money_arrays(df_trades, SUMMARY_VALUE_COLUMNS)
+    else:
+        values, missing = df_trades[SUMMARY_VALUE_COLUMNS].to_numpy(dtype=float), None
+
+    # Podsumowanie całkowite – pomijamy transakcje bez alokacji
+    allocated = df_trades["fifo_allocated"].to_numpy(dtype=float)
+    used = allocated > 0
+    summary = _grouped_summary(stock_codes[used], len(stocks), allocated[used], quantity[used], values[used],
+                               None if missing is None else missing[used])
+    summary.insert(0, "Stock", np.asarray(stocks, dtype=object))
+
+    # Podsumowanie roczne – grupa to para (stock, rok)
+    allocations = fifo_allocations_long(df_trades)
+    positions = allocations["position"].to_numpy()
+    years, year_codes = np.unique(allocations["Year"].to_numpy(), return_inverse=True)
+    codes = stock_codes[positions] * len(years) + year_codes
+    present, codes = np.unique(codes, return_inverse=True)
+    yearly = _grouped_summary(codes, len(present), allocations["allocated"].to_numpy(), quantity[positions],
+                              values[positions], None if missing is None else missing[positions])
+    yearly.insert(0, "Stock", np.asarray(stocks, dtype=object)[present // max(len(years), 1)])
+    yearly.insert(0, "Year", years[present % max(len(years), 1)] if len(years) else np.array([], dtype=np.int64))
+    return summary, yearly
+
+
+def summarize_transactions(group: pd.DataFrame) -> pd.DataFrame:
+    """
+    Generuje podsumowanie transakcji dla danego symbolu akcji.
+    Uwzględnia proporcjonalne wykorzystanie transakcji w zależności od 
+    wartości fifo_allocated.
+    """
+    return summarize_trades(group)[0]
+
+
+def summarize_transactions_by_year(group: pd.DataFrame) -> pd.DataFrame:
+    """
+    Generuje podsumowanie transakcji dla danego symbolu akcji z podziałem na lata.
+    """
+    yearly = summarize_trades(group)[1]
+    return yearly if not yearly.empty else pd.DataFrame()
+
+
+def highlight_fifo(row):
+    """
+    Zwraca stylizację wiersza - zaznacza na żółto transakcje, które zostały wykorzystane.
+    """
+    return ['background-color: yellow' if row["fifo_used"] else '' for _ in row.index]
+
+
+def check_negative_fifo(df_stock: pd.DataFrame) -> bool:
+    """
+    Sprawdza, czy dla danego stocku, idąc chronologicznie, bieżąca suma Quantity spada poniżej zera.
+    Jeśli tak – zwraca True, co oznacza, że brakuje transakcji.
+    """
+    df_stock = df_stock[df_stock["Date/Time"].notna()].sort_values("Date/Time")
+    return bool((np.cumsum(df_stock["Quantity"].to_numpy(dtype=float)) < 0).any())
+
+
+def standardize_stock_symbols(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Standaryzuje symbole akcji - zamienia FB na META
+    """
+    df.loc[df["Stock"] == "FB", "Stock"] = "META"
+    return df
+
+
+# Pola transakcji przyjmowane przez API (kolumny magazynu bez id)
+TRANSACTION_FIELDS = ["waluty", "Stock", "Date/Time", "Quantity", "Proceeds", "Comm/Fee", "Basis"]
+TRANSACTION_NUMERIC_FIELDS = ["Quantity", "Proceeds", "Comm/Fee", "Basis"]
+
+
+def validate_transactions(records: list, partial: bool = False) -> tuple:
+    """
+    Sprawdza i normalizuje transakcje z API (lista słowników z polami TRANSACTION_FIELDS) operacjami
+    na całych kolumnach. Daty (ISO lub układ wyciągów IBKR, z sekundami lub bez) są zapisywane w układzie
+    wyciągów, symbol FB zamieniany na META. Przy partial=True (zmiany) wymagane jest tylko pole id,
+    a brak pozostałych pól oznacza "bez zmian".
+    Zwraca (DataFrame z polami jako tekst, lista błędów {"index", "field", "error"}).
+    """
+    fields = (["id"] if partial else []) + TRANSACTION_FIELDS
+    errors = []
+    if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+        return pd.DataFrame(columns=fields), [{"index": None, "field": None, "error": "oczekiwano listy obiektów"}]
+    df = pd.DataFrame.from_records(records) if records else pd.DataFrame()
+
+    for field in sorted(set(df.columns) - set(fields)):
+        errors.append({"index": None, "field": field, "error": "nieznane pole"})
+    df = df.reindex(columns=fields).astype(object)
+    text = df.where(df.isna(), df.astype(str).apply(lambda column: column.str.strip()))
+    present = text.notna() & (text != "")
+
+    def report(mask: pd.Series, field: str, message: str):
+        errors.extend({"index": int(index), "field": field, "error": message} for index in mask[mask].index)
+
+    required = ["id"] if partial else TRANSACTION_FIELDS
+    for field in required:
+        report(~present[field], field, "pole wymagane")
+
+    if partial:
+        ids = pd.to_numeric(text["id"], errors="coerce")
+        invalid = present["id"] & (ids.isna() | (ids % 1 != 0))
+        report(invalid, "id", "nieprawidłowy identyfikator")
+        text["id"] = ids.where(~invalid).astype("Int64")
+
+    report(present["waluty"] & ~text["waluty"].str.fullmatch(r"[A-Z]{3}").fillna(False).astype(bool),
+           "waluty", "oczekiwano trzyliterowego kodu waluty")
+    text["Stock"] = text["Stock"].mask(text["Stock"] == "FB", "META")
+
+    for field in TRANSACTION_NUMERIC_FIELDS:
+        numbers = pd.to_numeric(text[field].str.replace(",", "", regex=False), errors="coerce")
+        report(present[field] & ~np.isfinite(numbers.astype(float)), field, "nieprawidłowa liczba")
+
+    # Daty: "2024-01-02T10:00:00", "2024-01-02 10:00" lub "2024-01-02, 10:00:00"
+    dates = text["Date/Time"].str.replace(r"^(\d{4}-\d{2}-\d{2})(?:, |T| )", r"\1 ", regex=True)
+    parsed = pd.to_datetime(dates, format="%Y-%m-%d %H:%M:%S", errors="coerce")
+    parsed = parsed.fillna(pd.to_datetime(dates, format="%Y-%m-%d %H:%M", errors="coerce"))
+    report(present["Date/Time"] & parsed.isna(), "Date/Time", "nieprawidłowa data")
+    text["Date/Time"] = parsed.dt.strftime("%Y-%m-%d, %H:%M:%S").where(parsed.notna())
+
+    # Puste pola zmian oznaczają "bez zmian"
+    return text.where(present), errors
+
+
+def process_all_trades(portfolio: "Portfolio", stocks=None, warnings: list = None) -> pd.DataFrame:
+    """
+    Przetwarza transakcje portfela pełnym potokiem: filtrowanie, łączenie z kursami,
+    konwersja walut oraz alokacja FIFO.
+    Jeśli podano zbiór stocks, przetwarzane są tylko transakcje tych symboli.
+    Ostrzeżenia z poszczególnych etapów trafiają do listy warnings jako pary (stock, komunikat).
+    """
+    if not portfolio.trade_count():
+        return pd.DataFrame()
+    df = portfolio.live_trades(stocks)
+    if stocks is None:
+        # Wybór symboli (take) daje już kopię; pełną ramkę portfela trzeba skopiować
+        df = df.copy()
+    
+    # Upewniamy się, że kolumna shares_in_possession istnieje
+    if "shares_in_possession" not in df.columns:
+        df["shares_in_possession"] = 0.0
+    
+    # Standaryzujemy symbole akcji
+    df = standardize_stock_symbols(df)
+    metrics.observe("rozliczenie_stage_rows", len(df), stage="process_all_trades")
+        
+    with measure("filter_and_convert"):
+        df = filter_and_convert_transactions(df)
+    if df.empty:
+        return pd.DataFrame()
+    rates = get_exchange_rates(portfolio.exchange_rates_file)
+    with measure("merge_exchange_rates"):
+        df = merge_exchange_rates(df, rates, warnings)
+    with measure("currency_conversion"):
+        df = apply_currency_conversion(df, rates, warnings)
+    with measure("allocate_fifo"):
+        df = allocate_fifo(df, warnings)
+    metrics.set("rozliczenie_dataframe_bytes", df.memory_usage(deep=True).sum(), frame="processed")
+    return df
+
+
+def build_stock_result(stock: str, group: pd.DataFrame, summary: pd.DataFrame,
+                       yearly_summary: pd.DataFrame, warnings: list = None) -> dict:
+    """
+    Przygotowuje wyniki dla jednego stocku (podsumowania policzone wcześniej przez summarize_trades).
+    Stan FIFO jest niezależny dla każdego stocku, więc wynik można przechowywać i liczyć osobno.
+    Fragmenty HTML są renderowane dopiero przy otwarciu zakładki (render_stock_tab).
+    """
+    group_sorted = group.sort_values("Date/Time").copy()
+    # Sprawdź, czy występuje ujemna suma transakcji dla danego stocku
+    has_issue = check_negative_fifo(group_sorted)
+    display_name = stock + (" !" if has_issue else "")
+    
+    return {
+        "frame": group_sorted,
+        "display_name": display_name,
+        "summary": summary,
+        "yearly": yearly_summary,
+        "warnings": warnings or [],
+        "html": {},  # Wyrenderowane fragmenty HTML, uzupełniane przez render_stock_tab
+        "nbytes": int(group_sorted.memory_usage(deep=True).sum())  # Do budżetu pamięci portfeli
+    }
+
+
+def render_transactions_html(frame: pd.DataFrame) -> str:
+    """
+    Renderuje tabelę transakcji z zaznaczeniem wykorzystanych (FIFO) transakcji i linkami do usuwania.
+    """
+    frame = money_to_float(frame).copy()
+    frame["Action"] = frame["id"].apply(
+        lambda x: f'<a href="{url_for("remove_transaction", transaction_id=x)}">Usuń</a>'
+    )
+    
+    # Zmiana formatowania liczb w tabeli transakcji
+    styled_group = frame.style.apply(highlight_fifo, axis=1).format({
+        col: lambda x: f"{x:.6f}" if isinstance(x, (float, int)) else x 
+        for col in frame.select_dtypes(include=['float64', 'int64']).columns
+    })
+    
+    return styled_group.hide(axis="index").to_html()
+
+
+def render_stock_tab(entry: dict, page: int, per_page: int) -> dict:
+    """
+    Zwraca fragmenty HTML zakładki jednego stocku: stronę tabeli transakcji (per_page=0 – wszystkie
+    transakcje), podsumowanie FIFO i podsumowanie roczne. Wyrenderowane fragmenty są zapamiętywane
+    w wyniku stocku.
+    """
+    html = entry["html"]
+    if "summary" not in html:
+        # Zmiana formatowania liczb w tabeli podsumowania
+        html["summary"] = money_to_float(entry["summary"]).to_html(
+            classes="table table-bordered", 
+            index=False, 
+            border=0,
+            float_format=lambda x: f"{x:.6f}"
+        )
+        # Dodajemy podsumowanie roczne
+        html["yearly"] = None
+        if not entry["yearly"].empty:
+            html["yearly"] = money_to_float(entry["yearly"]).to_html(
+                classes="table table-bordered", 
+                index=False, 
+                border=0,
+                float_format=lambda x: f"{x:.6f}" if isinstance(x, (float, int)) else x
+            )
+    
+    frame = entry["frame"]
+    pages = max(1, -(-len(frame) // per_page)) if per_page > 0 else 1
+    page = min(max(page, 1), pages)
+    key = ("transactions", page, per_page)
+    if key not in html:
+        rows = frame.iloc[(page - 1) * per_page:page * per_page] if per_page > 0 else frame
+        html[key] = render_transactions_html(rows)
+    
+    return {
+        "transactions": html[key],
+        "summary": html["summary"],
+        "yearly": html["yearly"],
+        "page": page,
+        "pages": pages,
+        "per_page": per_page,
+        "rows": len(frame)
+    }
+
+
+def build_results(stock_entries: dict, cash: dict = None) -> dict:
+    """
+    Składa wyniki per stock (z build_stock_result) w to, czego potrzebuje strona wyników
+    oraz eksport, i wylicza podsumowania dla zakładki "All". cash to wyniki build_cash_results
+    (dywidendy, podatek u źródła, odsetki).
+    """
+    cash = cash or {"yearly": pd.DataFrame(), "html": "", "warnings": []}
+    stock_results = {}
+    yearly_summaries = {}  # Dodajemy słownik na podsumowania roczne
+    summaries = {}  # Podsumowania FIFO per stock (DataFrame), wykorzystywane również w eksporcie
+    yearly_dfs = {}  # Podsumowania roczne per stock (DataFrame)
+    warnings = []  # Ostrzeżenia z przetwarzania (np. brak kursu dla waluty)
+    
+    for stock in sorted(stock_entries):
+        entry = stock_entries[stock]
+        summaries[stock] = entry["summary"]
+        yearly_dfs[stock] = entry["yearly"]
+        warnings.extend(entry["warnings"])
+        # Tabele stocku są ładowane przy otwarciu zakładki (trasa stock_tab)
+        stock_results[stock] = {
+            "display_name": entry["display_name"]
+        }
+    
+    all_summary = pd.Series(0.0, index=SUMMARY_COLUMNS)
+    all_yearly_df = pd.DataFrame(columns=["Year"] + SUMMARY_COLUMNS)
+    if stock_entries:
+        # Podsumowanie roczne dla zakładki "All" – suma podsumowań rocznych wszystkich akcji
+        yearly_frames = [df for df in yearly_dfs.values() if not df.empty]
+        if yearly_frames:
+            # Kwoty stałoprzecinkowe są sumowane dokładnie, na float zamieniane dopiero po zsumowaniu
+            all_yearly_df = money_to_float(pd.concat(yearly_frames, ignore_index=True)
+                                           .groupby("Year", sort=True)[SUMMARY_COLUMNS].sum()
+                                           .reset_index())
+            all_yearly_html = all_yearly_df.to_html(
+                classes="table table-bordered", 
+                index=False, 
+                border=0,
+                float_format=lambda x: f"{x:.6f}" if isinstance(x, (float, int)) else x
+            )
+            yearly_summaries["all"] = all_yearly_html
+        
+        # Dodajemy zakładkę "All" do wyników – tylko sumy w PLN
+        # Suma jako jedna grupa – groupby zachowuje typ kolumn, więc kwoty stałoprzecinkowe są sumowane dokładnie
+        totals = pd.concat(summaries.values(), ignore_index=True)
+        all_summary = money_to_float(totals.groupby(np.zeros(len(totals), dtype=int))[SUMMARY_COLUMNS].sum()).iloc[0]
+        all_summary_display = all_summary[[
+            "Proceeds_converted sum",
+            "Basis_converted sum",
+            "Comm/Fee_converted sum",
+            "Proceeds_converted sum (quantity < 0)",
+            "Basis_converted sum (quantity < 0)",
+            "Comm/Fee_converted sum (quantity < 0)"
+        ]].to_frame().T
+        
+        # Zmiana formatowania liczb w tabeli podsumowania "All"
+        all_summary_html = all_summary_display.to_html(
+            classes="table table-bordered", 
+            index=False, 
+            border=0,
+            float_format=lambda x: f"{x:.6f}"
+        )
+        
+        stock_results["all"] = {
+            "display_name": "All",
+            "transactions": "",  # Puste, bo nie pokazujemy transakcji w tej zakładce
+            "summary": all_summary_html
+        }
+    
+    return {
+        "stocks": stock_entries,
+        "summaries": summaries,
+        "yearly": yearly_dfs,
+        "stock_results": stock_results,
+        "yearly_summaries": yearly_summaries,
+        "all_summary": all_summary,  # Sumy "All" (Series) i sumy "All" per rok – dla eksportu
+        "all_yearly": all_yearly_df,
+        "cash_yearly": cash["yearly"],
+        "cash_summary": cash["html"],
+        "warnings": warnings + cash["warnings"],
+    }
+
+
+def get_processed_results(portfolio: "Portfolio") -> dict:
+    """
+    Zwraca wyniki build_results() dla portfela z jego pamięci podręcznej. Wyniki są liczone ponownie tylko wtedy,
+    gdy zmieni się wersja zbioru transakcji (wgranie plików, dodanie, usunięcie, odświeżenie)
+    lub zawartość aktywnego pliku z kursami.
+    
+    Po zmianie zbioru transakcji przeliczane są tylko stocki oznaczone jako zmienione
+    (invalidate_results), pozostałe wyniki per stock są używane ponownie. Zmiana pliku
+    z kursami wymusza pełne przeliczenie. Transakcje są przetwarzane paczkami symboli
+    (Portfolio.stock_batches, limit PROCESS_BATCH_ROWS).
+    """
+    cache = portfolio.results_cache
+    rates_key = rates_file_fingerprint(portfolio.exchange_rates_file)
+    if cache.get("rates_key") != rates_key:
+        cache.clear()
+    elif cache.get("version") == portfolio.version:
+        return cache["results"]
+    
+    stock_entries = cache.setdefault("stocks", {})
+    if cache.get("rates_key") is None:
+        dirty = None  # Pełne przeliczenie
+        stock_entries.clear()
+    else:
+        dirty = set(portfolio.dirty_stocks)
+        for stock in dirty:
+            stock_entries.pop(stock, None)
+    
+    # Paczkami symboli – w pamięci są naraz tylko ramki pośrednie jednej paczki i zwięzłe wyniki per stock
+    for batch in portfolio.stock_batches(dirty, app.config["PROCESS_BATCH_ROWS"]):
+        warnings = []
+        with measure("process_all_trades"):
+            processed_df = process_all_trades(portfolio, batch, warnings)
+        build_stock_entries(processed_df, warnings, stock_entries)
+        del processed_df
+    
+    portfolio.dirty_stocks.clear()
+    return store_results(portfolio, stock_entries, rates_key)
+
+
+def build_stock_entries(processed_df: pd.DataFrame, warnings: list, stock_entries: dict):
+    """
+    Liczy podsumowania przetworzonych transakcji i zapisuje wyniki per stock w stock_entries.
+    warnings to lista par (stock, komunikat) z przetwarzania.
+    """
+    if processed_df.empty:
+        return
+    with measure("summarize_trades"):
+        summary_df, yearly_df = summarize_trades(processed_df)
+        summaries = {stock: df.reset_index(drop=True) for stock, df in summary_df.groupby("Stock")}
+        yearly = {stock: df.reset_index(drop=True) for stock, df in yearly_df.groupby("Stock")}
+    with measure("build_stock_results"):
+        for stock, group in processed_df.groupby("Stock"):
+            metrics.observe("rozliczenie_stock_group_rows", len(group))
+            stock_warnings = [message for warning_stock, message in warnings if warning_stock == stock]
+            stock_entries[stock] = build_stock_result(
+                stock, group, summaries[stock], yearly.get(stock, pd.DataFrame()), stock_warnings
+            )
+
+
+def store_results(portfolio: "Portfolio", stock_entries: dict, rates_key: str) -> dict:
+    """
+    Składa wyniki z wyników per stock i zapisuje je w pamięci podręcznej portfela dla bieżącej
+    wersji zbioru transakcji i pliku z kursami.
+    """
+    cache = portfolio.results_cache
+    cache["stocks"] = stock_entries
+    if "cash" not in cache:
+        cache["cash"] = build_cash_results(portfolio)
+    with measure("build_results"):
+        cache["results"] = build_results(stock_entries, cache["cash"])
+    cache["rates_key"] = rates_key
+    cache["version"] = portfolio.version
+    portfolios.account(portfolio)
+    return cache["results"]
+
+
+def invalidate_results(portfolio: "Portfolio", stocks=None):
+    """
+    Podbija wersję zbioru transakcji portfela i oznacza podane symbole jako wymagające przeliczenia.
+    Bez argumentu porzuca wszystkie wyniki – kolejne żądanie przeliczy wszystko od nowa.
+    """
+    portfolio.version += 1
+    if stocks is None:
+        portfolio.results_cache.clear()
+    else:
+        portfolio.dirty_stocks.update(stocks)
+
+
+# Kolumny z sumami w eksporcie (poza Stock i Year), w kolejności kolumn pliku
+EXPORT_VALUE_COLUMNS = [
+    "Proceeds sum", "Proceeds_converted sum", "Comm/Fee sum", "Comm/Fee_converted sum",
+    "Proceeds sum (quantity < 0)", "Proceeds_converted sum (quantity < 0)", "Comm/Fee sum (quantity < 0)",
+    "Basis sum (quantity < 0)", "Basis_converted sum (quantity < 0)", "Comm/Fee_converted sum (quantity < 0)"
+]
+EXPORT_COLUMNS = ["Stock", "Year"] + EXPORT_VALUE_COLUMNS
+
+
+def iter_export_rows(results: dict):
+    """
+    Zwraca kolejne wiersze eksportu [Stock, Year, sumy EXPORT_VALUE_COLUMNS] prosto z podsumowań
+    zapisanych w wynikach build_results(), bez budowania całej tabeli w pamięci.
+    
+    Kolejność jak w sortowaniu po (Stock, Year): stocki i "All" alfabetycznie, dla każdego
+    najpierw wiersz "Total" (całkowita suma), potem kolejne lata rosnąco.
+    """
+    for stock in sorted([*results["summaries"], "All"]):
+        if stock == "All":
+            yield [stock, "Total", *results["all_summary"][EXPORT_VALUE_COLUMNS].tolist()]
+            yearly_summary = results["all_yearly"]
+        else:
+            summary = money_to_float(results["summaries"][stock])
+            if not summary.empty:
+                yield [stock, "Total", *summary[EXPORT_VALUE_COLUMNS].iloc[0].tolist()]
+            yearly_summary = money_to_float(results["yearly"][stock])
+        if not yearly_summary.empty:
+            values = yearly_summary[EXPORT_VALUE_COLUMNS].to_numpy(dtype=float).tolist()
+            for year, row in zip(yearly_summary["Year"].tolist(), values):
+                yield [stock, year, *row]
+
+
+def iter_export_batches(results: dict, batch_size: int = 1000):
+    """
+    Grupuje wiersze eksportu w paczki po batch_size wierszy.
+    """
+    batch = []
+    for row in iter_export_rows(results):
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def build_export_df(results: dict) -> pd.DataFrame:
+    """
+    Buduje DataFrame eksportu z podsumowań per stock zapisanych w wynikach build_results().
+    """
+    return pd.DataFrame(list(iter_export_rows(results)), columns=EXPORT_COLUMNS)
+
+
+def stream_export_csv(results: dict):
+    """
+    Generuje plik CSV eksportu kawałkami (paczka wierszy na raz) – pobieranie rusza od razu,
+    a zajętość pamięci nie zależy od liczby wierszy. Puste wartości (NaN) zapisywane są jak w pandas.
+    """
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    writer.writerow(EXPORT_COLUMNS)
+    with measure("export_csv_stream"):
+        for batch in iter_export_batches(results):
+            writer.writerows(
+                [value if value == value else "" for value in row]  # NaN != NaN
+                for row in batch
+            )
+            yield output.getvalue().encode("utf-8")
+            output.seek(0)
+            output.truncate()
+    if output.tell():
+        yield output.getvalue().encode("utf-8")
+
+
+class _StreamSink(io.RawIOBase):
+    """
+    Plik tylko do zapisu, który zbiera zapisane bajty do odebrania przez generator odpowiedzi.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_export_parquet(results: dict, pa, pq):
+    """
+    Generuje plik Parquet eksportu – każda paczka wierszy to osobna grupa wierszy (row group),
+    wysyłana zaraz po zapisaniu. Year jest kolumną tekstową, bo zawiera też wartość "Total".
+    """
+    schema = pa.schema([("Stock", pa.string()), ("Year", pa.string())]
+                       + [(column, pa.float64()) for column in EXPORT_VALUE_COLUMNS])
+    sink = _StreamSink()
+    with measure("export_parquet_stream"):
+        with pq.ParquetWriter(sink, schema) as writer:
+            for batch in iter_export_batches(results):
+                columns = list(zip(*batch))
+                writer.write_table(pa.table(
+                    [list(columns[0]), [str(year) for year in columns[1]]] + [list(values) for values in columns[2:]],
+                    schema=schema
+                ))
+                yield sink.take()
+    yield sink.take()
+
+
+def build_export_xlsx(results: dict, openpyxl) -> io.BytesIO:
+    """
+    Buduje plik XLSX eksportu w trybie write_only (wiersze nie są trzymane w arkuszu).
+    Plik XLSX to archiwum ZIP, więc wysyłamy go dopiero po zapisaniu całości.
+    """
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("Eksport")
+    sheet.append(EXPORT_COLUMNS)
+    with measure("export_xlsx_build"):
+        for row in iter_export_rows(results):
+            sheet.append([None if isinstance(value, float) and value != value else value for value in row])
+        output = io.BytesIO()
+        workbook.save(output)
+    output.seek(0)
+    return output
+
+
+# ----------------- Magazyn transakcji -----------------
+class TradeStore:
+    """
+    Wspólny magazyn transakcji w lokalnej bazie SQLite (tryb WAL), współdzielony przez wszystkie
+    procesy gunicorna. Transakcje należą do portfeli (jeden portfel na sesję użytkownika); dla każdego
+    portfela magazyn przechowuje transakcje (indeksowane po portfelu, id i Stock), wersję zbioru,
+    następny identyfikator transakcji, dziennik zmian (które symbole zmieniły się w danej wersji),
+    operacje pieniężne z wyciągów (dywidendy, podatek u źródła, odsetki) i aktywny plik z kursami.
+    Przechowuje też ostatnie metryki każdego procesu.
+    Wartości transakcji są trzymane jako tekst – tak jak w wyciągu, konwersję robi potok.
+    """
+
+    TRADE_COLUMNS = {
+        "id": "id", "waluty": "waluty", "Stock": "stock", "Date/Time": "date_time", "Quantity": "quantity",
+        "Proceeds": "proceeds", "Comm/Fee": "comm_fee", "Basis": "basis"
+    }
+    CASH_COLUMNS = {
+        "section": "section", "waluty": "waluty", "Date": "date", "Description": "description",
+        "Symbol": "symbol", "Amount": "amount"
+    }
+    # Ile wpisów dziennika zmian trzymać na portfel – starsze wersje wymagają pełnego przeładowania
+    CHANGES_KEPT = 10000
+    # Po ilu sekundach usuwać zakończone zadania wgrywania
+    UPLOAD_JOBS_KEPT_SECONDS = 24 * 3600
+    UPLOAD_JOB_FIELDS = ("state", "files_total", "files_done", "rows_parsed", "errors")
+    # Wiersz z sumą histogramów zakończonych procesów (pid 0 nie należy do żadnego procesu roboczego)
+    METRICS_RETAINED = (0, "")
+    # Procesy prowadzące zadania: pid i process_start_token (pid może zostać użyty ponownie)
+    UPLOAD_JOB_OWNER = ("pid", "started")
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with closing(sqlite3.connect(self.path)) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(f"""
+                CREATE TABLE IF NOT EXISTS portfolio_trades (
+                    portfolio TEXT NOT NULL, id INTEGER NOT NULL,
+                    waluty TEXT, stock TEXT NOT NULL, date_time TEXT,
+                    quantity TEXT, proceeds TEXT, comm_fee TEXT, basis TEXT,
+                    PRIMARY KEY (portfolio, id)
+                );
+                CREATE INDEX IF NOT EXISTS portfolio_trades_stock ON portfolio_trades (portfolio, stock);
+                CREATE TABLE IF NOT EXISTS portfolio_cash (
+                    id INTEGER PRIMARY KEY, portfolio TEXT NOT NULL, section TEXT NOT NULL,
+                    waluty TEXT, date TEXT, description TEXT, symbol TEXT, amount TEXT
+                );
+                CREATE INDEX IF NOT EXISTS portfolio_cash_portfolio ON portfolio_cash (portfolio);
+                CREATE TABLE IF NOT EXISTS portfolios (
+                    portfolio TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL DEFAULT 0,
+                    next_id INTEGER NOT NULL DEFAULT 1,
+                    exchange_rates_file TEXT NOT NULL DEFAULT '{DEFAULT_EXCHANGE_RATES_FILE}'
+                );
+                CREATE TABLE IF NOT EXISTS portfolio_changes (
+                    portfolio TEXT NOT NULL, version INTEGER NOT NULL, stocks TEXT, deleted_ids TEXT,
+                    PRIMARY KEY (portfolio, version)
+                );
+                CREATE TABLE IF NOT EXISTS upload_jobs (
+                    id TEXT PRIMARY KEY, portfolio TEXT NOT NULL, pid INTEGER NOT NULL,
+                    started TEXT NOT NULL DEFAULT '', state TEXT NOT NULL,
+                    files_total INTEGER NOT NULL, files_done INTEGER NOT NULL DEFAULT 0,
+                    rows_parsed INTEGER NOT NULL DEFAULT 0, errors TEXT NOT NULL DEFAULT '[]',
+                    created_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS portfolio_rates (
+                    portfolio TEXT NOT NULL, path TEXT NOT NULL, name TEXT NOT NULL, uploaded_at REAL NOT NULL,
+                    PRIMARY KEY (portfolio, path)
+                );
+                CREATE TABLE IF NOT EXISTS process_metrics (
+                    pid INTEGER NOT NULL, started TEXT NOT NULL, snapshot TEXT NOT NULL,
+                    PRIMARY KEY (pid, started)
+                );
+            """)
+            # Bazy sprzed dziennika usunięć
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(portfolio_changes)")}
+            if "deleted_ids" not in columns:
+                try:
+                    conn.execute("ALTER TABLE portfolio_changes ADD COLUMN deleted_ids TEXT")
+                except sqlite3.OperationalError:
+                    pass  # Kolumnę dodał już inny proces
+            # Bazy z metrykami kluczowanymi samym pid – wiersze trafiają pod started "legacy", a /metrics
+            # dołącza je do zachowanej sumy (żaden działający proces nie ma takiego identyfikatora)
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'metrics'").fetchone():
+                try:
+                    conn.execute("INSERT OR IGNORE INTO process_metrics (pid, started, snapshot) "
+                                 "SELECT pid, 'legacy', snapshot FROM metrics")
+                    conn.execute("DROP TABLE metrics")
+                except sqlite3.OperationalError:
+                    pass  # Tabelę przeniósł już inny proces
+            # Bazy sprzed zapisywania czasu startu procesu prowadzącego zadanie wgrywania
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(upload_jobs)")}
+            if "started" not in columns:
+                try:
+                    conn.execute("ALTER TABLE upload_jobs ADD COLUMN started TEXT NOT NULL DEFAULT ''")
+                except sqlite3.OperationalError:
+                    pass  # Kolumnę dodał już inny proces
+            conn.commit()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Osobne połączenie dla każdego wątku i procesu (gunicorn forkuje procesy robocze)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _write(self, portfolio: str, changed_stocks, deleted_ids=None):
+        """
+        Transakcja zapisu w portfelu: podbija jego wersję i zapisuje w dzienniku, które symbole
+        się zmieniły (None = zmiana całego zbioru; zbiór może być uzupełniany wewnątrz bloku).
+        Zmiany polegające wyłącznie na usunięciu transakcji podają też listę deleted_ids – procesy
+        oznaczają wtedy usunięte wiersze w swoich kopiach zamiast przeładowywać symbole.
+        Portfel jest zakładany przy pierwszym zapisie.
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("INSERT OR IGNORE INTO portfolios (portfolio) VALUES (?)", (portfolio,))
+            yield conn
+            conn.execute("UPDATE portfolios SET version = version + 1 WHERE portfolio = ?", (portfolio,))
+            version = conn.execute("SELECT version FROM portfolios WHERE portfolio = ?", (portfolio,)).fetchone()[0]
+            stocks = None if changed_stocks is None else json.dumps(sorted(changed_stocks))
+            deleted = None if deleted_ids is None else json.dumps(sorted(deleted_ids))
+            conn.execute("INSERT INTO portfolio_changes (portfolio, version, stocks, deleted_ids) VALUES (?, ?, ?, ?)",
+                         (portfolio, version, stocks, deleted))
+            conn.execute("DELETE FROM portfolio_changes WHERE portfolio = ? AND version <= ?",
+                         (portfolio, version - self.CHANGES_KEPT))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _insert_rows(self, conn: sqlite3.Connection, portfolio: str, df_trades: pd.DataFrame, ids):
+        names = [name for name in self.TRADE_COLUMNS if name != "id"]
+        rows = df_trades[names].astype(object).where(df_trades[names].notna(), None)
+        rows = [(portfolio, int(trade_id)) + tuple(None if value is None else str(value) for value in row)
+                for trade_id, row in zip(ids, rows.itertuples(index=False))]
+        columns = ", ".join(self.TRADE_COLUMNS[name] for name in names)
+        conn.executemany(
+            f"INSERT INTO portfolio_trades (portfolio, id, {columns}) VALUES ({', '.join('?' * (len(names) + 2))})",
+            rows
+        )
+
+    def _insert_cash(self, conn: sqlite3.Connection, portfolio: str, df_cash: pd.DataFrame):
+        names = list(self.CASH_COLUMNS)
+        rows = df_cash[names].astype(object).where(df_cash[names].notna(), None)
+        conn.executemany(
+            f"INSERT INTO portfolio_cash (portfolio, {', '.join(self.CASH_COLUMNS.values())}) "
+            f"VALUES ({', '.join('?' * (len(names) + 1))})",
+            [(portfolio,) + tuple(None if value is None else str(value) for value in row)
+             for row in rows.itertuples(index=False)]
+        )
+
+    def state(self, portfolio: str) -> tuple:
+        """
+        Zwraca (wersja zbioru transakcji, aktywny plik z kursami) portfela.
+        """
+        row = self._connect().execute(
+            "SELECT version, exchange_rates_file FROM portfolios WHERE portfolio = ?", (portfolio,)
+        ).fetchone()
+        return tuple(row) if row else (0, DEFAULT_EXCHANGE_RATES_FILE)
+
+    def changes(self, portfolio: str, since_version: int, version: int) -> tuple:
+        """
+        Zwraca zmiany portfela między wersjami jako (zbiór zmienionych symboli, lista usuniętych id).
+        Symbole to None, jeśli trzeba przeładować wszystko (zmiana całego zbioru lub brak wpisów
+        w dzienniku); lista id to None, jeśli nie wszystkie zmiany były samymi usunięciami.
+        """
+        rows = self._connect().execute(
+            "SELECT version, stocks, deleted_ids FROM portfolio_changes "
+            "WHERE portfolio = ? AND version > ? AND version <= ? ORDER BY version",
+            (portfolio, since_version, version)
+        ).fetchall()
+        if len(rows) != version - since_version or any(stocks is None for _, stocks, _ in rows):
+            return None, None
+        stocks = set().union(*(json.loads(stocks) for _, stocks, _ in rows))
+        if any(deleted is None for _, _, deleted in rows):
+            return stocks, None
+        return stocks, [trade_id for _, _, deleted in rows for trade_id in json.loads(deleted)]
+
+    def load(self, portfolio: str, stocks=None) -> pd.DataFrame:
+        """
+        Wczytuje transakcje portfela (wszystkie albo tylko podanych symboli) w kolejności id.
+        """
+        select = ", ".join(f'{column} AS "{name}"' for name, column in self.TRADE_COLUMNS.items())
+        query = f"SELECT {select} FROM portfolio_trades WHERE portfolio = ?"
+        params = [portfolio]
+        if stocks is not None:
+            stocks = sorted(stocks)
+            query += f" AND stock IN ({', '.join('?' * len(stocks))})"
+            params += stocks
+        df = pd.read_sql_query(query + " ORDER BY id", self._connect(), params=params)
+        df["shares_in_possession"] = 0.0
+        return df
+
+    def load_cash(self, portfolio: str) -> pd.DataFrame:
+        """
+        Wczytuje operacje pieniężne portfela (kolumny CASH_COLUMNS, wartości jako tekst) w kolejności dodania.
+        """
+        select = ", ".join(f'{column} AS "{name}"' for name, column in self.CASH_COLUMNS.items())
+        return pd.read_sql_query(f"SELECT {select} FROM portfolio_cash WHERE portfolio = ? ORDER BY id",
+                                 self._connect(), params=[portfolio])
+
+    def insert(self, portfolio: str, df_trades: pd.DataFrame, df_cash: pd.DataFrame = None) -> list:
+        """
+        Dodaje transakcje do portfela w kolejności wierszy i zwraca nadane im identyfikatory.
+        Operacje pieniężne z tego samego wyciągu (df_cash, kolumny CASH_COLUMNS) są zapisywane
+        w tej samej transakcji zapisu.
+        """
+        with self._write(portfolio, set(df_trades["Stock"]) if len(df_trades) else set()) as conn:
+            first_id = conn.execute("SELECT next_id FROM portfolios WHERE portfolio = ?", (portfolio,)).fetchone()[0]
+            ids = list(range(first_id, first_id + len(df_trades)))
+            if ids:
+                self._insert_rows(conn, portfolio, df_trades, ids)
+            conn.execute("UPDATE portfolios SET next_id = ? WHERE portfolio = ?", (first_id + len(ids), portfolio))
+            if df_cash is not None and len(df_cash):
+                self._insert_cash(conn, portfolio, df_cash)
+        return ids
+
+    def delete(self, portfolio: str, transaction_id: int):
+        """
+        Usuwa transakcję portfela o podanym id. Zwraca jej symbol albo None, jeśli jej nie było.
+        Symbol jest odczytywany w tej samej transakcji zapisu co usunięcie, więc równoległy zapis
+        innego procesu nie może go zmienić pomiędzy odczytem a usunięciem.
+        """
+        stocks = set()
+        try:
+            with self._write(portfolio, stocks, [transaction_id]) as conn:
+                row = conn.execute(
+                    "SELECT stock FROM portfolio_trades WHERE portfolio = ? AND id = ?", (portfolio, transaction_id)
+                ).fetchone()
+                if row is None:
+                    # Wycofuje transakcję – bez zmiany nie podbijamy wersji portfela
+                    raise LookupError(transaction_id)
+                stocks.add(row[0])
+                conn.execute("DELETE FROM portfolio_trades WHERE portfolio = ? AND id = ?", (portfolio, transaction_id))
+        except LookupError:
+            return None
+        return row[0]
+
+    def _stocks_of(self, conn: sqlite3.Connection, portfolio: str, ids: list) -> dict:
+        # Symbole istniejących transakcji o podanych id (paczkami – limit parametrów SQLite)
+        stocks = {}
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            stocks.update(conn.execute(
+                f"SELECT id, stock FROM portfolio_trades WHERE portfolio = ? AND id IN ({', '.join('?' * len(chunk))})",
+                (portfolio, *chunk)
+            ).fetchall())
+        return stocks
+
+    def _load_ids(self, conn: sqlite3.Connection, portfolio: str, ids: list) -> pd.DataFrame:
+        # Transakcje o podanych id (paczkami – limit parametrów SQLite)
+        select = ", ".join(f'{column} AS "{name}"' for name, column in self.TRADE_COLUMNS.items())
+        frames = []
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            frames.append(pd.read_sql_query(
+                f"SELECT {select} FROM portfolio_trades WHERE portfolio = ? AND id IN ({', '.join('?' * len(chunk))})",
+                conn, params=[portfolio, *chunk]
+            ))
+        return pd.concat(frames, ignore_index=True)
+
+    def apply_batch(self, portfolio: str, delete_ids: list, updates: pd.DataFrame, inserts: pd.DataFrame) -> tuple:
+        """
+        Wykonuje paczkę zmian portfela w jednej transakcji zapisu (jedna nowa wersja): usuwa transakcje
+        delete_ids, zmienia transakcje z updates (kolumna id i zmieniane kolumny; brak wartości – pole
+        bez zmian) i dodaje inserts. Kolejne zmiany tego samego id są łączone w podanej kolejności.
+        Odwołanie do nieistniejącej transakcji zgłasza KeyError z listą brakujących id i nie zmienia
+        niczego. Zwraca (identyfikatory dodanych transakcji, zbiór zmienionych symboli).
+        """
+        changed = set()
+        # Paczka samych usunięć jest zapisywana w dzienniku jako lista usuniętych id
+        deleted = sorted(set(delete_ids)) if updates.empty and inserts.empty else None
+        with self._write(portfolio, changed, deleted) as conn:
+            if delete_ids:
+                stocks = self._stocks_of(conn, portfolio, delete_ids)
+                missing = sorted(set(delete_ids) - set(stocks))
+                if missing:
+                    raise KeyError(missing)
+                changed.update(stocks.values())
+                conn.executemany("DELETE FROM portfolio_trades WHERE portfolio = ? AND id = ?",
+                                 [(portfolio, trade_id) for trade_id in stocks])
+
+            if not updates.empty:
+                update_ids = updates["id"].astype(int).tolist()
+                current = self._load_ids(conn, portfolio, update_ids).set_index("id")
+                missing = sorted(set(update_ids) - set(current.index))
+                if missing:
+                    raise KeyError(missing)
+                # Zmiana symbolu dotyczy zarówno starego, jak i nowego symbolu
+                changed.update(current["Stock"])
+                # Kilka zmian tego samego id łączymy w kolejności – dla każdego pola wygrywa
+                # ostatnia podana wartość
+                changes = updates.astype({"id": int}).groupby("id", sort=False).last()
+                current.update(changes)
+                changed.update(current["Stock"])
+                names = [name for name in self.TRADE_COLUMNS if name != "id"]
+                assignments = ", ".join(f"{self.TRADE_COLUMNS[name]} = ?" for name in names)
+                rows = current[names].astype(object).where(current[names].notna(), None)
+                conn.executemany(
+                    f"UPDATE portfolio_trades SET {assignments} WHERE portfolio = ? AND id = ?",
+                    [tuple(row) + (portfolio, int(trade_id))
+                     for trade_id, row in zip(rows.index, rows.itertuples(index=False))]
+                )
+
+            ids = []
+            if not inserts.empty:
+                first_id = conn.execute("SELECT next_id FROM portfolios WHERE portfolio = ?",
+                                        (portfolio,)).fetchone()[0]
+                ids = list(range(first_id, first_id + len(inserts)))
+                self._insert_rows(conn, portfolio, inserts, ids)
+                conn.execute("UPDATE portfolios SET next_id = ? WHERE portfolio = ?", (first_id + len(ids), portfolio))
+                changed.update(inserts["Stock"])
+        return ids, changed
+
+    def replace(self, portfolio: str, df_trades: pd.DataFrame, df_cash: pd.DataFrame = None):
+        """
+        Zastępuje cały zbiór transakcji portfela podanym (z zachowaniem identyfikatorów z kolumny id),
+        a operacje pieniężne – podanymi w df_cash (bez df_cash portfel zostaje bez operacji pieniężnych).
+        """
+        ids = df_trades["id"].astype(int).tolist()
+        with self._write(portfolio, None) as conn:
+            conn.execute("DELETE FROM portfolio_trades WHERE portfolio = ?", (portfolio,))
+            conn.execute("DELETE FROM portfolio_cash WHERE portfolio = ?", (portfolio,))
+            self._insert_rows(conn, portfolio, df_trades, ids)
+            if df_cash is not None and len(df_cash):
+                self._insert_cash(conn, portfolio, df_cash)
+            conn.execute("UPDATE portfolios SET next_id = ? WHERE portfolio = ?", (max(ids, default=0) + 1, portfolio))
+
+    def clear(self, portfolio: str):
+        """
+        Usuwa wszystkie transakcje i operacje pieniężne portfela, zeruje licznik identyfikatorów
+        i przywraca domyślny plik z kursami.
+        """
+        with self._write(portfolio, None) as conn:
+            conn.execute("DELETE FROM portfolio_trades WHERE portfolio = ?", (portfolio,))
+            conn.execute("DELETE FROM portfolio_cash WHERE portfolio = ?", (portfolio,))
+            conn.execute("UPDATE portfolios SET next_id = 1, exchange_rates_file = ? WHERE portfolio = ?",
+                         (DEFAULT_EXCHANGE_RATES_FILE, portfolio))
+
+    def set_exchange_rates_file(self, portfolio: str, path: str):
+        """
+        Ustawia aktywny plik z kursami portfela (dla wszystkich procesów).
+        """
+        with self._write(portfolio, None) as conn:
+            conn.execute("UPDATE portfolios SET exchange_rates_file = ? WHERE portfolio = ?", (path, portfolio))
+
+    def add_rates_file(self, portfolio: str, path: str, name: str):
+        """
+        Zapamiętuje wgraną tabelę kursów portfela (ścieżka skompilowanej tabeli i nazwa wgranego pliku).
+        """
+        self._connect().execute(
+            "INSERT OR REPLACE INTO portfolio_rates (portfolio, path, name, uploaded_at) VALUES (?, ?, ?, ?)",
+            (portfolio, path, name, time.time())
+        )
+
+    def rates_files(self, portfolio: str) -> dict:
+        """
+        Zwraca wgrane tabele kursów portfela: {ścieżka: nazwa pliku}, od najnowszej.
+        """
+        rows = self._connect().execute(
+            "SELECT path, name FROM portfolio_rates WHERE portfolio = ? ORDER BY uploaded_at DESC", (portfolio,)
+        ).fetchall()
+        return dict(rows)
+
+    def create_upload_job(self, job_id: str, portfolio: str, files_total: int):
+        """
+        Zakłada zadanie wgrywania (stan queued) prowadzone przez bieżący proces i usuwa stare zadania.
+        """
+        conn = self._connect()
+        conn.execute("DELETE FROM upload_jobs WHERE created_at < ?", (time.time() - self.UPLOAD_JOBS_KEPT_SECONDS,))
+        conn.execute(
+            "INSERT INTO upload_jobs (id, portfolio, pid, started, state, files_total, created_at) "
+            "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+            (job_id, portfolio, os.getpid(), process_start_token(os.getpid()), files_total, time.time())
+        )
+
+    def update_upload_job(self, job_id: str, **fields):
+        """
+        Zapisuje postęp zadania wgrywania (state, files_done, rows_parsed, errors – lista komunikatów).
+        """
+        if "errors" in fields:
+            fields["errors"] = json.dumps(fields["errors"])
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        self._connect().execute(f"UPDATE upload_jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def load_upload_job(self, portfolio: str, job_id: str):
+        """
+        Zwraca stan zadania wgrywania portfela jako słownik (z pid i started procesu, który je prowadzi)
+        albo None, jeśli takiego zadania nie ma.
+        """
+        fields = self.UPLOAD_JOB_OWNER + self.UPLOAD_JOB_FIELDS
+        row = self._connect().execute(
+            f"SELECT {', '.join(fields)} FROM upload_jobs WHERE id = ? AND portfolio = ?",
+            (job_id, portfolio)
+        ).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(fields, row))
+        job["errors"] = json.loads(job["errors"])
+        return job
+
+    def save_metrics(self, pid: int, started: str, snapshot: dict):
+        """
+        Zapisuje metryki procesu, identyfikowanego przez pid i process_start_token – proces, który dostał
+        pid zakończonego procesu, nie nadpisuje jego liczników (nie zmienia wersji zbioru transakcji).
+        """
+        self._connect().execute(
+            "INSERT OR REPLACE INTO process_metrics (pid, started, snapshot) VALUES (?, ?, ?)",
+            (pid, started, json.dumps(snapshot))
+        )
+
+    def load_metrics(self) -> dict:
+        """
+        Zwraca zapisane metryki wszystkich procesów: {(pid, started): snapshot}, razem z sumą
+        zakończonych procesów pod kluczem METRICS_RETAINED.
+        """
+        rows = self._connect().execute("SELECT pid, started, snapshot FROM process_metrics").fetchall()
+        return {(pid, started): json.loads(snapshot) for pid, started, snapshot in rows}
+
+    def fold_metrics(self, processes: list):
+        """
+        Dołącza histogramy zakończonych procesów (lista kluczy (pid, started)) do zachowanej sumy
+        METRICS_RETAINED i usuwa ich wiersze – skumulowane wartości w /metrics nie maleją.
+        Wskaźniki zakończonych procesów są pomijane.
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            snapshots = []
+            for key in [self.METRICS_RETAINED] + list(processes):
+                row = conn.execute("SELECT snapshot FROM process_metrics WHERE pid = ? AND started = ?",
+                                   key).fetchone()
+                if row is not None:  # Wiersze dołączone już przez inny proces są pomijane
+                    snapshots.append(json.loads(row[0]))
+                    conn.execute("DELETE FROM process_metrics WHERE pid = ? AND started = ?", key)
+            retained = {"histograms": MetricsRegistry.merge_histograms(snapshots), "gauges": []}
+            conn.execute("INSERT INTO process_metrics (pid, started, snapshot) VALUES (?, ?, ?)",
+                         self.METRICS_RETAINED + (json.dumps(retained),))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+
+trade_store = TradeStore(app.config["TRADES_DB"])
+
+
+def sync_trades(portfolio: "Portfolio"):
+    """
+    Synchronizuje lokalną kopię transakcji portfela i jego aktywny plik z kursami ze wspólnym
+    magazynem. Przeładowywane są tylko symbole zmienione od ostatniej synchronizacji.
+    """
+    version, portfolio.exchange_rates_file = trade_store.state(portfolio.id)
+    if version == portfolio.loaded_version:
+        return
+    
+    changed, deleted_ids = ((None, None) if portfolio.loaded_version is None
+                            else trade_store.changes(portfolio.id, portfolio.loaded_version, version))
+    if deleted_ids is None:
+        # Operacje pieniężne nie mają wpisów w dzienniku symboli – przeładowujemy je przy każdej zmianie
+        # innej niż samo usunięcie transakcji
+        portfolio.set_cash(trade_store.load_cash(portfolio.id))
+    if changed is None:
+        portfolio.set_trades(trade_store.load(portfolio.id))
+        invalidate_results(portfolio)
+    elif deleted_ids is not None:
+        # Same usunięcia – oznaczamy wiersze, bez kopiowania ramki
+        invalidate_results(portfolio, portfolio.delete_ids(deleted_ids))
+    else:
+        trades = portfolio.live_trades()
+        unchanged = trades[~trades["Stock"].isin(changed)]
+        portfolio.set_trades(pd.concat([unchanged, trade_store.load(portfolio.id, changed)], ignore_index=True))
+        invalidate_results(portfolio, changed)
+    portfolio.loaded_version = version
+    portfolios.account(portfolio)
+
+
+# ----------------- Migawki -----------------
+# Wersja układu plików migawek – zmiana układu wymaga podbicia i obsługi starszych wersji
+SNAPSHOT_SCHEMA_VERSION = 1
+
+
+def _frame_arrays(prefix: str, df: pd.DataFrame) -> dict:
+    """
+    Zamienia DataFrame na tablice numpy bez obiektów Pythona (do zapisu z allow_pickle=False).
+    Kolumny liczbowe, logiczne i dat są zapisywane wprost, kwoty stałoprzecinkowe (pd.Int64) jako int64
+    z maską braków, pozostałe jako tekst z maską braków.
+    """
+    arrays = {f"{prefix}_columns": np.array([str(column) for column in df.columns], dtype=str)}
+    for i, column in enumerate(df.columns):
+        values = df[column]
+        if isinstance(values.dtype, pd.Int64Dtype):
+            arrays[f"{prefix}_{i}"] = values.to_numpy(dtype=np.int64, na_value=0)
+            arrays[f"{prefix}_{i}_missing"] = values.isna().to_numpy()
+        elif values.dtype.kind in "biufM":
+            arrays[f"{prefix}_{i}"] = values.to_numpy()
+        else:
+            missing = values.isna().to_numpy()
+            arrays[f"{prefix}_{i}"] = np.array(values.where(~missing, "").astype(str).tolist(), dtype=str)
+            arrays[f"{prefix}_{i}_missing"] = missing
+    return arrays
+
+
+def _frame_from_arrays(prefix: str, data) -> pd.DataFrame:
+    columns = data[f"{prefix}_columns"].tolist()
+    frame = {}
+    for i, column in enumerate(columns):
+        values = data[f"{prefix}_{i}"]
+        if f"{prefix}_{i}_missing" in data.files and values.dtype.kind == "i":
+            values = pd.arrays.IntegerArray(values, data[f"{prefix}_{i}_missing"])
+        elif f"{prefix}_{i}_missing" in data.files:
+            values = values.astype(object)
+            values[data[f"{prefix}_{i}_missing"]] = None
+        frame[column] = values
+    return pd.DataFrame(frame, columns=columns)
+
+
+def save_snapshot(file, trades_df: pd.DataFrame, processed_df: pd.DataFrame = None,
+                  warnings: list = None, rates_key: str = None, cash_df: pd.DataFrame = None):
+    """
+    Zapisuje migawkę zbioru transakcji (plik .npz) – opcjonalnie razem z przetworzonym stanem FIFO,
+    ostrzeżeniami (pary stock, komunikat) i odciskiem pliku kursów, z którym stan został policzony,
+    oraz z operacjami pieniężnymi portfela (cash_df, kolumny TradeStore.CASH_COLUMNS).
+    """
+    arrays = {"schema_version": np.array(SNAPSHOT_SCHEMA_VERSION)}
+    arrays.update(_frame_arrays("trades", trades_df[list(TradeStore.TRADE_COLUMNS)]))
+    if cash_df is not None:
+        arrays.update(_frame_arrays("cash", cash_df[list(TradeStore.CASH_COLUMNS)]))
+    if processed_df is not None:
+        arrays.update(_frame_arrays("processed", processed_df))
+        warnings = warnings or []
+        arrays["warnings"] = np.array([[stock, message] for stock, message in warnings], dtype=str).reshape(-1, 2)
+        arrays["rates_key"] = np.array(rates_key or "", dtype=str)
+    np.savez_compressed(file, **arrays)
+
+
+def load_snapshot(file) -> dict:
+    """
+    Wczytuje migawkę zapisaną przez save_snapshot. Zwraca słownik z kluczami trades, cash (pusty
+    DataFrame dla migawek bez operacji pieniężnych), processed (None, jeśli migawka nie zawiera
+    stanu FIFO), warnings i rates_key.
+    Niepoprawny plik lub nieobsługiwana wersja układu zgłaszają ValueError.
+    """
+    try:
+        data = np.load(file, allow_pickle=False)
+    except (OSError, EOFError, ValueError) as e:
+        raise ValueError(f"Nie można wczytać migawki: {e}")
+    if not isinstance(data, np.lib.npyio.NpzFile) or "schema_version" not in data.files:
+        raise ValueError("Plik nie jest migawką transakcji")
+    with data:
+        version = int(data["schema_version"])
+        if version != SNAPSHOT_SCHEMA_VERSION:
+            raise ValueError(f"Nieobsługiwana wersja migawki: {version}")
+        snapshot = {"trades": _frame_from_arrays("trades", data), "processed": None,
+                    "warnings": [], "rates_key": None}
+        snapshot["cash"] = (_frame_from_arrays("cash", data) if "cash_columns" in data.files
+                            else pd.DataFrame(columns=list(TradeStore.CASH_COLUMNS)))
+        if "processed_columns" in data.files:
+            snapshot["processed"] = _frame_from_arrays("processed", data)
+            snapshot["warnings"] = [tuple(warning) for warning in data["warnings"].tolist()]
+            snapshot["rates_key"] = str(data["rates_key"])
+    if list(snapshot["trades"].columns) != list(TradeStore.TRADE_COLUMNS):
+        raise ValueError("Migawka ma nieprawidłowe kolumny transakcji")
+    if list(snapshot["cash"].columns) != list(TradeStore.CASH_COLUMNS):
+        raise ValueError("Migawka ma nieprawidłowe kolumny operacji pieniężnych")
+    return snapshot
+
+
+def save_portfolio_snapshot(portfolio: "Portfolio", file):
+    """
+    Zapisuje migawkę transakcji i operacji pieniężnych portfela razem ze stanem FIFO z jego pamięci
+    podręcznej wyników.
+    """
+    entries = portfolio.results_cache["stocks"]
+    processed_df = (pd.concat([entry["frame"] for entry in entries.values()], ignore_index=True)
+                    if entries else pd.DataFrame())
+    warnings = [(stock, message) for stock, entry in entries.items() for message in entry["warnings"]]
+    save_snapshot(file, portfolio.live_trades(), processed_df, warnings, portfolio.results_cache["rates_key"],
+                  portfolio.cash)
+
+
+def snapshot_current(portfolio: "Portfolio", file, include_fifo: bool = False):
+    """
+    Zapisuje migawkę bieżącego zbioru transakcji i operacji pieniężnych portfela, a z include_fifo
+    także przetworzony stan FIFO.
+    """
+    if not include_fifo:
+        save_snapshot(file, portfolio.live_trades(), cash_df=portfolio.cash)
+        return
+    get_processed_results(portfolio)
+    save_portfolio_snapshot(portfolio, file)
+
+
+def restore_processed(portfolio: "Portfolio", snapshot: dict) -> bool:
+    """
+    Odtwarza wyniki portfela ze stanu FIFO zapisanego w migawce, jeśli został policzony z aktywnym
+    plikiem kursów i w reprezentacji kwot zgodnej z MONEY_MODE. Zwraca, czy wyniki odtworzono.
+    """
+    rates_key = rates_file_fingerprint(portfolio.exchange_rates_file)
+    processed_df = snapshot["processed"]
+    if (processed_df is None or snapshot["rates_key"] != rates_key
+            or is_fixed_point(processed_df) != (app.config["MONEY_MODE"] == "fixed")):
+        return False
+    portfolio.results_cache.clear()
+    portfolio.dirty_stocks.clear()
+    stock_entries = {}
+    build_stock_entries(processed_df, snapshot["warnings"], stock_entries)
+    store_results(portfolio, stock_entries, rates_key)
+    return True
+
+
+def restore_snapshot(portfolio: "Portfolio", file):
+    """
+    Przywraca zbiór transakcji portfela z migawki do wspólnego magazynu – razem z operacjami pieniężnymi,
+    które zastępują dotychczasowe (migawki bez operacji pieniężnych zostawiają portfel bez nich).
+    Jeśli migawka zawiera stan FIFO policzony z tym samym plikiem kursów i w tej samej reprezentacji
+    kwot (MONEY_MODE), wyniki są odtwarzane bez ponownego przetwarzania.
+    """
+    snapshot = load_snapshot(file)
+    trade_store.replace(portfolio.id, snapshot["trades"], snapshot["cash"])
+    sync_trades(portfolio)
+    restore_processed(portfolio, snapshot)
+
+
+def snapshots_dir(portfolio: "Portfolio") -> str:
+    """
+    Zwraca katalog migawek portfela (każdy portfel widzi tylko swoje migawki).
+    """
+    return os.path.join(app.config["SNAPSHOTS_DIR"], portfolio.id)
+
+
+def list_snapshots(portfolio: "Portfolio") -> list:
     """
-    Parsuje HTML i zwraca DataFrame z danymi transakcji.
-    Obsługuje różne formaty tabel poprzez wykrywanie nagłówków.
+    Zwraca nazwy zapisanych migawek portfela, od najnowszej.
     """
-    soup = BeautifulSoup(html_content, "html.parser")
-    parent_container = soup.find(
-        lambda tag: tag.name == "div" and tag.get("id") and re.search(r"^tblTransactions_.*Body$", tag.get("id"))
-    )
-    
-    # Jeśli nie znaleziono standardowego kontenera, szukamy alternatywnych struktur
-    if parent_container is None:
-        # Szukaj tabeli w całym dokumencie
-        trades_table = soup.find("table", {"class": "table-bordered"})
-        if trades_table is None:
-            raise ValueError("Nie znaleziono tabeli z transakcjami")
-    else:
-        # Znajdź tabelę z transakcjami w standardowym kontenerze
-        trades_table = parent_container.find("table")
-        if trades_table is None:
-            raise ValueError("Nie znaleziono tabeli z transakcjami")
+    directory = snapshots_dir(portfolio)
+    if not os.path.isdir(directory):
+        return []
+    return sorted((name for name in os.listdir(directory) if name.endswith(".npz")), reverse=True)
 
-    # Znajdź nagłówki kolumn, aby określić ich indeksy
-    column_indices = {}
-    headers = trades_table.find_all("th")
-    
-    if headers:
-        for i, header in enumerate(headers):
-            header_text = header.get_text(strip=True).lower()
-            if "symbol" in header_text:
-                column_indices["symbol"] = i
-            elif "date/time" in header_text:
-                column_indices["date_time"] = i
-            elif "quantity" in header_text:
-                column_indices["quantity"] = i
-            elif "proceeds" in header_text:
-                column_indices["proceeds"] = i
-            elif "comm/fee" in header_text:
-                column_indices["comm_fee"] = i
-            elif "basis" in header_text:
-                column_indices["basis"] = i
-            elif "account" in header_text:
-                column_indices["account"] = i
-            if all(key in column_indices for key in ["symbol", "date_time", "quantity", "proceeds", "comm_fee", "basis"]):
-                break
-    
-    # Jeśli nie znaleziono nagłówków, używamy domyślnego układu
-    if not column_indices:
-        # Domyślny układ (z pierwszego formatu)
-        column_indices = {
-            "symbol": 0,
-            "date_time": 1,
-            "quantity": 2,
-            "proceeds": 5,
-            "comm_fee": 6,
-            "basis": 7
-        }
 
-    data = []
-    current_currency = None
-    
-    # Sprawdź, czy mamy układ z numerem konta
-    has_account_column = "account" in column_indices
-    
-    for tr in trades_table.find_all("tr"):
-        cells = tr.find_all("td")
-        
-        # Wiersze z jedną komórką traktujemy jako nagłówek waluty
-        if len(cells) == 1:
-            text = cells[0].get_text(strip=True)
-            if text in ["EUR", "GBP", "USD", "PLN"]:
-                current_currency = text
-            continue
-        
-        # Sprawdź, czy wiersz zawiera dane transakcji (musi mieć wystarczająco kolumn)
-        if len(cells) >= 8:
-            try:
-                # Obsługa przypadku, gdy pierwsza kolumna to "Account"
-                if has_account_column:
-                    # Jeśli mamy wykrytą kolumnę account, używamy ją jako wskaźnik
-                    account_idx = column_indices.get("account", 0)
-                    symbol_idx = account_idx + 1  # Symbol jest następną kolumną po Account
-                    date_time_idx = account_idx + 2
-                    quantity_idx = account_idx + 3
-                    # Pozostałe indeksy dostosowujemy według układu
-                    proceeds_idx = account_idx + 6  # Zakładamy, że Proceeds jest 6 kolumn po Account
-                    comm_fee_idx = account_idx + 7
-                    basis_idx = account_idx + 8
-                else:
-                    # Pobierz dane z komórek zgodnie z wykrytymi indeksami kolumn
-                    symbol_idx = column_indices.get("symbol", 0)
-                    date_time_idx = column_indices.get("date_time", 1)
-                    quantity_idx = column_indices.get("quantity", 2)
-                    proceeds_idx = column_indices.get("proceeds", 5)
-                    comm_fee_idx = column_indices.get("comm_fee", 6)
-                    basis_idx = column_indices.get("basis", 7)
-                
-                # Zabezpieczenie przed wyjściem poza zakres
-                symbol_idx = min(symbol_idx, len(cells) - 1)
-                stock = cells[symbol_idx].get_text(strip=True)
-                
-                # Mapuj FB na META, ponieważ to ten sam stock
-                if stock == "FB":
-                    stock = "META"
-                
-                # Zabezpieczenie przed wyjściem poza zakres
-                date_time_idx = min(date_time_idx, len(cells) - 1)
-                quantity_idx = min(quantity_idx, len(cells) - 1)
-                proceeds_idx = min(proceeds_idx, len(cells) - 1)
-                comm_fee_idx = min(comm_fee_idx, len(cells) - 1)
-                basis_idx = min(basis_idx, len(cells) - 1)
-                
-                date_time = cells[date_time_idx].get_text(strip=True)
-                quantity = cells[quantity_idx].get_text(strip=True)
-                proceeds = cells[proceeds_idx].get_text(strip=True)
-                comm_fee = cells[comm_fee_idx].get_text(strip=True)
-                basis = cells[basis_idx].get_text(strip=True)
-
-                if not stock.startswith("Total") and not cells[0].get_text(strip=True).startswith("Total"):
-                    data.append({
-                        "waluty": current_currency,
-                        "Stock": stock,
-                        "Date/Time": date_time,
-                        "Quantity": quantity,
-                        "Proceeds": proceeds,
-                        "Comm/Fee": comm_fee,
-                        "Basis": basis
-                    })
-            except Exception as e:
-                # Logowanie błędu do konsoli - możesz zakomentować lub usunąć w produkcji
-                print(f"Błąd przetwarzania wiersza: {e}")
-                continue
-    
-    return pd.DataFrame(data)
+# ----------------- Portfele -----------------
+PORTFOLIO_COOKIE = "portfolio"
+PORTFOLIO_ID = re.compile(r"[A-Za-z0-9_-]{22,64}")
+# Przybliżony narzut pamięci jednego portfela poza DataFrame (liczony do budżetu pamięci)
+PORTFOLIO_OVERHEAD_BYTES = 16 * 1024
 
 
-def filter_and_convert_transactions(df_trades: pd.DataFrame) -> pd.DataFrame:
+class Portfolio:
     """
-    Filtrowanie wierszy oraz konwersja kolumn liczbowych i dat.
+    Stan jednego portfela w pamięci procesu: lokalna kopia transakcji ze wspólnego magazynu
+    i wersja magazynu, z której pochodzi, aktywny plik z kursami oraz wyniki w pamięci podręcznej.
+
+    Usunięte transakcje są tylko oznaczane w masce deleted (w czasie O(1) dzięki indeksowi id → pozycja),
+    a ramka jest zagęszczana, gdy oznaczonych wierszy jest dużo (compact).
     """
-    df_trades = df_trades[~((df_trades["Quantity"].str.strip() == "") &
-                             (df_trades["Stock"].str.lower().str.contains("total")))]
-    df_trades = df_trades[df_trades["Basis"].str.strip() != ""]
 
-    for col in ["Quantity", "Proceeds", "Comm/Fee", "Basis"]:
-        df_trades[col] = pd.to_numeric(df_trades[col].str.replace(",", ""), errors="coerce")
-    df_trades["Date/Time"] = pd.to_datetime(df_trades["Date/Time"], errors="coerce")
-    return df_trades
+    # Zagęszczanie, gdy usunięte wiersze stanowią taki ułamek ramki (i jest ich co najmniej COMPACT_MIN)
+    COMPACT_RATIO = 0.25
+    COMPACT_MIN = 1024
 
+    def __init__(self, portfolio_id: str):
+        self.id = portfolio_id
+        self.loaded_version = None
+        self.exchange_rates_file = DEFAULT_EXCHANGE_RATES_FILE
+        # Wersja lokalnej kopii – podbijana przy każdej zmianie, klucz pamięci podręcznej wyników
+        self.version = 0
+        self.results_cache = {}
+        self.dirty_stocks = set()  # Symbole, których wyniki trzeba przeliczyć przy następnym żądaniu
+        self.set_trades(pd.DataFrame(columns=TRADE_FRAME_COLUMNS))
+        self.set_cash(pd.DataFrame(columns=list(TradeStore.CASH_COLUMNS)))
 
-def load_exchange_rates(csv_path: str) -> pd.DataFrame:
+    def set_trades(self, trades: pd.DataFrame):
+        """
+        Ustawia lokalną kopię transakcji (bez usuniętych wierszy) i zeruje indeksy.
+        """
+        self.trades = trades.reset_index(drop=True)
+        self.deleted = np.zeros(len(self.trades), dtype=bool)
+        self.deleted_count = 0
+        self._id_index = None  # id → pozycja w trades, budowany przy pierwszym usunięciu
+        self._stock_positions = None  # symbol → pozycje w trades, budowane przy pierwszym użyciu
+        self.trades_nbytes = int(self.trades.memory_usage(deep=True).sum())
+
+    def set_cash(self, cash: pd.DataFrame):
+        """
+        Ustawia lokalną kopię operacji pieniężnych i porzuca policzone z nich wyniki.
+        """
+        self.cash = cash
+        self.cash_nbytes = int(cash.memory_usage(deep=True).sum())
+        self.results_cache.pop("cash", None)
+
+    def trade_count(self) -> int:
+        return len(self.trades) - self.deleted_count
+
+    def delete_ids(self, ids) -> set:
+        """
+        Oznacza transakcje o podanych id jako usunięte i zwraca ich symbole. Nieznane id są pomijane.
+        """
+        if self._id_index is None:
+            self._id_index = pd.Index(self.trades["id"].astype(np.int64))
+        positions = self._id_index.get_indexer(np.asarray(list(ids), dtype=np.int64))
+        positions = positions[positions >= 0]
+        positions = positions[~self.deleted[positions]]
+        self.deleted[positions] = True
+        self.deleted_count += len(positions)
+        stocks = set(self.trades["Stock"].values[positions])
+        if self.deleted_count >= max(self.COMPACT_MIN, self.COMPACT_RATIO * len(self.trades)):
+            self.compact()
+        return stocks
+
+    def compact(self):
+        """
+        Usuwa z ramki transakcje oznaczone jako usunięte.
+        """
+        if self.deleted_count:
+            with measure("portfolio_compact"):
+                self.set_trades(self.trades[~self.deleted])
+
+    def live_trades(self, stocks=None) -> pd.DataFrame:
+        """
+        Zwraca transakcje portfela bez usuniętych – wszystkie albo tylko podanych symboli
+        (wybierane po pozycjach symbolu, bez przeglądania całej ramki).
+        """
+        if stocks is None:
+            return self.trades[~self.deleted] if self.deleted_count else self.trades
+        if self._stock_positions is None:
+            self._stock_positions = self.trades.groupby("Stock").indices
+        positions = [self._stock_positions[stock] for stock in stocks if stock in self._stock_positions]
+        positions = np.sort(np.concatenate(positions)) if positions else np.array([], dtype=np.intp)
+        return self.trades.take(positions[~self.deleted[positions]])
+
+    def stock_batches(self, stocks, max_rows: int) -> list:
+        """
+        Dzieli symbole (podane albo wszystkie – stocks=None) na paczki do przetworzenia przez
+        process_all_trades, każda z co najwyżej max_rows transakcjami. Symbole po standaryzacji
+        (standardize_stock_symbols) tym samym symbolem trafiają do jednej paczki, bo FIFO liczone
+        jest per symbol. Symbol większy od limitu tworzy własną paczkę. Przy max_rows <= 0 albo gdy
+        wszystko mieści się w limicie zwraca jedną paczkę [stocks]; pusty zbiór symboli daje pustą listę.
+        """
+        if stocks is not None and not stocks:
+            return []
+        if max_rows <= 0 or self.trade_count() <= max_rows:
+            return [stocks]
+        if self._stock_positions is None:
+            self._stock_positions = self.trades.groupby("Stock").indices
+        names = list(self._stock_positions if stocks is None else stocks)
+        standardized = standardize_stock_symbols(pd.DataFrame({"Stock": names}))["Stock"]
+        groups = {}
+        for name, key in zip(names, standardized):
+            positions = self._stock_positions.get(name)
+            rows = 0 if positions is None else int(len(positions) - self.deleted[positions].sum())
+            symbols, count = groups.get(key, (set(), 0))
+            symbols.add(name)
+            groups[key] = (symbols, count + rows)
+        batches = []
+        batch, batch_rows = set(), 0
+        for symbols, rows in groups.values():
+            if batch and batch_rows + rows > max_rows:
+                batches.append(batch)
+                batch, batch_rows = set(), 0
+            batch |= symbols
+            batch_rows += rows
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def nbytes(self) -> int:
+        """
+        Szacowana zajętość pamięci portfela: transakcje, operacje pieniężne, przetworzone ramki per stock
+        i stały narzut.
+        """
+        entries = self.results_cache.get("stocks", {})
+        return (PORTFOLIO_OVERHEAD_BYTES + self.trades_nbytes + self.cash_nbytes
+                + sum(entry["nbytes"] for entry in entries.values()))
+
+
+class PortfolioCache:
     """
-    Ładuje kursy walut z pliku CSV i formatuje daty.
+    Portfele w pamięci procesu, od najdawniej do najświeżej używanego, z łącznym budżetem pamięci.
+    Po przekroczeniu budżetu najdawniej używane portfele są usuwane z pamięci – ich transakcje są we
+    wspólnym magazynie, a aktualny stan FIFO jest zrzucany do migawki w spill_dir (plik
+    <portfel>-<wersja magazynu>.npz), z której portfel jest odtwarzany bez ponownego przeliczania.
+    Portfel, którego zajętość jest właśnie liczona, nie jest usuwany.
     """
-    df_kursy = pd.read_csv(csv_path, delimiter=",")
-    df_kursy["data"] = pd.to_datetime(df_kursy["data"], format="%Y%m%d", errors="coerce")
-    return df_kursy.sort_values("data")
 
+    def __init__(self, budget_bytes: int, spill_dir: str):
+        self.budget_bytes = budget_bytes
+        self.spill_dir = spill_dir
+        self._lock = threading.Lock()
+        self._portfolios = OrderedDict()
+        self._sizes = {}
+
+    def get(self, portfolio_id: str) -> Portfolio:
+        """
+        Zwraca portfel zsynchronizowany ze wspólnym magazynem: z pamięci (oznaczając go jako ostatnio
+        używany) albo wczytany z magazynu i zrzuconej migawki. Nowy portfel jest wczytywany poza
+        blokadą i trafia do pamięci dopiero po wczytaniu – inne wątki nie widzą go w połowie wczytywania.
+        """
+        with self._lock:
+            portfolio = self._portfolios.get(portfolio_id)
+            if portfolio is not None:
+                self._portfolios.move_to_end(portfolio_id)
+        if portfolio is None:
+            loaded = Portfolio(portfolio_id)
+            sync_trades(loaded)
+            self._restore_spilled(loaded)
+            with self._lock:
+                # Ten sam portfel mógł w tym czasie wczytać inny wątek – używamy jego kopii
+                portfolio = self._portfolios.get(portfolio_id)
+                if portfolio is None:
+                    self._portfolios[portfolio_id] = portfolio = loaded
+                    self._sizes[portfolio_id] = PORTFOLIO_OVERHEAD_BYTES
+                else:
+                    self._portfolios.move_to_end(portfolio_id)
+            if portfolio is loaded:
+                self.account(portfolio)
+                return portfolio
+        sync_trades(portfolio)
+        return portfolio
+
+    def account(self, portfolio: Portfolio):
+        """
+        Aktualizuje zajętość pamięci portfela i usuwa najdawniej używane portfele ponad budżet.
+        """
+        with self._lock:
+            if portfolio.id not in self._portfolios:
+                return
+            self._sizes[portfolio.id] = portfolio.nbytes()
+            total = sum(self._sizes.values())
+            evicted = []
+            for portfolio_id in list(self._portfolios):
+                if total <= self.budget_bytes:
+                    break
+                if portfolio_id != portfolio.id:
+                    evicted.append(self._portfolios.pop(portfolio_id))
+                    total -= self._sizes.pop(portfolio_id)
+            metrics.set("rozliczenie_portfolios", len(self._portfolios))
+            metrics.set("rozliczenie_portfolio_bytes", total)
+            metrics.set("rozliczenie_trades", sum(item.trade_count() for item in self._portfolios.values()))
+            metrics.set("rozliczenie_stocks", sum(len(item.results_cache.get("stocks", {}))
+                                                  for item in self._portfolios.values()))
+        for old in evicted:
+            metrics.observe("rozliczenie_evicted_portfolio_bytes", old.nbytes())
+            self._spill(old)
+
+    def _spill_files(self, portfolio_id: str) -> list:
+        if not self.spill_dir or not os.path.isdir(self.spill_dir):
+            return []
+        return [name for name in os.listdir(self.spill_dir)
+                if name.endswith(".npz") and name[:-len(".npz")].rsplit("-", 1)[0] == portfolio_id]
+
+    def _spill(self, portfolio: Portfolio):
+        """
+        Zrzuca aktualny stan FIFO portfela do migawki. Portfele bez transakcji lub z nieaktualnymi
+        wynikami są tylko usuwane z pamięci.
+        """
+        cache = portfolio.results_cache
+        if not self.spill_dir or not portfolio.trade_count() or cache.get("version") != portfolio.version:
+            return
+        os.makedirs(self.spill_dir, exist_ok=True)
+        name = f"{portfolio.id}-{portfolio.loaded_version}.npz"
+        path = os.path.join(self.spill_dir, name)
+        with measure("portfolio_spill"):
+            with open(f"{path}.{os.getpid()}.tmp", "wb") as f:
+                save_portfolio_snapshot(portfolio, f)
+            os.replace(f"{path}.{os.getpid()}.tmp", path)
+        for old in self._spill_files(portfolio.id):
+            if old != name:
+                os.remove(os.path.join(self.spill_dir, old))
 
-def merge_exchange_rates(df_trades: pd.DataFrame, df_kursy: pd.DataFrame) -> pd.DataFrame:
+    def _restore_spilled(self, portfolio: Portfolio):
+        """
+        Odtwarza wyniki portfela z migawki zrzuconej dla jego bieżącej wersji w magazynie.
+        Zrzucone migawki portfela są potem usuwane (starsze wersje i tak są już nieaktualne).
+        """
+        for name in self._spill_files(portfolio.id):
+            path = os.path.join(self.spill_dir, name)
+            if name == f"{portfolio.id}-{portfolio.loaded_version}.npz":
+                try:
+                    with measure("portfolio_restore"):
+                        restore_processed(portfolio, load_snapshot(path))
+                except ValueError as e:
+                    print(f"Nie można odtworzyć portfela z migawki {name}: {e}")
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # Usunięta już przez inny proces
+
+
+portfolios = PortfolioCache(int(app.config["PORTFOLIO_MEMORY_MB"] * 1024 * 1024), app.config["PORTFOLIO_SPILL_DIR"])
+
+
+def current_portfolio() -> Portfolio:
     """
-    Łączy transakcje z kursami walut, wykorzystując datę transakcji pomniejszoną o jeden dzień.
+    Zwraca portfel sesji bieżącego żądania (identyfikator w ciasteczku portfolio), zakładając nowy,
+    jeśli żądanie nie ma poprawnego identyfikatora. Portfel jest synchronizowany ze wspólnym
+    magazynem raz na żądanie.
     """
-    df_trades["match_date"] = df_trades["Date/Time"] - timedelta(days=1)
-    df_trades = df_trades.sort_values("match_date")
-    df_trades = pd.merge_asof(df_trades, df_kursy, left_on="match_date", right_on="data", direction="backward")
-    df_trades.rename(columns={"data": "Kurs_Date"}, inplace=True)
-    df_trades.drop(columns=["match_date"], inplace=True)
-    return df_trades
+    if "portfolio" not in g:
+        portfolio_id = request.cookies.get(PORTFOLIO_COOKIE, "")
+        if not PORTFOLIO_ID.fullmatch(portfolio_id):
+            portfolio_id = secrets.token_urlsafe(24)
+            g.new_portfolio = True
+        g.portfolio = portfolios.get(portfolio_id)
+    return g.portfolio
 
 
-def apply_currency_conversion(df_trades: pd.DataFrame) -> pd.DataFrame:
+# ----------------- Metryki -----------------
+class MetricsRegistry:
     """
-    Przelicza wartości transakcji zgodnie z odpowiednim kursem waluty.
+    Metryki procesu (histogramy i wskaźniki) bez zewnętrznych zależności. Każdy proces gunicorna
+    zbiera własne metryki i okresowo zapisuje je do wspólnego magazynu; /metrics skleja metryki
+    wszystkich procesów w format tekstowy Prometheusa. Histogramy są sumowane (także z procesów,
+    które już się zakończyły), wskaźniki są raportowane per proces (etykieta pid).
     """
 
-    def wybierz_kurs(row):
-        waluta = row["waluty"]
-        if waluta == "USD":
-            return row.get("1 USD")
-        elif waluta == "EUR":
-            return row.get("1 EUR")
-        elif waluta == "GBP":
-            return row.get("1 GBP")
-        elif waluta == "PLN":
-            return 1.0
-        return None
+    # nazwa -> (typ, opis, przedziały histogramu)
+    DEFINITIONS = {
+        "rozliczenie_stage_seconds": (
+            "histogram", "Czas etapów przetwarzania w sekundach",
+            (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+        ),
+        "rozliczenie_stage_rows": (
+            "histogram", "Liczba wierszy przetwarzanych przez etap",
+            (1, 10, 100, 1000, 10000, 100000, 1000000)
+        ),
+        "rozliczenie_stock_group_rows": (
+            "histogram", "Liczba transakcji w przeliczanych grupach stocków",
+            (1, 10, 100, 1000, 10000, 100000)
+        ),
+        "rozliczenie_dataframe_bytes": (
+            "gauge", "Zajętość pamięci DataFrame w bajtach (memory_usage deep=True)", None
+        ),
+        "rozliczenie_evicted_portfolio_bytes": (
+            "histogram", "Szacowana zajętość pamięci portfeli usuniętych z pamięci procesu",
+            (1 << 16, 1 << 20, 1 << 24, 1 << 26, 1 << 28, 1 << 30)
+        ),
+        "rozliczenie_portfolios": ("gauge", "Liczba portfeli w pamięci procesu", None),
+        "rozliczenie_portfolio_bytes": ("gauge", "Szacowana zajętość pamięci portfeli w bajtach", None),
+        "rozliczenie_trades": ("gauge", "Liczba transakcji w portfelach w pamięci procesu", None),
+        "rozliczenie_stocks": ("gauge", "Liczba stocków w wynikach portfeli w pamięci procesu", None),
+    }
 
-    df_trades["rate"] = df_trades.apply(wybierz_kurs, axis=1)
-    df_trades["Basis_converted"] = df_trades["Basis"] * df_trades["rate"]
-    df_trades["Comm/Fee_converted"] = df_trades["Comm/Fee"] * df_trades["rate"]
-    df_trades["Proceeds_converted"] = df_trades["Proceeds"] * df_trades["rate"]
-    df_trades = df_trades.drop(columns=["1 USD", "1 EUR", "1 GBP"], errors="ignore")
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}  # (nazwa, etykiety) -> [liczniki przedziałów, suma, liczba]
+        self.gauges = {}  # (nazwa, etykiety) -> wartość
+        self.flushed_at = 0.0
+        self.dirty = False
 
-    desired_order = ["id", "waluty", "Stock", "Date/Time", "Quantity", "Proceeds", "Proceeds_converted",
-                     "Comm/Fee", "Basis", "Kurs_Date", "rate", "Basis_converted", "Comm/Fee_converted", 
-                     "shares_in_possession"]
-    return df_trades[desired_order]
+    def observe(self, name: str, value: float, **labels):
+        buckets = self.DEFINITIONS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            counts, total, count = self.histograms.get(key, ([0] * len(buckets), 0.0, 0))
+            index = int(np.searchsorted(buckets, value, side="left"))
+            if index < len(buckets):
+                counts[index] += 1
+            self.histograms[key] = (counts, total + value, count + 1)
+            self.dirty = True
 
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = float(value)
+            self.dirty = True
 
-def allocate_fifo(df_trades: pd.DataFrame) -> pd.DataFrame:
-    """
-    Alokacja FIFO – przypisuje transakcjom kupna i sprzedaży wykorzystanie 
-    zgodnie z kolejnością transakcji. Obsługuje zarówno pozycje długie 
-    jak i krótką sprzedaż (short selling).
-    """
-    df_trades["fifo_allocated"] = 0.0
-    df_trades["fifo_used"] = False
-    df_trades["year_allocated"] = None
-    df_trades["shares_in_possession"] = 0.0  # Nowa kolumna do śledzenia posiadanych akcji
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "histograms": [[name, dict(labels), list(counts), total, count]
+                               for (name, labels), (counts, total, count) in self.histograms.items()],
+                "gauges": [[name, dict(labels), value] for (name, labels), value in self.gauges.items()],
+            }
 
-    for stock, group in df_trades.groupby("Stock"):
-        # Sortujemy transakcje chronologicznie
-        group = group.sort_values("Date/Time").copy()
-        
-        # Tworzymy oddzielne kolejki dla transakcji kupna i sprzedaży
-        buy_queue = []  # Format: (index, ilość pozostała do alokacji, oryginalna ilość)
-        sell_queue = []  # Format: (index, ilość pozostała do alokacji, oryginalna ilość)
+    @staticmethod
+    def merge_histograms(snapshots: list) -> list:
+        """
+        Sumuje histogramy z migawek metryk procesów; zwraca je w układzie pola histograms migawki.
+        """
+        histograms = {}
+        for snapshot in snapshots:
+            for name, labels, counts, total, count in snapshot["histograms"]:
+                key = (name, tuple(sorted(labels.items())))
+                merged = histograms.setdefault(key, [[0] * len(counts), 0.0, 0])
+                merged[0] = [a + b for a, b in zip(merged[0], counts)]
+                merged[1] += total
+                merged[2] += count
+        return [[name, dict(labels), counts, total, count]
+                for (name, labels), (counts, total, count) in histograms.items()]
+
+    @classmethod
+    def render(cls, snapshots: dict) -> str:
+        """
+        Skleja migawki metryk procesów ({(pid, started): snapshot}) w format tekstowy Prometheusa.
+        """
+        histograms = {
+            (name, tuple(sorted(labels.items()))): (counts, total, count)
+            for name, labels, counts, total, count in cls.merge_histograms(list(snapshots.values()))
+        }
+        gauges = {}
+        for (pid, _), snapshot in snapshots.items():
+            for name, labels, value in snapshot["gauges"]:
+                gauges[(name, tuple(sorted({**labels, "pid": str(pid)}.items())))] = value
         
-        # Zmienna do śledzenia aktualnie posiadanych akcji dla danego stocku
-        current_possession = 0.0
+        def format_labels(labels):
+            if not labels:
+                return ""
+            escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+                       for _, value in labels)
+            return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
         
-        # Przetwarzamy transakcje chronologicznie
-        for idx, row in group.iterrows():
-            quantity = row["Quantity"]
-            transaction_year = row["Date/Time"].year
-            
-            # Aktualizujemy stan posiadania akcji
-            current_possession += quantity
-            # Zapisujemy aktualny stan posiadania dla tej transakcji
-            df_trades.at[idx, "shares_in_possession"] = current_possession
-            
-            if quantity > 0:  # Transakcja kupna
-                # Najpierw próbujemy pokryć istniejące pozycje krótkie
-                remaining_buy = quantity
-                
-                while sell_queue and remaining_buy > 0:
-                    sell_idx, sell_remaining, sell_original = sell_queue[0]
-                    
-                    # Określamy ile można alokować
-                    to_allocate = min(remaining_buy, sell_remaining)
-                    
-                    # Aktualizujemy stan transakcji sprzedaży
-                    sell_queue[0] = (sell_idx, sell_remaining - to_allocate, sell_original)
-                    
-                    # Aktualizujemy flagi dla transakcji sprzedaży
-                    df_trades.at[sell_idx, "fifo_allocated"] += to_allocate
-                    if sell_remaining == to_allocate:  # Całkowicie pokryta
-                        df_trades.at[sell_idx, "fifo_used"] = True
-                        sell_queue.pop(0)  # Usuwamy z kolejki
-                    
-                    # Aktualizujemy flagi dla transakcji kupna
-                    df_trades.at[idx, "fifo_allocated"] += to_allocate
-                    
-                    # Przypisanie roku dla celów podatkowych
-                    # Dla transakcji sprzedaży (short selling)
-                    if pd.isna(df_trades.at[sell_idx, "year_allocated"]):
-                        df_trades.at[sell_idx, "year_allocated"] = {transaction_year: to_allocate}
-                    elif isinstance(df_trades.at[sell_idx, "year_allocated"], dict):
-                        if transaction_year in df_trades.at[sell_idx, "year_allocated"]:
-                            df_trades.at[sell_idx, "year_allocated"][transaction_year] += to_allocate
-                        else:
-                            df_trades.at[sell_idx, "year_allocated"][transaction_year] = to_allocate
-                    else:
-                        # Konwersja z pojedynczego roku na słownik
-                        old_year = df_trades.at[sell_idx, "year_allocated"]
-                        old_allocated = sell_original - sell_remaining + to_allocate
-                        df_trades.at[sell_idx, "year_allocated"] = {
-                            old_year: old_allocated - to_allocate,
-                            transaction_year: to_allocate
-                        }
-                    
-                    # Dla transakcji kupna
-                    if pd.isna(df_trades.at[idx, "year_allocated"]):
-                        df_trades.at[idx, "year_allocated"] = {transaction_year: to_allocate}
-                    elif isinstance(df_trades.at[idx, "year_allocated"], dict):
-                        if transaction_year in df_trades.at[idx, "year_allocated"]:
-                            df_trades.at[idx, "year_allocated"][transaction_year] += to_allocate
-                        else:
-                            df_trades.at[idx, "year_allocated"][transaction_year] = to_allocate
-                    else:
-                        # Konwersja z pojedynczego roku na słownik
-                        df_trades.at[idx, "year_allocated"] = {transaction_year: to_allocate}
-                    
-                    remaining_buy -= to_allocate
-                
-                # Jeśli zostało coś niezaalokowanego, dodajemy do kolejki kupna
-                if remaining_buy > 0:
-                    buy_queue.append((idx, remaining_buy, quantity))
-                
-                # Jeśli całkowicie zaalokowane
-                if remaining_buy == 0:
-                    df_trades.at[idx, "fifo_used"] = True
-                
-            else:  # Transakcja sprzedaży (quantity < 0)
-                # Absolutna wartość ilości sprzedaży
-                abs_quantity = -quantity
-                remaining_sell = abs_quantity
-                
-                # Najpierw próbujemy pokryć istniejące pozycje długie
-                while buy_queue and remaining_sell > 0:
-                    buy_idx, buy_remaining, buy_original = buy_queue[0]
-                    
-                    # Określamy ile można alokować
-                    to_allocate = min(remaining_sell, buy_remaining)
-                    
-                    # Aktualizujemy stan transakcji kupna
-                    buy_queue[0] = (buy_idx, buy_remaining - to_allocate, buy_original)
-                    
-                    # Aktualizujemy flagi dla transakcji kupna
-                    df_trades.at[buy_idx, "fifo_allocated"] += to_allocate
-                    if buy_remaining == to_allocate:  # Całkowicie pokryta
-                        df_trades.at[buy_idx, "fifo_used"] = True
-                        buy_queue.pop(0)  # Usuwamy z kolejki
-                    
-                    # Aktualizujemy flagi dla transakcji sprzedaży
-                    df_trades.at[idx, "fifo_allocated"] += to_allocate
-                    
-                    # Przypisanie roku dla celów podatkowych
-                    # Dla transakcji sprzedaży
-                    if pd.isna(df_trades.at[idx, "year_allocated"]):
-                        df_trades.at[idx, "year_allocated"] = {transaction_year: to_allocate}
-                    elif isinstance(df_trades.at[idx, "year_allocated"], dict):
-                        if transaction_year in df_trades.at[idx, "year_allocated"]:
-                            df_trades.at[idx, "year_allocated"][transaction_year] += to_allocate
-                        else:
-                            df_trades.at[idx, "year_allocated"][transaction_year] = to_allocate
-                    else:
-                        # Konwersja z pojedynczego roku na słownik
-                        df_trades.at[idx, "year_allocated"] = {transaction_year: to_allocate}
-                    
-                    # Dla transakcji kupna
-                    if pd.isna(df_trades.at[buy_idx, "year_allocated"]):
-                        df_trades.at[buy_idx, "year_allocated"] = {transaction_year: to_allocate}
-                    elif isinstance(df_trades.at[buy_idx, "year_allocated"], dict):
-                        if transaction_year in df_trades.at[buy_idx, "year_allocated"]:
-                            df_trades.at[buy_idx, "year_allocated"][transaction_year] += to_allocate
-                        else:
-                            df_trades.at[buy_idx, "year_allocated"][transaction_year] = to_allocate
-                    else:
-                        # Konwersja z pojedynczego roku na słownik
-                        old_year = df_trades.at[buy_idx, "year_allocated"]
-                        old_allocated = buy_original - buy_remaining + to_allocate
-                        df_trades.at[buy_idx, "year_allocated"] = {
-                            old_year: old_allocated - to_allocate,
-                            transaction_year: to_allocate
-                        }
-                    
-                    remaining_sell -= to_allocate
-                
-                # Jeśli zostało coś niezaalokowanego, dodajemy do kolejki sprzedaży (short selling)
-                if remaining_sell > 0:
-                    sell_queue.append((idx, remaining_sell, abs_quantity))
-                
-                # Jeśli całkowicie zaalokowane
-                if remaining_sell == 0:
-                    df_trades.at[idx, "fifo_used"] = True
-    
-    return df_trades
+        lines = []
+        for name, (metric_type, description, buckets) in cls.DEFINITIONS.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if metric_type == "histogram":
+                for (metric, labels), (counts, total, count) in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = np.cumsum(counts)
+                    for bound, value in zip(buckets, cumulative):
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {value}")
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {total}")
+                    lines.append(f"{name}_count{format_labels(labels)} {count}")
+            else:
+                for (metric, labels), value in sorted(gauges.items()):
+                    if metric == name:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
 
 
-def summarize_transactions(group: pd.DataFrame) -> pd.DataFrame:
+metrics = MetricsRegistry()
+
+
+@contextmanager
+def measure(stage: str):
     """
-    Generuje podsumowanie transakcji dla danego symbolu akcji.
-    Uwzględnia proporcjonalne wykorzystanie transakcji w zależności od 
-    wartości fifo_allocated.
+    Mierzy czas wykonania bloku i zapisuje go w histogramie etapów.
     """
-    total_sold_sum = 0.0
-    proceeds_sum = 0.0
-    proceeds_conv_sum = 0.0
-    comm_fee_sum = 0.0
-    basis_sum = 0.0
-    basis_conv_sum = 0.0
-    comm_fee_conv_sum = 0.0
-    
-    # Nowe sumy dla transakcji sprzedaży (quantity < 0)
-    proceeds_sum_sell = 0.0
-    proceeds_conv_sum_sell = 0.0
-    comm_fee_sum_sell = 0.0
-    basis_sum_sell = 0.0
-    basis_conv_sum_sell = 0.0
-    comm_fee_conv_sum_sell = 0.0
-
-    for idx, row in group.iterrows():
-        # Pomijamy transakcje bez alokacji
-        if row["fifo_allocated"] <= 0:
-            continue
-            
-        # Obliczamy proporcję wykorzystania transakcji
-        proportion = row["fifo_allocated"] / abs(row["Quantity"]) if row["Quantity"] != 0 else 0
-        
-        # Dodajemy wartości do sum, niezależnie od typu transakcji
-        if row["Quantity"] < 0:  # Transakcja sprzedaży
-            total_sold_sum += row["fifo_allocated"]  # Używamy dokładnej wartości alokowanej
-            
-            # Dodajemy wartości do sum dla transakcji sprzedaży
-            proceeds_sum_sell += row["Proceeds"] * proportion
-            proceeds_conv_sum_sell += row["Proceeds_converted"] * proportion
-            comm_fee_sum_sell += row["Comm/Fee"] * proportion
-            basis_sum_sell += row["Basis"] * proportion
-            basis_conv_sum_sell += row["Basis_converted"] * proportion
-            comm_fee_conv_sum_sell += row["Comm/Fee_converted"] * proportion
-        
-        # Wszystkie transakcje (zarówno kupna jak i sprzedaży) dodają wartości do wszystkich sum
-        proceeds_sum += row["Proceeds"] * proportion
-        proceeds_conv_sum += row["Proceeds_converted"] * proportion
-        comm_fee_sum += row["Comm/Fee"] * proportion
-        basis_sum += row["Basis"] * proportion
-        basis_conv_sum += row["Basis_converted"] * proportion
-        comm_fee_conv_sum += row["Comm/Fee_converted"] * proportion
-
-    summary = pd.DataFrame({
-        "Stock": [group["Stock"].iloc[0]],
-        "Total_Sold": [total_sold_sum],
-        "Proceeds sum": [proceeds_sum],
-        "Proceeds_converted sum": [proceeds_conv_sum],
-        "Comm/Fee sum": [comm_fee_sum],
-        "Basis sum": [basis_sum],
-        "Basis_converted sum": [basis_conv_sum],
-        "Comm/Fee_converted sum": [comm_fee_conv_sum],
-        # Dodajemy nowe kolumny dla transakcji sprzedaży
-        "Proceeds sum (quantity < 0)": [proceeds_sum_sell],
-        "Proceeds_converted sum (quantity < 0)": [proceeds_conv_sum_sell],
-        "Comm/Fee sum (quantity < 0)": [comm_fee_sum_sell],
-        "Basis sum (quantity < 0)": [basis_sum_sell],
-        "Basis_converted sum (quantity < 0)": [basis_conv_sum_sell],
-        "Comm/Fee_converted sum (quantity < 0)": [comm_fee_conv_sum_sell]
-    })
-    return summary
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe("rozliczenie_stage_seconds", time.perf_counter() - start, stage=stage)
 
 
-def summarize_transactions_by_year(group: pd.DataFrame) -> pd.DataFrame:
+def flush_metrics(force: bool = False):
     """
-    Generuje podsumowanie transakcji dla danego symbolu akcji z podziałem na lata.
+    Zapisuje metryki procesu do wspólnego magazynu (nie częściej niż co METRICS_FLUSH_SECONDS).
     """
-    # Zbieramy wszystkie lata, w których wystąpiły transakcje
-    years = set()
-    
-    for idx, row in group.iterrows():
-        if isinstance(row["year_allocated"], dict):
-            # Dla transakcji z przypisanym słownikiem lat
-            for year in row["year_allocated"].keys():
-                years.add(year)
-        elif pd.notna(row["year_allocated"]):
-            # Dla transakcji z pojedynczym przypisanym rokiem
-            years.add(int(row["year_allocated"]))
-    
-    years = sorted(years)
-    
-    # Przygotowujemy DataFrame na podsumowanie roczne
-    year_summary_data = []
-    
-    for year in years:
-        total_sold_year = 0.0
-        proceeds_year = 0.0
-        proceeds_conv_year = 0.0
-        comm_fee_year = 0.0
-        basis_year = 0.0
-        basis_conv_year = 0.0
-        comm_fee_conv_year = 0.0
-        
-        # Nowe sumy dla transakcji sprzedaży (quantity < 0)
-        proceeds_year_sell = 0.0
-        proceeds_conv_year_sell = 0.0
-        comm_fee_year_sell = 0.0
-        basis_year_sell = 0.0
-        basis_conv_year_sell = 0.0
-        comm_fee_conv_year_sell = 0.0
-        
-        for idx, row in group.iterrows():
-            # Pomijamy transakcje bez alokacji dla danego roku
-            year_allocation = row["year_allocated"]
-            if not isinstance(year_allocation, dict) or year not in year_allocation:
-                if not (pd.notna(year_allocation) and year_allocation == year):
-                    continue
-            
-            # Obliczamy proporcję alokowaną do danego roku
-            if isinstance(year_allocation, dict) and year in year_allocation:
-                allocated_to_year = year_allocation[year]
-                total_fraction = allocated_to_year / abs(row["Quantity"]) if row["Quantity"] != 0 else 0
-                
-                # Zliczamy sprzedane akcje
-                if row["Quantity"] < 0:  # Transakcja sprzedaży
-                    total_sold_year += allocated_to_year
-                    
-                    # Dodajemy wartości do sum dla transakcji sprzedaży
-                    proceeds_year_sell += row["Proceeds"] * total_fraction
-                    proceeds_conv_year_sell += row["Proceeds_converted"] * total_fraction
-                    comm_fee_year_sell += row["Comm/Fee"] * total_fraction
-                    basis_year_sell += row["Basis"] * total_fraction
-                    basis_conv_year_sell += row["Basis_converted"] * total_fraction
-                    comm_fee_conv_year_sell += row["Comm/Fee_converted"] * total_fraction
-                
-                # Wszystkie transakcje dodają wartości do wszystkich sum
-                proceeds_year += row["Proceeds"] * total_fraction
-                proceeds_conv_year += row["Proceeds_converted"] * total_fraction
-                comm_fee_year += row["Comm/Fee"] * total_fraction
-                basis_year += row["Basis"] * total_fraction
-                basis_conv_year += row["Basis_converted"] * total_fraction
-                comm_fee_conv_year += row["Comm/Fee_converted"] * total_fraction
-            elif pd.notna(year_allocation) and year_allocation == year:
-                # Dla zgodności wstecz - obsługa prostego przypisania roku
-                if row["Quantity"] < 0:  # Transakcja sprzedaży
-                    total_sold_year += -row["Quantity"]
-                    
-                    # Dodajemy wartości do sum dla transakcji sprzedaży
-                    proceeds_year_sell += row["Proceeds"]
-                    proceeds_conv_year_sell += row["Proceeds_converted"]
-                    comm_fee_year_sell += row["Comm/Fee"]
-                    basis_year_sell += row["Basis"]
-                    basis_conv_year_sell += row["Basis_converted"]
-                    comm_fee_conv_year_sell += row["Comm/Fee_converted"]
-                
-                # Dodajemy wszystkie wartości (niezależnie od typu transakcji)
-                proceeds_year += row["Proceeds"]
-                proceeds_conv_year += row["Proceeds_converted"]
-                comm_fee_year += row["Comm/Fee"]
-                basis_year += row["Basis"]
-                basis_conv_year += row["Basis_converted"]
-                comm_fee_conv_year += row["Comm/Fee_converted"]
-        
-        year_summary_data.append({
-            "Year": year,
-            "Stock": group["Stock"].iloc[0],
-            "Total_Sold": total_sold_year,
-            "Proceeds sum": proceeds_year,
-            "Proceeds_converted sum": proceeds_conv_year,
-            "Comm/Fee sum": comm_fee_year,
-            "Basis sum": basis_year,
-            "Basis_converted sum": basis_conv_year,
-            "Comm/Fee_converted sum": comm_fee_conv_year,
-            # Dodajemy nowe kolumny dla transakcji sprzedaży
-            "Proceeds sum (quantity < 0)": proceeds_year_sell,
-            "Proceeds_converted sum (quantity < 0)": proceeds_conv_year_sell,
-            "Comm/Fee sum (quantity < 0)": comm_fee_year_sell,
-            "Basis sum (quantity < 0)": basis_year_sell,
-            "Basis_converted sum (quantity < 0)": basis_conv_year_sell,
-            "Comm/Fee_converted sum (quantity < 0)": comm_fee_conv_year_sell
-        })
-    
-    if year_summary_data:
-        return pd.DataFrame(year_summary_data)
-    else:
-        return pd.DataFrame()
+    now = time.monotonic()
+    if not metrics.dirty or (not force and now - metrics.flushed_at < app.config["METRICS_FLUSH_SECONDS"]):
+        return
+    metrics.dirty = False
+    metrics.flushed_at = now
+    trade_store.save_metrics(os.getpid(), process_start_token(os.getpid()), metrics.snapshot())
 
 
-def highlight_fifo(row):
+def process_start_token(pid: int) -> str:
     """
-    Zwraca stylizację wiersza - zaznacza na żółto transakcje, które zostały wykorzystane.
+    Identyfikator uruchomienia procesu: identyfikator rozruchu systemu i czas startu procesu
+    (z /proc, w taktach zegara od rozruchu). Odróżnia proces od późniejszego procesu z tym samym pid
+    (restart procesu roboczego, ponowne uruchomienie kontenera). Pusty, gdy system nie udostępnia /proc.
     """
-    return ['background-color: yellow' if row["fifo_used"] else '' for _ in row.index]
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as f:
+            boot_id = f.read().strip()
+        with open(f"/proc/{pid}/stat") as f:
+            # Nazwa procesu (pole 2) może zawierać spacje – pola liczymy od ostatniego nawiasu
+            start_time = f.read().rsplit(")", 1)[1].split()[19]
+    except (OSError, IndexError):
+        return ""
+    return f"{boot_id}:{start_time}"
 
 
-def check_negative_fifo(df_stock: pd.DataFrame) -> bool:
+def process_alive(pid: int, started: str = "") -> bool:
     """
-    Sprawdza, czy dla danego stocku, idąc chronologicznie, bieżąca suma Quantity spada poniżej zera.
-    Jeśli tak – zwraca True, co oznacza, że brakuje transakcji.
+    Sprawdza, czy działa proces o podanym pid, a jeśli podano started (process_start_token zapisany
+    przez ten proces) – czy to nadal ten sam proces, a nie inny, który dostał jego pid.
     """
-    df_stock = df_stock.sort_values("Date/Time")
-    running_total = 0.0
-    for qty in df_stock["Quantity"]:
-        running_total += qty
-        if running_total < 0:
-            return True
-    return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return not started or process_start_token(pid) in ("", started)
 
 
-def standardize_stock_symbols(df: pd.DataFrame) -> pd.DataFrame:
+# ----------------- Profilowanie -----------------
+def profile_token_valid() -> bool:
     """
-    Standaryzuje symbole akcji - zamienia FB na META
+    Sprawdza, czy żądanie ma poprawny token profilowania (parametr profile lub nagłówek X-Profile-Token).
     """
-    df.loc[df["Stock"] == "FB", "Stock"] = "META"
-    return df
+    expected = app.config["PROFILE_TOKEN"]
+    given = request.headers.get("X-Profile-Token") or request.args.get("profile", "")
+    return bool(expected) and hmac.compare_digest(given.encode(), expected.encode())
 
 
-def process_all_trades() -> pd.DataFrame:
+def save_profile(profiler: cProfile.Profile, name: str) -> str:
     """
-    Przetwarza globalny DataFrame transakcji pełnym potokiem: filtrowanie, łączenie z kursami,
-    konwersja walut oraz alokacja FIFO.
+    Zapisuje profil żądania: plik .prof (pełne drzewo wywołań, np. dla snakeviz lub pstats)
+    oraz raport tekstowy z top-N funkcji według czasu łącznego i własnego. Zwraca nazwę profilu.
     """
-    global all_trades_df, exchange_rates_file
-    if all_trades_df.empty:
-        return pd.DataFrame()
-    df = all_trades_df.copy()
-    
-    # Upewniamy się, że kolumna shares_in_possession istnieje
-    if "shares_in_possession" not in df.columns:
-        df["shares_in_possession"] = 0.0
+    os.makedirs(app.config["PROFILES_DIR"], exist_ok=True)
+    profile_name = f"{datetime.now():%Y%m%d-%H%M%S-%f}-{name}-{os.getpid()}"
+    path = os.path.join(app.config["PROFILES_DIR"], profile_name)
+    profiler.dump_stats(path + ".prof")
     
-    # Standaryzujemy symbole akcji
-    df = standardize_stock_symbols(df)
-        
-    df = filter_and_convert_transactions(df)
-    df_kursy = load_exchange_rates(exchange_rates_file)
-    df = merge_exchange_rates(df, df_kursy)
-    df = apply_currency_conversion(df)
-    df = allocate_fifo(df)
-    return df
+    report = io.StringIO()
+    # Token nie trafia do raportu
+    query = "&".join(f"{key}={value}" for key, value in request.args.items(multi=True) if key != "profile")
+    report.write(f"{request.method} {request.path}{'?' + query if query else ''}\n\n")
+    stats = pstats.Stats(profiler, stream=report).strip_dirs()
+    for order in ("cumulative", "tottime"):
+        stats.sort_stats(order).print_stats(app.config["PROFILE_TOP"])
+    stats.sort_stats("cumulative").print_callees(app.config["PROFILE_TOP"])
+    with open(path + ".txt", "w", encoding="utf-8") as f:
+        f.write(report.getvalue())
+    return profile_name
+
+
+def profiled(view):
+    """
+    Dekorator trasy: z poprawnym tokenem profilowania wykonuje żądanie pod cProfile i zapisuje profil.
+    Parametr cold=1 porzuca najpierw wyniki z pamięci podręcznej, żeby profil objął cały potok.
+    Odpowiedzi strumieniowane (eksport CSV i Parquet) są przy profilowaniu składane w całości,
+    żeby profil objął też generowanie treści.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not profile_token_valid():
+            return view(*args, **kwargs)
+        if request.args.get("cold") == "1":
+            invalidate_results(current_portfolio())
+        profiler = cProfile.Profile()
+        response = app.make_response(profiler.runcall(view, *args, **kwargs))
+        if response.is_streamed:
+            # Treść generatora powstaje dopiero przy wysyłaniu – po runcall profil byłby pusty
+            response.set_data(profiler.runcall(lambda: b"".join(response.iter_encoded())))
+        response.headers["X-Profile"] = save_profile(profiler, view.__name__)
+        return response
+    return wrapper
 
 
 # ----------------- Trasy Flask -----------------
+@app.after_request
+def after_request(response):
+    if g.get("new_portfolio"):
+        response.set_cookie(PORTFOLIO_COOKIE, g.portfolio.id, max_age=365 * 24 * 3600, httponly=True, samesite="Lax")
+    flush_metrics()
+    return response
+
+
 @app.route("/", methods=["GET", "POST"])
+@profiled
 def index():
-    global all_trades_df, next_transaction_id, exchange_rates_file
-
+    portfolio = current_portfolio()
     if request.method == "POST":
         # Obsługa wgrywania pliku CSV z kursami walut
         if "exchange_rates_file" in request.files and request.files["exchange_rates_file"].filename:
             file = request.files["exchange_rates_file"]
-            if file.filename.endswith('.csv'):
-                # Zapisz plik tymczasowo
-                temp_path = "uploaded_" + file.filename
-                file.save(temp_path)
-                
-                try:
-                    # Sprawdź czy plik ma prawidłowy format
-                    test_df = pd.read_csv(temp_path, delimiter=",")
-                    required_columns = ["data", "1 USD", "1 EUR", "1 GBP"]
-                    if all(col in test_df.columns for col in required_columns):
-                        exchange_rates_file = temp_path
-                    else:
-                        os.remove(temp_path)
-                        return "Plik CSV musi zawierać kolumny: data, 1 USD, 1 EUR, 1 GBP", 400
-                except Exception as e:
-                    os.remove(temp_path)
-                    return f"Błąd podczas przetwarzania pliku CSV: {str(e)}", 400
-                
-            else:
+            if not file.filename.endswith('.csv'):
                 return "Plik musi mieć rozszerzenie .csv", 400
+            # Plik jest sprawdzany i kompilowany raz, do tabeli binarnej nazwanej skrótem zawartości
+            try:
+                with measure("rates_compile"):
+                    path = compile_exchange_rates(file.read())
+            except Exception as e:
+                return f"Błąd podczas przetwarzania pliku CSV: {str(e)}", 400
+            trade_store.add_rates_file(portfolio.id, path, file.filename)
+            trade_store.set_exchange_rates_file(portfolio.id, path)
             
             return redirect(url_for("index"))
         
-        # Obsługa wgrywania plików HTML
+        # Obsługa wgrywania plików HTML – przetwarzanie w tle, strona wyników śledzi postęp zadania
         elif "files" in request.files and any(file.filename for file in request.files.getlist("files")):
-            files = request.files.getlist("files")
-            df_list = []
-            for file in files:
-                if file.filename:
-                    html_content = file.read().decode("utf-8")
-                    try:
-                        df = parse_html_transactions(html_content)
-                    except ValueError as e:
-                        return str(e), 400
-                    df_list.append(df)
-            if df_list:
-                df_all = pd.concat(df_list, ignore_index=True)
-                # Dodaj unikalny identyfikator do każdej transakcji
-                df_all["id"] = range(next_transaction_id, next_transaction_id + len(df_all))
-                next_transaction_id += len(df_all)
-                if not all_trades_df.empty:
-                    all_trades_df = pd.concat([all_trades_df, df_all], ignore_index=True)
-                else:
-                    all_trades_df = df_all.copy()
-            return redirect(url_for("index"))
+            files = [file for file in request.files.getlist("files") if file.filename]
+            with measure("upload_enqueue"):
+                job_id = enqueue_upload(portfolio, files)
+            return redirect(url_for("index", upload=job_id))
         # Obsługa dodawania transakcji z formularza wbudowanego w stronę wyników
         elif request.form.get("form_type") == "add_transaction":
             waluty = request.form.get("waluty")
@@ -696,375 +3291,299 @@ def index():
                 return "Nieprawidłowy format daty.", 400
 
             new_row = {
-                "id": next_transaction_id,
                 "waluty": waluty,
                 "Stock": stock,
-                "Date/Time": dt,
+                # Zapisujemy datę w układzie wyciągów IBKR
+                "Date/Time": dt.strftime("%Y-%m-%d, %H:%M:%S"),
                 "Quantity": quantity,
                 "Proceeds": proceeds,
                 "Comm/Fee": comm_fee,
-                "Basis": basis,
-                "shares_in_possession": 0.0  # Inicjalizujemy nową kolumnę
+                "Basis": basis
             }
-            next_transaction_id += 1
-            new_df = pd.DataFrame([new_row])
-            if all_trades_df.empty:
-                all_trades_df = new_df.copy()
-            else:
-                # Upewniamy się, że kolumna shares_in_possession istnieje w all_trades_df
-                if "shares_in_possession" not in all_trades_df.columns:
-                    all_trades_df["shares_in_possession"] = 0.0
-                all_trades_df = pd.concat([all_trades_df, new_df], ignore_index=True)
+            trade_store.insert(portfolio.id, pd.DataFrame([new_row]))
             return redirect(url_for("index"))
 
     # Metoda GET – przetwarzamy transakcje i wyświetlamy wyniki
-    processed_df = process_all_trades()
-    stock_results = {}
-    yearly_summaries = {}  # Dodajemy słownik na podsumowania roczne
+    results = get_processed_results(portfolio)
     
-    if not processed_df.empty:
-        # Dodajemy obliczenie sum dla wszystkich akcji
-        all_summary = pd.DataFrame({
-            "Stock": ["All"],
-            "Total_Sold": [0.0],
-            "Proceeds sum": [0.0],
-            "Proceeds_converted sum": [0.0],
-            "Comm/Fee sum": [0.0],
-            "Basis sum": [0.0],
-            "Basis_converted sum": [0.0],
-            "Comm/Fee_converted sum": [0.0],
-            # Dodajemy nowe kolumny dla transakcji sprzedaży
-            "Proceeds sum (quantity < 0)": [0.0],
-            "Proceeds_converted sum (quantity < 0)": [0.0],
-            "Comm/Fee sum (quantity < 0)": [0.0],
-            "Basis sum (quantity < 0)": [0.0],
-            "Basis_converted sum (quantity < 0)": [0.0],
-            "Comm/Fee_converted sum (quantity < 0)": [0.0]
-        })
-        
-        # Przygotowanie słownika na roczne podsumowanie dla zakładki "All"
-        all_years_summary = {}
-        
-        for stock, group in processed_df.groupby("Stock"):
-            group_sorted = group.sort_values("Date/Time").copy()
-            # Sprawdź, czy występuje ujemna suma transakcji dla danego stocku
-            has_issue = check_negative_fifo(group_sorted)
-            display_name = stock + (" !" if has_issue else "")
-            group_sorted["Action"] = group_sorted["id"].apply(
-                lambda x: f'<a href="{url_for("remove_transaction", transaction_id=x)}">Usuń</a>'
-            )
-            
-            # Zmiana formatowania liczb w tabeli transakcji
-            styled_group = group_sorted.style.apply(highlight_fifo, axis=1).format({
-                col: lambda x: f"{x:.6f}" if isinstance(x, (float, int)) else x 
-                for col in group_sorted.select_dtypes(include=['float64', 'int64']).columns
-            })
-            
-            transactions_html = styled_group.hide_index().render()
-            summary = summarize_transactions(group_sorted)
-            
-            # Zmiana formatowania liczb w tabeli podsumowania
-            summary_html = summary.to_html(
-                classes="table table-bordered", 
-                index=False, 
-                border=0,
-                float_format=lambda x: f"{x:.6f}"
-            )
-            
-            # Dodajemy podsumowanie roczne
-            yearly_summary = summarize_transactions_by_year(group_sorted)
-            if not yearly_summary.empty:
-                yearly_summary_html = yearly_summary.to_html(
-                    classes="table table-bordered", 
-                    index=False, 
-                    border=0,
-                    float_format=lambda x: f"{x:.6f}" if isinstance(x, (float, int)) else x
-                )
-                yearly_summaries[stock] = yearly_summary_html
-                
-                # Dodajemy dane do podsumowania rocznego dla zakładki "All"
-                for _, row in yearly_summary.iterrows():
-                    year = row["Year"]
-                    if year not in all_years_summary:
-                        all_years_summary[year] = {
-                            "Total_Sold": 0.0,
-                            "Proceeds sum": 0.0,
-                            "Proceeds_converted sum": 0.0,
-                            "Comm/Fee sum": 0.0,
-                            "Basis sum": 0.0,
-                            "Basis_converted sum": 0.0,
-                            "Comm/Fee_converted sum": 0.0,
-                            # Dodajemy nowe kolumny
-                            "Proceeds sum (quantity < 0)": 0.0,
-                            "Proceeds_converted sum (quantity < 0)": 0.0,
-                            "Comm/Fee sum (quantity < 0)": 0.0,
-                            "Basis sum (quantity < 0)": 0.0, 
-                            "Basis_converted sum (quantity < 0)": 0.0,
-                            "Comm/Fee_converted sum (quantity < 0)": 0.0
-                        }
-                    all_years_summary[year]["Total_Sold"] += row["Total_Sold"]
-                    all_years_summary[year]["Proceeds sum"] += row["Proceeds sum"]
-                    all_years_summary[year]["Proceeds_converted sum"] += row["Proceeds_converted sum"]
-                    all_years_summary[year]["Comm/Fee sum"] += row["Comm/Fee sum"]
-                    all_years_summary[year]["Basis sum"] += row["Basis sum"]
-                    all_years_summary[year]["Basis_converted sum"] += row["Basis_converted sum"]
-                    all_years_summary[year]["Comm/Fee_converted sum"] += row["Comm/Fee_converted sum"]
-                    # Dodajemy aktualizację nowych kolumn
-                    all_years_summary[year]["Proceeds sum (quantity < 0)"] += row["Proceeds sum (quantity < 0)"]
-                    all_years_summary[year]["Proceeds_converted sum (quantity < 0)"] += row["Proceeds_converted sum (quantity < 0)"]
-                    all_years_summary[year]["Comm/Fee sum (quantity < 0)"] += row["Comm/Fee sum (quantity < 0)"]
-                    all_years_summary[year]["Basis sum (quantity < 0)"] += row["Basis sum (quantity < 0)"]
-                    all_years_summary[year]["Basis_converted sum (quantity < 0)"] += row["Basis_converted sum (quantity < 0)"]
-                    all_years_summary[year]["Comm/Fee_converted sum (quantity < 0)"] += row["Comm/Fee_converted sum (quantity < 0)"]
-            
-            stock_results[stock] = {
-                "display_name": display_name,
-                "transactions": transactions_html,
-                "summary": summary_html
-            }
-            
-            # Aktualizujemy sumy dla zakładki "All"
-            if not summary.empty:
-                all_summary["Proceeds_converted sum"] += summary["Proceeds_converted sum"].values[0]
-                all_summary["Basis_converted sum"] += summary["Basis_converted sum"].values[0]
-                all_summary["Comm/Fee_converted sum"] += summary["Comm/Fee_converted sum"].values[0]
-                # Dodajemy aktualizację nowych kolumn
-                all_summary["Proceeds sum (quantity < 0)"] += summary["Proceeds sum (quantity < 0)"].values[0]
-                all_summary["Proceeds_converted sum (quantity < 0)"] += summary["Proceeds_converted sum (quantity < 0)"].values[0]
-                all_summary["Comm/Fee sum (quantity < 0)"] += summary["Comm/Fee sum (quantity < 0)"].values[0]
-                all_summary["Basis sum (quantity < 0)"] += summary["Basis sum (quantity < 0)"].values[0]
-                all_summary["Basis_converted sum (quantity < 0)"] += summary["Basis_converted sum (quantity < 0)"].values[0]
-                all_summary["Comm/Fee_converted sum (quantity < 0)"] += summary["Comm/Fee_converted sum (quantity < 0)"].values[0]
-        
-        # Tworzymy DataFrame z podsumowaniem rocznym dla zakładki "All"
-        if all_years_summary:
-            all_yearly_data = []
-            for year, data in sorted(all_years_summary.items()):
-                row_data = {"Year": year}
-                row_data.update(data)
-                all_yearly_data.append(row_data)
-            
-            all_yearly_df = pd.DataFrame(all_yearly_data)
-            all_yearly_html = all_yearly_df.to_html(
-                classes="table table-bordered", 
-                index=False, 
-                border=0,
-                float_format=lambda x: f"{x:.6f}" if isinstance(x, (float, int)) else x
-            )
-            yearly_summaries["all"] = all_yearly_html
-        
-        # Dodajemy zakładkę "All" do wyników
-        # Tworzymy nowy DataFrame tylko z potrzebnymi kolumnami
-        all_summary_display = pd.DataFrame({
-            "Proceeds_converted sum": [all_summary["Proceeds_converted sum"].values[0]],
-            "Basis_converted sum": [all_summary["Basis_converted sum"].values[0]],
-            "Comm/Fee_converted sum": [all_summary["Comm/Fee_converted sum"].values[0]],
-            # Dodajemy nowe kolumny
-            "Proceeds_converted sum (quantity < 0)": [all_summary["Proceeds_converted sum (quantity < 0)"].values[0]],
-            "Basis_converted sum (quantity < 0)": [all_summary["Basis_converted sum (quantity < 0)"].values[0]],
-            "Comm/Fee_converted sum (quantity < 0)": [all_summary["Comm/Fee_converted sum (quantity < 0)"].values[0]]
-        })
-        
-        # Zmiana formatowania liczb w tabeli podsumowania "All"
-        all_summary_html = all_summary_display.to_html(
-            classes="table table-bordered", 
-            index=False, 
-            border=0,
-            float_format=lambda x: f"{x:.6f}"
-        )
-        
-        stock_results["all"] = {
-            "display_name": "All",
-            "transactions": "",  # Puste, bo nie pokazujemy transakcji w tej zakładce
-            "summary": all_summary_html
-        }
+    # Dodaj informację o obecnie używanym pliku z kursami i wcześniej wgranych tabelach
+    rates_files = trade_store.rates_files(portfolio.id)
+    current_rates_file = rates_files.get(portfolio.exchange_rates_file,
+                                         os.path.basename(portfolio.exchange_rates_file))
+    
+    # Waluty dostępne w formularzu dodawania transakcji: PLN oraz wszystkie z pliku kursów
+    currencies = sorted(set(get_exchange_rates(portfolio.exchange_rates_file).currencies) | {"PLN"})
     
-    # Dodaj informację o obecnie używanym pliku z kursami
-    current_rates_file = os.path.basename(exchange_rates_file)
+    with measure("index_render"):
+        return render_template("results.html", stock_results=results["stock_results"], 
+                               yearly_summaries=results["yearly_summaries"], current_rates_file=current_rates_file,
+                               warnings=results["warnings"], cash_summary=results["cash_summary"],
+                               currencies=currencies, snapshots=list_snapshots(portfolio),
+                               upload_job=request.args.get("upload"), rates_files=rates_files,
+                               active_rates_file=portfolio.exchange_rates_file,
+                               default_rates_file=DEFAULT_EXCHANGE_RATES_FILE)
+
+
+@app.route("/stock/<path:stock>")
+def stock_tab(stock):
+    """
+    Zwraca fragment HTML z tabelami jednego stocku – ładowany, gdy użytkownik otworzy jego zakładkę.
+    Parametry page i per_page stronicują tabelę transakcji (per_page=0 – wszystkie transakcje).
+    """
+    portfolio = current_portfolio()
+    entry = get_processed_results(portfolio)["stocks"].get(stock)
+    if entry is None:
+        return "Nie znaleziono transakcji dla podanego stocku", 404
     
-    return render_template("results.html", stock_results=stock_results, 
-                           yearly_summaries=yearly_summaries, current_rates_file=current_rates_file)
+    page = request.args.get("page", 1, type=int)
+    per_page = request.args.get("per_page", app.config["TAB_PAGE_SIZE"], type=int)
+    with measure("stock_tab_render"):
+        tab = render_stock_tab(entry, page, per_page)
+        currencies = sorted(set(get_exchange_rates(portfolio.exchange_rates_file).currencies) | {"PLN"})
+        return render_template("stock_tab.html", key=stock, tab=tab, currencies=currencies)
+
+
+@app.route("/uploads/<job_id>")
+def upload_status(job_id):
+    """
+    Postęp zadania wgrywania (JSON): state (queued, running, done, failed), files_total, files_done,
+    rows_parsed i errors (przy stanie done – wiersze transakcji, których nie udało się odczytać).
+    Zadanie, którego proces się zakończył, jest zgłaszane jako nieudane.
+    """
+    job = trade_store.load_upload_job(current_portfolio().id, job_id)
+    if job is None:
+        return jsonify({"error": "Nie znaleziono zadania wgrywania"}), 404
+    pid, started = (job.pop(field) for field in TradeStore.UPLOAD_JOB_OWNER)
+    if job["state"] in ("queued", "running") and not process_alive(pid, started):
+        job["state"] = "failed"
+        job["errors"].append("Proces przetwarzający wgrane pliki został zakończony")
+    return jsonify(job)
 
 
 @app.route("/remove-transaction/<int:transaction_id>")
 def remove_transaction(transaction_id):
-    global all_trades_df
-    if not all_trades_df.empty:
-        all_trades_df = all_trades_df[all_trades_df["id"] != transaction_id]
+    trade_store.delete(current_portfolio().id, transaction_id)
     return redirect(url_for("index"))
 
 
+def frame_records(df: pd.DataFrame) -> list:
+    """
+    Zamienia podsumowanie na listę słowników gotową do JSON (kwoty jako float, braki jako null).
+    """
+    df = money_to_float(df).astype(object)
+    return df.where(df.notna(), None).to_dict("records")
+
+
+@app.route("/api/transactions", methods=["POST"])
+def transactions_batch():
+    """
+    Wsadowe zmiany transakcji portfela (JSON): {"insert": [transakcje], "update": [{"id": ..., pola}],
+    "delete": [id, ...]}. Wszystkie zmiany są sprawdzane przed zapisem i zapisywane razem (jedna wersja),
+    wyniki są przeliczane raz na paczkę. Odpowiedź zawiera id dodanych transakcji oraz podsumowania
+    (summary, yearly) zmienionych symboli – null dla symboli, które nie mają już transakcji.
+    Błędy walidacji zwracają 400 z listą errors, odwołania do nieistniejących id – 404.
+    """
+    portfolio = current_portfolio()
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({"error": "Oczekiwano obiektu JSON z polami insert, update, delete"}), 400
+
+    with measure("api_validate"):
+        inserts, insert_errors = validate_transactions(payload.get("insert") or [])
+        updates, update_errors = validate_transactions(payload.get("update") or [], partial=True)
+        delete_ids = payload.get("delete") or []
+        if not isinstance(delete_ids, list):
+            delete_ids = [delete_ids]
+        delete_errors = [{"index": index, "field": "id", "error": "nieprawidłowy identyfikator"}
+                         for index, trade_id in enumerate(delete_ids)
+                         if not isinstance(trade_id, int) or isinstance(trade_id, bool)]
+    errors = ([dict(error, section="insert") for error in insert_errors]
+              + [dict(error, section="update") for error in update_errors]
+              + [dict(error, section="delete") for error in delete_errors])
+    if errors:
+        return jsonify({"errors": errors}), 400
+
+    try:
+        ids, changed = trade_store.apply_batch(portfolio.id, delete_ids, updates, inserts)
+    except KeyError as e:
+        return jsonify({"error": "Nie znaleziono transakcji", "missing": e.args[0]}), 404
+
+    sync_trades(portfolio)
+    results = get_processed_results(portfolio)
+    summaries = {}
+    for stock in sorted(changed):
+        entry = results["stocks"].get(stock)
+        summaries[stock] = None if entry is None else {
+            "summary": frame_records(entry["summary"].drop(columns="Stock", errors="ignore")),
+            "yearly": frame_records(entry["yearly"].drop(columns="Stock", errors="ignore")),
+        }
+    return jsonify({"inserted_ids": ids, "deleted": len(set(delete_ids)), "updated": int(updates["id"].nunique()),
+                    "version": portfolio.loaded_version, "summaries": summaries})
+
+
 @app.route("/refresh")
 def refresh():
     """
-    Odświeża aplikację - czyści wszystkie załadowane transakcje.
+    Odświeża aplikację - czyści wszystkie transakcje portfela.
     """
-    global all_trades_df, next_transaction_id, exchange_rates_file
-    all_trades_df = pd.DataFrame(
-        columns=["id", "waluty", "Stock", "Date/Time", "Quantity", "Proceeds", "Comm/Fee", "Basis", "shares_in_possession"]
-    )
-    next_transaction_id = 1
-    # Resetowanie do domyślnego pliku z kursami
-    if exchange_rates_file != "kursy.csv" and os.path.exists(exchange_rates_file):
-        if exchange_rates_file.startswith("uploaded_"):
-            os.remove(exchange_rates_file)
-    exchange_rates_file = "kursy.csv"
+    # Resetowanie do domyślnego pliku z kursami – wgrane tabele kursów zostają do ponownego wyboru
+    trade_store.clear(current_portfolio().id)
+    return redirect(url_for("index"))
+
+
+@app.route("/rates", methods=["POST"])
+def select_rates():
+    """
+    Przełącza portfel na domyślny plik kursów albo jedną z wcześniej wgranych tabel (bez ponownego parsowania).
+    """
+    portfolio = current_portfolio()
+    path = request.form.get("path", "")
+    if path != DEFAULT_EXCHANGE_RATES_FILE and path not in trade_store.rates_files(portfolio.id):
+        return "Nie znaleziono tabeli kursów", 404
+    trade_store.set_exchange_rates_file(portfolio.id, path)
     return redirect(url_for("index"))
 
 
 @app.route("/export-csv")
+@app.route("/export")
+@profiled
 def export_csv():
     """
-    Eksportuje dane do pliku CSV. W wierszach są akcje, a w kolumnach wartości:
+    Eksportuje dane do pliku CSV (domyślnie), Parquet lub XLSX – format wybiera parametr format.
+    W wierszach są akcje, a w kolumnach wartości:
     Proceeds sum, Proceeds_converted sum, Comm/Fee sum, Comm/Fee_converted sum
     oraz dodatkowe kolumny zawierające sumy dla transakcji sprzedaży.
     
-    Dane są rozdzielone na lata - każda akcja ma wiersz podsumowujący oraz osobne wiersze dla każdego roku
+    Dane są rozdzielone na lata - każda akcja ma wiersz podsumowujący oraz osobne wiersze dla każdego roku.
+    CSV i Parquet są wysyłane strumieniowo, w miarę składania kolejnych wierszy.
     """
-    global all_trades_df
-    if all_trades_df.empty:
+    export_format = request.args.get("format", "csv")
+    if export_format not in ("csv", "parquet", "xlsx"):
+        return "Nieobsługiwany format eksportu (dostępne: csv, parquet, xlsx)", 400
+    
+    portfolio = current_portfolio()
+    if not portfolio.trade_count():
         return "Brak danych do eksportu", 400
     
-    # Przetwarzamy dane jak w głównej funkcji
-    processed_df = process_all_trades()
+    # Korzystamy z wyników przetworzonych dla strony głównej (pamięć podręczna)
+    results = get_processed_results(portfolio)
     
-    if processed_df.empty:
+    if not results["summaries"]:
         return "Brak przetworzonych danych do eksportu", 400
     
-    # Tworzymy DataFrame dla eksportu, zawierający podsumowania dla każdej akcji
-    export_data = []
-    
-    # Słownik do przechowywania sum dla podsumowania "All"
-    all_yearly_data = {}
-    
-    for stock, group in processed_df.groupby("Stock"):
-        # Dodajemy wiersz z ogólnym podsumowaniem dla danej akcji
-        summary = summarize_transactions(group)
-        if not summary.empty:
-            export_data.append({
-                "Stock": stock,
-                "Year": "Total",  # Oznaczamy, że to wiersz z całkowitą sumą
-                "Proceeds sum": summary["Proceeds sum"].values[0],
-                "Proceeds_converted sum": summary["Proceeds_converted sum"].values[0],
-                "Comm/Fee sum": summary["Comm/Fee sum"].values[0],
-                "Comm/Fee_converted sum": summary["Comm/Fee_converted sum"].values[0],
-                # Dodajemy nowe kolumny
-                "Proceeds sum (quantity < 0)": summary["Proceeds sum (quantity < 0)"].values[0],
-                "Proceeds_converted sum (quantity < 0)": summary["Proceeds_converted sum (quantity < 0)"].values[0],
-                "Comm/Fee sum (quantity < 0)": summary["Comm/Fee sum (quantity < 0)"].values[0],
-                "Basis sum (quantity < 0)": summary["Basis sum (quantity < 0)"].values[0],
-                "Basis_converted sum (quantity < 0)": summary["Basis_converted sum (quantity < 0)"].values[0],
-                "Comm/Fee_converted sum (quantity < 0)": summary["Comm/Fee_converted sum (quantity < 0)"].values[0]
-            })
-        
-        # Dodajemy wiersze z podsumowaniem dla każdego roku
-        yearly_summary = summarize_transactions_by_year(group)
-        if not yearly_summary.empty:
-            for _, year_row in yearly_summary.iterrows():
-                year = year_row["Year"]
-                
-                # Dodajemy dane roczne do eksportu
-                export_data.append({
-                    "Stock": stock,
-                    "Year": year,
-                    "Proceeds sum": year_row["Proceeds sum"],
-                    "Proceeds_converted sum": year_row["Proceeds_converted sum"],
-                    "Comm/Fee sum": year_row["Comm/Fee sum"],
-                    "Comm/Fee_converted sum": year_row["Comm/Fee_converted sum"],
-                    # Dodajemy nowe kolumny
-                    "Proceeds sum (quantity < 0)": year_row["Proceeds sum (quantity < 0)"],
-                    "Proceeds_converted sum (quantity < 0)": year_row["Proceeds_converted sum (quantity < 0)"],
-                    "Comm/Fee sum (quantity < 0)": year_row["Comm/Fee sum (quantity < 0)"],
-                    "Basis sum (quantity < 0)": year_row["Basis sum (quantity < 0)"],
-                    "Basis_converted sum (quantity < 0)": year_row["Basis_converted sum (quantity < 0)"],
-                    "Comm/Fee_converted sum (quantity < 0)": year_row["Comm/Fee_converted sum (quantity < 0)"]
-                })
-                
-                # Aktualizujemy sumy dla "All" w podziale na lata
-                if year not in all_yearly_data:
-                    all_yearly_data[year] = {
-                        "Proceeds sum": 0,
-                        "Proceeds_converted sum": 0,
-                        "Comm/Fee sum": 0,
-                        "Comm/Fee_converted sum": 0,
-                        # Dodajemy nowe kolumny
-                        "Proceeds sum (quantity < 0)": 0,
-                        "Proceeds_converted sum (quantity < 0)": 0,
-                        "Comm/Fee sum (quantity < 0)": 0,
-                        "Basis sum (quantity < 0)": 0,
-                        "Basis_converted sum (quantity < 0)": 0,
-                        "Comm/Fee_converted sum (quantity < 0)": 0
-                    }
-                all_yearly_data[year]["Proceeds sum"] += year_row["Proceeds sum"]
-                all_yearly_data[year]["Proceeds_converted sum"] += year_row["Proceeds_converted sum"]
-                all_yearly_data[year]["Comm/Fee sum"] += year_row["Comm/Fee sum"]
-                all_yearly_data[year]["Comm/Fee_converted sum"] += year_row["Comm/Fee_converted sum"]
-                # Dodajemy aktualizację nowych kolumn
-                all_yearly_data[year]["Proceeds sum (quantity < 0)"] += year_row["Proceeds sum (quantity < 0)"]
-                all_yearly_data[year]["Proceeds_converted sum (quantity < 0)"] += year_row["Proceeds_converted sum (quantity < 0)"]
-                all_yearly_data[year]["Comm/Fee sum (quantity < 0)"] += year_row["Comm/Fee sum (quantity < 0)"]
-                all_yearly_data[year]["Basis sum (quantity < 0)"] += year_row["Basis sum (quantity < 0)"]
-                all_yearly_data[year]["Basis_converted sum (quantity < 0)"] += year_row["Basis_converted sum (quantity < 0)"]
-                all_yearly_data[year]["Comm/Fee_converted sum (quantity < 0)"] += year_row["Comm/Fee_converted sum (quantity < 0)"]
-    
-    # Dodajemy wiersz "All" z sumą wszystkich wartości
-    all_row = {
-        "Stock": "All",
-        "Year": "Total",
-        "Proceeds sum": sum(row["Proceeds sum"] for row in export_data if row["Year"] == "Total"),
-        "Proceeds_converted sum": sum(row["Proceeds_converted sum"] for row in export_data if row["Year"] == "Total"),
-        "Comm/Fee sum": sum(row["Comm/Fee sum"] for row in export_data if row["Year"] == "Total"),
-        "Comm/Fee_converted sum": sum(row["Comm/Fee_converted sum"] for row in export_data if row["Year"] == "Total"),
-        # Dodajemy nowe kolumny
-        "Proceeds sum (quantity < 0)": sum(row["Proceeds sum (quantity < 0)"] for row in export_data if row["Year"] == "Total"),
-        "Proceeds_converted sum (quantity < 0)": sum(row["Proceeds_converted sum (quantity < 0)"] for row in export_data if row["Year"] == "Total"),
-        "Comm/Fee sum (quantity < 0)": sum(row["Comm/Fee sum (quantity < 0)"] for row in export_data if row["Year"] == "Total"),
-        "Basis sum (quantity < 0)": sum(row["Basis sum (quantity < 0)"] for row in export_data if row["Year"] == "Total"),
-        "Basis_converted sum (quantity < 0)": sum(row["Basis_converted sum (quantity < 0)"] for row in export_data if row["Year"] == "Total"),
-        "Comm/Fee_converted sum (quantity < 0)": sum(row["Comm/Fee_converted sum (quantity < 0)"] for row in export_data if row["Year"] == "Total")
-    }
-    export_data.append(all_row)
-    
-    # Dodajemy wiersze "All" dla każdego roku
-    for year, year_data in sorted(all_yearly_data.items()):
-        export_data.append({
-            "Stock": "All",
-            "Year": year,
-            "Proceeds sum": year_data["Proceeds sum"],
-            "Proceeds_converted sum": year_data["Proceeds_converted sum"],
-            "Comm/Fee sum": year_data["Comm/Fee sum"],
-            "Comm/Fee_converted sum": year_data["Comm/Fee_converted sum"],
-            # Dodajemy nowe kolumny
-            "Proceeds sum (quantity < 0)": year_data["Proceeds sum (quantity < 0)"],
-            "Proceeds_converted sum (quantity < 0)": year_data["Proceeds_converted sum (quantity < 0)"],
-            "Comm/Fee sum (quantity < 0)": year_data["Comm/Fee sum (quantity < 0)"],
-            "Basis sum (quantity < 0)": year_data["Basis sum (quantity < 0)"],
-            "Basis_converted sum (quantity < 0)": year_data["Basis_converted sum (quantity < 0)"],
-            "Comm/Fee_converted sum (quantity < 0)": year_data["Comm/Fee_converted sum (quantity < 0)"]
-        })
+    # Generujemy nazwę pliku z datą
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = f"trades_export_{timestamp}.{export_format}"
     
-    # Tworzymy DataFrame z przygotowanych danych
-    export_df = pd.DataFrame(export_data)
+    # Parquet i XLSX wymagają opcjonalnych pakietów, importowanych dopiero przy eksporcie
+    if export_format == "parquet":
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            return "Eksport do Parquet wymaga pakietu pyarrow", 400
+        response = Response(stream_export_parquet(results, pa, pq), mimetype="application/vnd.apache.parquet")
+    elif export_format == "xlsx":
+        try:
+            import openpyxl
+        except ImportError:
+            return "Eksport do XLSX wymaga pakietu openpyxl", 400
+        return send_file(
+            build_export_xlsx(results, openpyxl),
+            mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            as_attachment=True,
+            download_name=filename
+        )
+    else:
+        response = Response(stream_export_csv(results), mimetype="text/csv")
     
-    # Sortujemy dane dla lepszej czytelności (najpierw po Stock, potem po Year)
-    export_df = export_df.sort_values(["Stock", "Year"], key=lambda x: x.map({"Total": 0}).fillna(x))
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return response
+
+
+@app.route("/snapshots", methods=["POST"])
+def save_snapshot_route():
+    """
+    Zapisuje migawkę bieżącego zbioru transakcji w katalogu migawek (include_fifo=1 – razem
+    z przetworzonym stanem FIFO).
+    """
+    portfolio = current_portfolio()
+    if not portfolio.trade_count():
+        return "Brak transakcji do zapisania", 400
+    directory = snapshots_dir(portfolio)
+    os.makedirs(directory, exist_ok=True)
+    name = f"snapshot_{datetime.now():%Y%m%d_%H%M%S_%f}.npz"
+    snapshot_current(portfolio, os.path.join(directory, name), request.form.get("include_fifo") == "1")
+    return redirect(url_for("index"))
+
+
+@app.route("/snapshots/<name>")
+def download_snapshot(name):
+    return send_from_directory(os.path.abspath(snapshots_dir(current_portfolio())), name, as_attachment=True)
+
+
+@app.route("/snapshots/restore", methods=["POST"])
+def restore_snapshot_route():
+    """
+    Przywraca zbiór transakcji z zapisanej migawki (pole name) albo z wgranego pliku .npz
+    (pole snapshot_file). Bieżący zbiór transakcji jest zastępowany.
+    """
+    portfolio = current_portfolio()
+    file = request.files.get("snapshot_file")
+    if file is not None and file.filename:
+        source = io.BytesIO(file.read())
+    else:
+        path = safe_join(os.path.abspath(snapshots_dir(portfolio)), request.form.get("name", ""))
+        if path is None or not os.path.isfile(path):
+            return "Nie znaleziono migawki", 400
+        source = path
     
-    # Zapisujemy do pamięci zamiast do pliku
-    output = io.StringIO()
-    export_df.to_csv(output, index=False)
-    output.seek(0)
+    try:
+        with measure("snapshot_restore"):
+            restore_snapshot(portfolio, source)
+    except ValueError as e:
+        return str(e), 400
+    return redirect(url_for("index"))
+
+
+@app.route("/profiles")
+@app.route("/profiles/<path:name>")
+def profiles(name=None):
+    """
+    Lista zapisanych profili (od najnowszego) albo pobranie pliku profilu. Wymaga tokenu profilowania.
+    """
+    if not profile_token_valid():
+        return "Brak dostępu do profili", 403
+    if name is not None:
+        return send_from_directory(os.path.abspath(app.config["PROFILES_DIR"]), name,
+                                   as_attachment=name.endswith(".prof"))
     
-    # Generujemy nazwę pliku z datą
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"trades_export_{timestamp}.csv"
+    directory = app.config["PROFILES_DIR"]
+    names = sorted(os.listdir(directory), reverse=True) if os.path.isdir(directory) else []
+    entries = [
+        {"name": profile[:-len(".prof")], "size": os.path.getsize(os.path.join(directory, profile))}
+        for profile in names if profile.endswith(".prof")
+    ]
+    return render_template("profiles.html", entries=entries, token=request.args.get("profile", ""))
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """
+    Metryki wszystkich procesów w formacie tekstowym Prometheusa (dostępne tylko lokalnie).
+    Histogramy procesów, które się zakończyły, są dołączane do zachowanej sumy (fold_metrics),
+    a ich wskaźniki pomijane.
+    """
+    if request.remote_addr not in app.config["METRICS_ALLOWED"]:
+        return "Metryki są dostępne tylko lokalnie", 403
     
-    # Zwracamy plik do pobrania - z parametrami dla Flask 2.0+
-    return send_file(
-        io.BytesIO(output.getvalue().encode('utf-8')),
-        mimetype='text/csv',
-        as_attachment=True,
-        download_name=filename
-    )
+    flush_metrics(force=True)
+    snapshots = trade_store.load_metrics()
+    finished = [key for key in snapshots if key != TradeStore.METRICS_RETAINED and not process_alive(*key)]
+    if finished:
+        trade_store.fold_metrics(finished)
+        snapshots = trade_store.load_metrics()
+    return Response(MetricsRegistry.render(snapshots), mimetype="text/plain; version=0.0.4")
 
 
 if __name__ == "__main__":